@@ -1,224 +1,53 @@
 #
 # Client-side python app for photoapp, this time working with
 # web service, which in turn uses AWS S3, RDS, and Rekognition
-# to implement a simple photo application for photo analysis, 
+# to implement a simple photo application for photo analysis,
 # storage, and viewing.
 #
+# Run without arguments for the interactive prompt, or give a
+# command for non-interactive use, e.g.
+#
+#   python main.py stats
+#   python main.py upload degu.jpg --user 80001
+#   python main.py bulk-upload ~/photos --user 80001 --pattern '*.jpg'
+#   python main.py bucket-export bucket.csv --format csv --user 80001
+#   python main.py assets-export assets.jsonl
+#   python main.py bulk-analyze --all --rate 5
+#   python main.py query 'dog AND NOT cat' --min-confidence 90
+#   python main.py batch commands.txt
+#
+# Non-interactive commands print one JSON object per line.
+#
 # Authors:
-#   
+#
 #   Neo Trovela-Villamiel
 #
 #   Starter code: Prof. Joe Hummel
 #   Northwestern University
 #
 
-import requests  # calling web service
-import jsons  # relational-object mapping
-
+import argparse
+import json
+import shlex
 import uuid
 import pathlib
 import logging
 import sys
-import os
-import base64
-import time
-
-from configparser import ConfigParser
-
-
-###################################################################
-#
-# classes
-#
-class User:
-  userid: int  # these must match columns from DB table
-  email: str
-  lastname: str
-  firstname: str
-  bucketfolder: str
 
+import photoapp_api
+import photoapp_bulk
+import photoapp_cache
+import photoapp_index
+import photoapp_metrics
+import photoapp_transform
+from photoapp_api import ApiError
+from photoapp_client import read_config, configure
+from photoapp_web import close_session
 
-class Asset:
-  assetid: int  # these must match columns from DB table
-  userid: int
-  assetname: str
-  bucketkey: str
-
-
-class BucketItem:
-  Key: str
-  LastModified: str
-  ETag: str
-  Size: int
-  StorageClass: str
 
-
-###################################################################
-#
-# web_service_get
-#
-# When calling servers on a network, calls can randomly fail. 
-# The better approach is to repeat at least N times (typically 
-# N=3), and then give up after N tries.
-#
-def web_service_get(url):
-  """
-  Submits a GET request to a web service at most 3 times, since 
-  web services can fail to respond e.g. to heavy user or internet 
-  traffic. If the web service responds with status code 200, 400 
-  or 500, we consider this a valid response and return the response.
-  Otherwise we try again, at most 3 times. After 3 attempts the 
-  function returns with the last response.
-  
-  Parameters
-  ----------
-  url: url for calling the web service
-  
-  Returns
-  -------
-  response received from web service
-  """
-
-  try:
-    retries = 0
-    
-    while True:
-      response = requests.get(url)
-        
-      if response.status_code in [200, 400, 500]:
-        #
-        # we consider this a successful call and response
-        #
-        break
-
-      #
-      # failed, try again?
-      #
-      retries = retries + 1
-      if retries < 3:
-        # try at most 3 times
-        time.sleep(retries)
-        continue
-          
-      #
-      # if get here, we tried 3 times, we give up:
-      #
-      break
-
-    return response
-
-  except Exception as e:
-    print("**ERROR**")
-    logging.error("web_service_get() failed:")
-    logging.error("url: " + url)
-    logging.error(e)
-    return None
-  
-def web_service_put(url, data):
-  """
-  Submits a PUT request to a web service at most 3 times, since 
-  web services can fail to respond e.g. to heavy user or internet 
-  traffic. If the web service responds with status code 200, 400 
-  or 500, we consider this a valid response and return the response.
-  Otherwise we try again, at most 3 times. After 3 attempts the 
-  function returns with the last response.
-  
-  Parameters
-  ----------
-  url: url for calling the web service
-  
-  Returns
-  -------
-  response received from web service
-  """
-
-  try:
-    retries = 0
-    
-    while True:
-      response = requests.put(url, json=data)
-        
-      if response.status_code in [200, 400, 500]:
-        #
-        # we consider this a successful call and response
-        #
-        break
-
-      #
-      # failed, try again?
-      #
-      retries = retries + 1
-      if retries < 3:
-        # try at most 3 times
-        time.sleep(retries)
-        continue
-          
-      #
-      # if get here, we tried 3 times, we give up:
-      #
-      break
-
-    return response
-
-  except Exception as e:
-    print("**ERROR**")
-    logging.error("web_service_get() failed:")
-    logging.error("url: " + url)
-    logging.error(e)
-    return None
-
-def web_service_post(url, data):
-  """
-  Submits a POST request to a web service at most 3 times, since 
-  web services can fail to respond e.g. to heavy user or internet 
-  traffic. If the web service responds with status code 200, 400 
-  or 500, we consider this a valid response and return the response.
-  Otherwise we try again, at most 3 times. After 3 attempts the 
-  function returns with the last response.
-  
-  Parameters
-  ----------
-  url: url for calling the web service
-  
-  Returns
-  -------
-  response received from web service
-  """
-
-  try:
-    retries = 0
-    
-    while True:
-      response = requests.post(url, json=data)
-        
-      if response.status_code in [200, 400, 500]:
-        #
-        # we consider this a successful call and response
-        #
-        break
-
-      #
-      # failed, try again?
-      #
-      retries = retries + 1
-      if retries < 3:
-        # try at most 3 times
-        time.sleep(retries)
-        continue
-          
-      #
-      # if get here, we tried 3 times, we give up:
-      #
-      break
-
-    return response
-
-  except Exception as e:
-    print("**ERROR**")
-    logging.error("web_service_get() failed:")
-    logging.error("url: " + url)
-    logging.error(e)
-    return None
+# pages of the bucket fetched ahead while browsing interactively,
+# see bucket_prefetch in the [client] section of the config:
+DEFAULT_BUCKET_PREFETCH = 2
 
 ###################################################################
 #
@@ -227,11 +56,11 @@ def web_service_post(url, data):
 def prompt():
   """
   Prompts the user and returns the command number
-  
+
   Parameters
   ----------
   None
-  
+
   Returns
   -------
   Command number entered by user (0, 1, 2, ...)
@@ -261,51 +90,38 @@ def prompt():
     return -1
 
 
+def print_api_error(e):
+  """
+  Prints the status code, url and (if any) error message of a
+  failed web service call.
+  """
+
+  print("Failed with status code:", e.status_code)
+  print("url: " + e.url)
+  if e.message is not None:
+    print("Error message:", e.message)
+
+
 ###################################################################
 #
 # stats
 #
 def stats(baseurl):
   """
-  Prints out S3 and RDS info: bucket status, # of users and 
+  Prints out S3 and RDS info: bucket status, # of users and
   assets in the database
-  
+
   Parameters
   ----------
   baseurl: baseurl for web service
-  
+
   Returns
   -------
   nothing
   """
 
   try:
-    #
-    # call the web service:
-    #
-    api = '/stats'
-    url = baseurl + api
-
-    # res = requests.get(url)
-    res = web_service_get(url)
-
-    #
-    # let's look at what we got back:
-    #
-    if res.status_code != 200:
-      # failed:
-      print("Failed with status code:", res.status_code)
-      print("url: " + url)
-      if res.status_code in [400, 500]:  # we'll have an error message
-        body = res.json()
-        print("Error message:", body["message"])
-      #
-      return
-
-    #
-    # deserialize and extract stats:
-    #
-    body = res.json()
+    body = photoapp_api.get_stats(baseurl)
     #
     msg = body["message"]
     numusers = body["db_numUsers"]
@@ -315,9 +131,11 @@ def stats(baseurl):
     print(f"# of users in PhotoApp DB: {numusers}")
     print(f"# of assets in PhotoApp DB: {numassets}")
 
+  except ApiError as e:
+    print_api_error(e)
+
   except Exception as e:
     logging.error("stats() failed:")
-    logging.error("url: " + url)
     logging.error(e)
     return
 
@@ -329,52 +147,21 @@ def stats(baseurl):
 def users(baseurl):
   """
   Prints out all the users in the database
-  
+
   Parameters
   ----------
   baseurl: baseurl for web service
-  
+
   Returns
   -------
   nothing
   """
 
   try:
+    users = photoapp_api.iter_users(baseurl)
     #
-    # call the web service:
-    #
-    api = '/users'
-    url = baseurl + api
-
-    # res = requests.get(url)
-    res = web_service_get(url)
-
-    #
-    # let's look at what we got back:
-    #
-    if res.status_code != 200:
-      # failed:
-      print("Failed with status code:", res.status_code)
-      print("url: " + url)
-      if res.status_code in [400, 500]:  # we'll have an error message
-        body = res.json()
-        print("Error message:", body["message"])
-      #
-      return
-
-    #
-    # deserialize and extract users:
-    #
-    body = res.json()
-    #
-    # let's map each dictionary into a User object:
-    #
-    users = []
-    for row in body["data"]:
-      user = jsons.load(row, User)
-      users.append(user)
-    #
-    # Now we can think OOP:
+    # Now we can think OOP, printing each page of users as it
+    # arrives:
     #
     for user in users:
       print(f"User id: {user.userid}")
@@ -382,9 +169,11 @@ def users(baseurl):
       print(f" Name: {user.lastname}, {user.firstname}")
       print(f" Folder: {user.bucketfolder}")
 
+  except ApiError as e:
+    print_api_error(e)
+
   except Exception as e:
     logging.error("users() failed:")
-    logging.error("url: " + url)
     logging.error(e)
     return
 
@@ -396,52 +185,21 @@ def users(baseurl):
 def assets(baseurl):
   """
   Prints out all the assets in the database
-  
+
   Parameters
   ----------
   baseurl: baseurl for web service
-  
+
   Returns
   -------
   nothing
   """
 
   try:
+    assets = photoapp_api.iter_assets(baseurl)
     #
-    # call the web service:
-    #
-    api = '/assets'
-    url = baseurl + api
-
-    # res = requests.get(url)
-    res = web_service_get(url)
-
-    #
-    # let's look at what we got back:
-    #
-    if res.status_code != 200:
-      # failed:
-      print("Failed with status code:", res.status_code)
-      print("url: " + url)
-      if res.status_code in [400, 500]:  # we'll have an error message
-        body = res.json()
-        print("Error message:", body["message"])
-      #
-      return
-
-    #
-    # deserialize and extract assets:
-    #
-    body = res.json()
-    #
-    # let's map each dictionary into an Asset object:
-    #
-    assets = []
-    for row in body["data"]:
-      asset = jsons.load(row, Asset)
-      assets.append(asset)
-    #
-    # Now we can think OOP:
+    # Now we can think OOP, printing each page of assets as it
+    # arrives:
     #
     for asset in assets:
       print(f"Asset id: {asset.assetid}")
@@ -449,9 +207,11 @@ def assets(baseurl):
       print(f" Asset name: {asset.assetname}")
       print(f" Bucket key: {asset.bucketkey}")
 
+  except ApiError as e:
+    print_api_error(e)
+
   except Exception as e:
     logging.error("assets() failed:")
-    logging.error("url: " + url)
     logging.error(e)
     return
 
@@ -464,11 +224,11 @@ def download(baseurl):
   """
   Prompts the user for an asset id, and downloads
   that asset (image) from the bucket.
-  
+
   Parameters
   ----------
   baseurl: baseurl for web service
-  
+
   Returns
   -------
   nothing
@@ -478,69 +238,22 @@ def download(baseurl):
     print("Enter asset id>")
     assetid = input()
 
-    #
-    # call the web service:
-    #
-    api = '/image'
-    url = baseurl + api + '/' + assetid
-
-    # res = requests.get(url)
-    res = web_service_get(url)
-
-    #
-    # let's look at what we got back:
-    #
-    if res.status_code != 200:
-      # failed:
-      print(res.json()["message"])
-      #
-      return
-
-    #
-    # deserialize and extract image:
-    #
-    body = res.json()
-
-    #print(body)
-    #print(body.keys())
-
-    #
-    # TODO:
-    #
-    userid = body['user_id']
-    assetname = body['asset_name'] 
-    bucketkey = body['bucket_key']
-    decoded_data = base64.b64decode(body['data'])
-    bytes = decoded_data
-
-    print("userid:", userid)
-    print("asset name:", assetname)
-    print("bucket key:", bucketkey)
+    result = photoapp_api.download_image(baseurl, assetid)
 
-    #
-    # write the binary data to a file (as a
-    # binary file, not a text file):
-    #
-    # TODO
-    #
-    with open(assetname, 'wb') as outfile:
-      outfile.write(decoded_data)
+    print("userid:", result['user_id'])
+    print("asset name:", result['asset_name'])
+    print("bucket key:", result['bucket_key'])
 
-    print(f"Downloaded from S3 and saved as '{assetname}'")
-    expected_file = assetname
-
-    with open(assetname, 'rb') as f1, open(expected_file, 'rb') as f2: # check if download correctly
-      file1_data = f1.read()
-      file2_data = f2.read()
+    if result['cached']:
+      print(f"Found in local cache and saved as '{result['filename']}'")
+    else:
+      print(f"Downloaded from S3 and saved as '{result['filename']}'")
 
-    if file1_data != file2_data:
-      print(f"**ERROR:")
-      print(f"**ERROR in download: downloaded file differs from original")
-      print(f"**ERROR:")
+  except ApiError as e:
+    print_api_error(e)
 
   except Exception as e:
     logging.error("download() failed:")
-    logging.error("url: " + url)
     logging.error(e)
     return
 
@@ -549,91 +262,37 @@ def download(baseurl):
 #
 # bucket_contents
 #
-def bucket_contents(baseurl):
+def bucket_contents(baseurl, prefetch=DEFAULT_BUCKET_PREFETCH):
   """
-  Prints out the contents of the S3 bucket
-  
+  Prints out the contents of the S3 bucket, a page at a time.
+  While a page is shown, the next pages are already being
+  fetched in the background, so page turns are instant.
+
   Parameters
   ----------
   baseurl: baseurl for web service
-  
+  prefetch: # of pages fetched ahead of the one shown
+
   Returns
   -------
   nothing
   """
 
+  pages = photoapp_api.iter_bucket_pages(baseurl, prefetch=prefetch)
+
   try:
     #
-    # call the web service:
+    # the service returns the bucket page by page, the
+    # iterator follows the pages for us:
     #
-    api = '/bucket'
-    url = baseurl + api
+    for page in pages:
+      for item in page:
+        print(f"Bucket key: {item.Key}")
+        print(f" Last modified: {item.LastModified}")
+        print(f" Size: {item.Size}")
 
-    #
-    # we have to loop since data is returned page
-    # by page:
-    #
-    lastkey = ""
-    
-    while True:
-      #
-      # make a request...
-      # check status code, if failed break out of loop
-      # any data? if not, break out of loop
-      # display data
-      #
-      
-      #
-      # TODO
-      #
-      #print(f"Bucket key: {item.Key}")
-      #print(f" Last modified: {item.LastModified}")
-      #print(f" Size: {item.Size}")
-      res = web_service_get(url)
-
-      #
-      # let's look at what we got back:
-      #
-      if res.status_code != 200:
-        # failed:
-        print("Failed with status code:", res.status_code)
-        print("url: " + url)
-        if res.status_code in [400, 500]:  # we'll have an error message
-          body = res.json()
-          print("Error message:", body["message"])
-        #
-        return
-      
-      body = res.json()
-
-      #print(body.keys())
-      #print(body['data'])
-      body_data = body['data']
-
-      num_assets = len(body_data)
-
-      if num_assets < 12: # special case
-        for i in range(num_assets):
-          bucket_key = body_data[i]['Key']
-          last_mod = body_data[i]['LastModified']
-          bucket_size = body_data[i]['Size']
-
-          print(f"Bucket key: {bucket_key}")
-          print(f" Last modified: {last_mod}")
-          print(f" Size: {bucket_size}")
+      if len(page) < photoapp_api.BUCKET_PAGE_SIZE:  # no more pages
         break
-    
-      bucket_key = 0
-      for i in range(12): # only 12 at a time
-        bucket_key = body_data[i]['Key']
-        last_mod = body_data[i]['LastModified']
-        bucket_size = body_data[i]['Size']
-
-        print(f"Bucket key: {bucket_key}")
-        print(f" Last modified: {last_mod}")
-        print(f" Size: {bucket_size}")
-
-      lastkey = bucket_key # need last key for next 12
       #
       # prompt...
       # if 'y' then continue, else break
@@ -641,21 +300,20 @@ def bucket_contents(baseurl):
       print("another page? [y/n]")
       answer = input()
       #
-      if answer == 'y':
-        # add parameter to url
-        url = baseurl + api
-        url += "?startafter=" + lastkey
-        #
-        continue
-      else:
+      if answer != 'y':
         break
 
+  except ApiError as e:
+    print_api_error(e)
+
   except Exception as e:
     logging.error("bucket_contents() failed:")
-    logging.error("url: " + url)
     logging.error(e)
     return
 
+  finally:
+    pages.close()  # stops fetching pages ahead
+
 
 ###################################################################
 #
@@ -663,16 +321,16 @@ def bucket_contents(baseurl):
 #
 def upload(baseurl):
   """
-  Prompts the user for a local filename and user id, 
-  and uploads that asset (image) to the user's folder 
-  in the bucket. The asset is given a random, unique 
-  name. The database is also updated to record the 
+  Prompts the user for a local filename and user id,
+  and uploads that asset (image) to the user's folder
+  in the bucket. The asset is given a random, unique
+  name. The database is also updated to record the
   existence of this new asset in S3.
-  
+
   Parameters
   ----------
   baseurl: baseurl for web service
-  
+
   Returns
   -------
   nothing
@@ -689,60 +347,18 @@ def upload(baseurl):
     print("Enter user id>")
     userid = input()
 
-    #
-    # build the data packet:
-    #
-    infile = open(local_filename, "rb")
-    bytes = infile.read()
-    infile.close()
-
-    #
-    # now encode the image as base64. Note b64encode returns
-    # a bytes object, not a string. So then we have to convert
-    # (decode) the bytes -> string, and then we can serialize
-    # the string as JSON for upload to server:
-    #
-    data = base64.b64encode(bytes)
-    datastr = data.decode()
-
-    data = {"assetname": local_filename, "data": datastr}
+    result = photoapp_api.upload_image(baseurl, userid, local_filename)
 
-    #
-    # call the web service:
-    #
-    api = '/image'
-    url = baseurl + api + "/" + userid
-
-    #res = requests.post(url, json=data)
-    res = web_service_post(url, data)
-
-    #
-    # let's look at what we got back:
-    #
-    if res.status_code != 200:
-      # failed:
-      print("Failed with status code:", res.status_code)
-      print("url: " + url)
-      if res.status_code in [400, 500]:  # we'll have an error message
-        body = res.json()
-        print("Error message:", body["message"])
-      #
-      return
-
-    #
-    # success, extract userid:
-    #
-    body = res.json()
-
-    asset_id = body["asset_id"]
-    message = body["message"]
-    #print(message)
+    if result["duplicate"]:
+      print(f"Image already uploaded with the same contents, asset id = {result['asset_id']}")
+    else:
+      print(f"Image uploaded, asset id = {result['asset_id']}")
 
-    print(f"Image uploaded, asset id = {asset_id}")
+  except ApiError as e:
+    print_api_error(e)
 
   except Exception as e:
     logging.error("upload() failed:")
-    logging.error("url: " + url)
     logging.error(e)
     return
 
@@ -759,11 +375,11 @@ def add_user(baseurl):
   email already exists in the database, then we
   update the user's info instead of inserting
   a new user.
-  
+
   Parameters
   ----------
   baseurl: baseurl for web service
-  
+
   Returns
   -------
   nothing
@@ -782,60 +398,15 @@ def add_user(baseurl):
     # generate unique folder name:
     folder = str(uuid.uuid4())
 
-    #
-    # build the data packet:
-    #
-    # TODO
-    #
-    data = {
-      "email": email,
-      "lastname": last_name,
-      "firstname": first_name,
-      "bucketfolder": folder
-    }
-
-    #
-    # call the web service:
-    #
-    api = '/user'
-    url = baseurl + api
-    
-    #
-    # TODO
-    #
-    # res = requests.???(url, json=???)
-    #
-    res = web_service_put(url, data) # function to try request at least 3 times
-    #res = requests.put(url, json=data)
-
-    #
-    # let's look at what we got back:
-    #
-    if res.status_code != 200:
-      # failed:
-      print("Failed with status code:", res.status_code)
-      print("url: " + url)
-      if res.status_code in [400, 500]:  # we'll have an error message
-        body = res.json()
-        print("Error message:", body["message"])
-      #
-      return
-
-    #
-    # success, extract userid:
-    #
-    body = res.json()
-
-    user_id = body["user_id"]
-    message = body["message"]
-
-    #print(message)
+    user_id, message = photoapp_api.put_user(baseurl, email, last_name, first_name, folder)
 
     print(f"User {user_id} successfully {message}")
 
+  except ApiError as e:
+    print_api_error(e)
+
   except Exception as e:
     logging.error("add_user() failed:")
-    logging.error("url: " + url)
     logging.error(e)
     return
 
@@ -844,98 +415,97 @@ def add_user(baseurl):
 # analyze
 #
 def analyze(baseurl):
+  """
+  Prompts the user for an asset id and prints the labels
+  Rekognition finds in that asset (image).
+
+  Parameters
+  ----------
+  baseurl: baseurl for web service
+
+  Returns
+  -------
+  nothing
+  """
 
   try:
     print("Enter asset id>")
     assetid = input()
-    #
-    # call the web service:
-    #
-    api = '/labels'
-    url = baseurl + api + '/' + assetid
 
-    # res = requests.get(url)
-    res = web_service_get(url)
+    asset_name, all_data = photoapp_api.get_labels(baseurl, assetid)
 
-    #
-    # let's look at what we got back:
-    #
-    if res.status_code != 200:
-      # failed:
-      print(res.json()["message"])
-      return
-
-    # success
-    body = res.json()
-    #print(body)
-    print(f"analyzing '{body['asset_name']}'...")
-    all_data = body['data']
-    #print(all_data)
+    print(f"analyzing '{asset_name}'...")
     if all_data == []:
       print('No labels found...')
     else:
       for line in all_data:
-        #print(line)
         print(line['name'] + ' with ' + str(line['confidence']) + '% confidence')
 
+  except ApiError as e:
+    print_api_error(e)
+
   except Exception as e:
-    logging.error("stats() failed:")
-    logging.error("url: " + url)
+    logging.error("analyze() failed:")
     logging.error(e)
     return
-  
+
 ###################################################################
 #
 # search
 #
 def search(baseurl):
+  """
+  Prompts the user for a label and prints the analyzed
+  assets (images) that have this label.
+
+  Parameters
+  ----------
+  baseurl: baseurl for web service
+
+  Returns
+  -------
+  nothing
+  """
 
   try:
     print("Enter label to search for>")
     label = input()
-    #
-    # call the web service:
-    #
-    api = '/images'
-    url = baseurl + api + '/' + label
 
-    # res = requests.get(url)
-    res = web_service_get(url)
-
-    #
-    # let's look at what we got back:
-    #
-    if res.status_code != 200:
-      # failed:
-      print(body["message"])
-      return
-
-    # success
-    body = res.json()
-    #print(body)
-    #asset 1001 with 97% confidence
-    data = body['data']
+    data = photoapp_api.search_images(baseurl, label)
 
     if data == []:
       print('No assets found...')
     else:
       for asset in data:
-        #print(asset)
         print('asset ' + str(asset['asset_id']) + ' with ' + str(asset['confidence']) + '% confidence')
-        #print(asset['asset_id'])
-        #print
+
+  except ApiError as e:
+    print_api_error(e)
 
   except Exception as e:
-    logging.error("stats() failed:")
-    logging.error("url: " + url)
+    logging.error("search() failed:")
     logging.error(e)
     return
 
 
-#########################################################################
-# main
+###################################################################
+#
+# interactive
 #
-try:
+def interactive(config_file=None):
+  """
+  Runs the interactive prompt until the user enters 0.
+
+  Parameters
+  ----------
+  config_file: client config file, or None to ask the user
+
+  Returns
+  -------
+  nothing
+  """
+
+  try:
     print('** Welcome to Multi-tier PhotoApp **')
     print()
 
@@ -945,50 +515,33 @@ try:
     #
     # what config file should we use for this session?
     #
-    config_file = 'photoapp-client-config.ini'
+    if config_file is None:
+      config_file = 'photoapp-client-config.ini'
 
-    print("What config file to use for this session?")
-    print("Press ENTER to use default (photoapp-client-config.ini),")
-    print("otherwise enter name of config file>")
-    s = input()
+      print("What config file to use for this session?")
+      print("Press ENTER to use default (photoapp-client-config.ini),")
+      print("otherwise enter name of config file>")
+      s = input()
 
-    if s == "":  # use default
-      pass  # already set
-    else:
-      config_file = s
+      if s == "":  # use default
+        pass  # already set
+      else:
+        config_file = s
 
-    #
-    # does config file exist?
-    #
-    if not pathlib.Path(config_file).is_file():
-      print("**ERROR: config file '", config_file, "' does not exist, exiting")
+    try:
+      configur, baseurl = read_config(config_file)
+    except ValueError as e:
+      print("**ERROR**")
+      print("**ERROR:", str(e))
       sys.exit(0)
 
     #
-    # setup base URL to web service:
+    # one pooled, keep-alive session for the whole run, how
+    # its calls retry, and the local caches:
     #
-    configur = ConfigParser()
-    configur.read(config_file)
-    baseurl = configur.get('client', 'webservice')
+    configure(configur)
 
-    #
-    # make sure baseurl does not end with /, if so remove:
-    #
-    if len(baseurl) < 16:
-      print("**ERROR**")
-      print("**ERROR: baseurl '", baseurl, "' in .ini file is empty or not nearly long enough, please fix")
-      sys.exit(0)
-
-    if baseurl.startswith('https'):
-      print("**ERROR**")
-      print("**ERROR: baseurl '", baseurl, "' in .ini file starts with https, which is not supported (use http)")
-      sys.exit(0)
-
-    lastchar = baseurl[len(baseurl) - 1]
-    if lastchar == "/":
-      baseurl = baseurl[:-1]
-
-    # print(baseurl)
+    prefetch = configur.getint('client', 'bucket_prefetch', fallback=DEFAULT_BUCKET_PREFETCH)
 
     #
     # main processing loop:
@@ -1006,7 +559,7 @@ try:
       elif cmd == 4:
         download(baseurl)
       elif cmd == 5:
-        bucket_contents(baseurl)
+        bucket_contents(baseurl, prefetch)
       elif cmd == 6:
         upload(baseurl)
       elif cmd == 7:
@@ -1023,10 +576,546 @@ try:
     #
     # done
     #
+    close_session()
+    photoapp_index.save_index()
+    photoapp_metrics.save_metrics('interactive')
+
     print()
     print('** done **')
 
-except Exception as e:
+  except Exception as e:
     print("ERROR")
     print("ERROR:", str(e))
     print("ERROR")
+
+
+###################################################################
+#
+# non-interactive commands
+#
+# Each takes the web service's baseurl and the parsed arguments,
+# and returns a result that can be serialized as JSON.
+#
+def cmd_stats(baseurl, args):
+  return photoapp_api.get_stats(baseurl)
+
+
+def cmd_users(baseurl, args):
+  return [user.as_dict() for user in photoapp_api.get_users(baseurl)]
+
+
+def cmd_assets(baseurl, args):
+  return [asset.as_dict() for asset in photoapp_api.get_assets(baseurl)]
+
+
+def cmd_download(baseurl, args):
+  return photoapp_api.download_image(baseurl, args.assetid, args.output,
+                                     use_cache=not args.no_cache)
+
+
+def bucket_prefix(baseurl, args):
+  """
+  The key prefix selected by --prefix or --user (the user's
+  bucket folder), or None.
+  """
+
+  if args.user is None:
+    return args.prefix
+
+  for user in photoapp_api.iter_users(baseurl):
+    if user.userid == args.user:
+      return user.bucketfolder + '/'
+
+  raise ValueError(f"no such user: {args.user}")
+
+
+def cmd_bucket(baseurl, args):
+  prefix = bucket_prefix(baseurl, args)
+
+  if not args.all:
+    pages = photoapp_api.iter_bucket_pages(baseurl, args.startafter, prefix, prefetch=0)
+    return [item.as_dict() for item in next(pages, [])]
+
+  return [item.as_dict() for item in photoapp_api.iter_bucket(baseurl, args.startafter, prefix)]
+
+
+def export(rows, args):
+  """
+  Writes records to args.output ('-' for stdout) in args.format.
+  """
+
+  if args.output == '-':
+    return photoapp_bulk.export_rows(rows, sys.stdout, args.format)
+
+  with open(args.output, 'w', newline='') as outfile:
+    result = photoapp_bulk.export_rows(rows, outfile, args.format)
+
+  result["output"] = args.output
+  return result
+
+
+def cmd_bucket_export(baseurl, args):
+  prefix = bucket_prefix(baseurl, args)
+  return export(photoapp_api.iter_bucket(baseurl, args.startafter, prefix), args)
+
+
+def cmd_users_export(baseurl, args):
+  return export(photoapp_api.iter_users(baseurl, args.page_size), args)
+
+
+def cmd_assets_export(baseurl, args):
+  return export(photoapp_api.iter_assets(baseurl, args.page_size), args)
+
+
+def upload_transform(args):
+  """
+  The configured image transform, with the settings given by
+  --max-dimension, --quality and --strip-exif changed.
+  """
+
+  return photoapp_transform.get_upload_transform().replace(
+    max_dimension=args.max_dimension,
+    quality=args.quality,
+    strip_exif=True if args.strip_exif else None)
+
+
+def cmd_upload(baseurl, args):
+  if not pathlib.Path(args.file).is_file():
+    raise ValueError(f"local file '{args.file}' does not exist")
+
+  result = photoapp_api.upload_image(baseurl, args.user, args.file, args.name,
+                                     force=args.force,
+                                     transform=upload_transform(args))
+  result["file"] = args.file
+
+  return result
+
+
+def cmd_bulk_upload(baseurl, args):
+  return photoapp_bulk.bulk_upload(baseurl, args.user, args.sources,
+                                   pattern=args.pattern,
+                                   workers=args.workers,
+                                   manifest=args.manifest,
+                                   force=args.force,
+                                   transform=upload_transform(args))
+
+
+def cmd_bulk_download(baseurl, args):
+  assetids = photoapp_bulk.parse_asset_ids(args.assetids)
+  bucketkeys = {}
+
+  if args.user is not None or args.all:
+    for asset in photoapp_api.iter_assets(baseurl):
+      if args.all or asset.userid == args.user:
+        assetids.append(asset.assetid)
+        bucketkeys[asset.assetid] = asset.bucketkey
+    assetids = list(dict.fromkeys(assetids))
+
+  return photoapp_bulk.bulk_download(baseurl, assetids, args.to, bucketkeys,
+                                     workers=args.workers)
+
+
+def cmd_bulk_analyze(baseurl, args):
+  assetids = photoapp_bulk.parse_asset_ids(args.assetids)
+
+  if args.user is not None or args.all or not assetids:
+    for asset in photoapp_api.iter_assets(baseurl):
+      if args.user is None or asset.userid == args.user:
+        assetids.append(asset.assetid)
+    assetids = list(dict.fromkeys(assetids))
+
+  return photoapp_bulk.bulk_analyze(baseurl, assetids, workers=args.workers,
+                                    rate=args.rate, refresh=args.refresh)
+
+
+def cmd_cache_stats(baseurl, args):
+  downloads = photoapp_cache.get_download_cache()
+
+  uploads = photoapp_cache.get_upload_index()
+
+  responses = photoapp_cache.get_response_cache()
+
+  return {
+    "downloads": downloads.stats() if downloads is not None else None,
+    "labels": photoapp_cache.get_label_cache().stats(),
+    "uploads": uploads.stats() if uploads is not None else None,
+    "responses": responses.stats() if responses is not None else None
+  }
+
+
+def cmd_cache_clear(baseurl, args):
+  downloads = photoapp_cache.get_download_cache()
+  labels = photoapp_cache.get_label_cache()
+
+  if args.uploads:
+    uploads = photoapp_cache.get_upload_index()
+    if uploads is not None:
+      uploads.clear()
+  elif args.asset is None and args.label is None:
+    if downloads is not None and not args.labels_only:
+      downloads.clear()
+    labels.invalidate()
+    responses = photoapp_cache.get_response_cache()
+    if responses is not None:
+      responses.clear()
+  else:
+    labels.invalidate(baseurl, args.asset, args.label)
+
+  return cmd_cache_stats(baseurl, args)
+
+
+def cmd_add_user(baseurl, args):
+  folder = args.folder if args.folder else str(uuid.uuid4())
+
+  user_id, message = photoapp_api.put_user(baseurl, args.email, args.lastname, args.firstname, folder)
+
+  return {"user_id": user_id, "message": message, "bucketfolder": folder}
+
+
+def cmd_analyze(baseurl, args):
+  asset_name, labels = photoapp_api.get_labels(baseurl, args.assetid,
+                                               use_cache=not args.refresh)
+
+  return {"asset_id": args.assetid, "asset_name": asset_name, "labels": labels}
+
+
+def cmd_search(baseurl, args):
+  return photoapp_api.search_images(baseurl, args.label,
+                                    use_cache=not args.refresh)
+
+
+def cmd_query(baseurl, args):
+  index = photoapp_index.get_label_index(baseurl)
+  assetids = index.query(args.expression, args.min_confidence)
+
+  return {"count": len(assetids),
+          "asset_ids": assetids if args.limit is None else assetids[:args.limit]}
+
+
+def cmd_index_stats(baseurl, args):
+  index = photoapp_index.get_label_index(baseurl)
+
+  result = index.stats()
+  if args.labels:
+    result["top_labels"] = index.labels()[:args.labels]
+  return result
+
+
+def cmd_index_rebuild(baseurl, args):
+  index = photoapp_index.LabelIndex()
+  for assetid, labels in photoapp_cache.get_label_cache().all_labels(baseurl):
+    index.add(assetid, labels)
+
+  photoapp_index.set_label_index(baseurl, index)
+  return index.stats()
+
+
+def cmd_metrics(baseurl, args):
+  metrics = photoapp_metrics.get_metrics()
+
+  result = metrics.snapshot()
+
+  if args.export is not None:
+    if args.format == 'prometheus':
+      text = metrics.to_prometheus()
+    else:
+      text = metrics.to_json_lines()
+    with open(args.export, 'a' if args.format == 'jsonl' else 'w') as outfile:
+      outfile.write(text)
+    result["exported"] = {"file": args.export, "format": args.format}
+
+  if args.reset:
+    metrics.reset()
+
+  return result
+
+
+class CommandParser(argparse.ArgumentParser):
+  """
+  Argument parser for lines of a batch script: raises ValueError
+  on bad input instead of exiting the program.
+  """
+
+  def error(self, message):
+    raise ValueError(message)
+
+
+def add_commands(subparsers):
+  """
+  Adds the non-interactive commands to the given subparsers.
+  """
+
+  p = subparsers.add_parser('stats', help="bucket status, # of users and assets")
+  p.set_defaults(func=cmd_stats)
+
+  p = subparsers.add_parser('users', help="all users")
+  p.set_defaults(func=cmd_users)
+
+  p = subparsers.add_parser('assets', help="all assets")
+  p.set_defaults(func=cmd_assets)
+
+  p = subparsers.add_parser('download', help="download an asset")
+  p.add_argument('assetid', type=int)
+  p.add_argument('-o', '--output', help="local file, default is the asset name")
+  p.add_argument('--no-cache', action='store_true', help="bypass the local download cache")
+  p.set_defaults(func=cmd_download)
+
+  p = subparsers.add_parser('bucket', help="bucket contents")
+  p.add_argument('--startafter', help="bucket key to start after")
+  p.add_argument('--all', action='store_true', help="all pages, not just one")
+  p.add_argument('--prefix', help="only keys starting with this")
+  p.add_argument('--user', type=int, help="only this user's bucket folder")
+  p.set_defaults(func=cmd_bucket)
+
+  p = subparsers.add_parser('bucket-export', help="write the whole bucket listing as JSON lines or CSV")
+  p.add_argument('output', help="file to write, '-' for stdout (before the command's own result line)")
+  p.add_argument('--format', choices=['jsonl', 'csv'], default='jsonl')
+  p.add_argument('--startafter', help="bucket key to start after")
+  p.add_argument('--prefix', help="only keys starting with this")
+  p.add_argument('--user', type=int, help="only this user's bucket folder")
+  p.set_defaults(func=cmd_bucket_export)
+
+  for name, func in (('users', cmd_users_export), ('assets', cmd_assets_export)):
+    p = subparsers.add_parser(f'{name}-export', help=f"write all {name} as JSON lines or CSV, page by page")
+    p.add_argument('output', help="file to write, '-' for stdout (before the command's own result line)")
+    p.add_argument('--format', choices=['jsonl', 'csv'], default='jsonl')
+    p.add_argument('--page-size', type=int, default=photoapp_api.DEFAULT_PAGE_SIZE, help=f"{name} per call")
+    p.set_defaults(func=func)
+
+  p = subparsers.add_parser('upload', help="upload a local file")
+  p.add_argument('file')
+  p.add_argument('--user', type=int, required=True, help="user id")
+  p.add_argument('--name', help="asset name, default is the file name")
+  p.add_argument('--force', action='store_true', help="upload even if the same contents were uploaded before")
+  add_transform_arguments(p)
+  p.set_defaults(func=cmd_upload)
+
+  p = subparsers.add_parser('bulk-upload', help="upload directories of files in parallel")
+  p.add_argument('sources', nargs='+', help="directories, files or glob patterns")
+  p.add_argument('--user', type=int, required=True, help="user id")
+  p.add_argument('--pattern', default='*', help="file name pattern within directories (default: *)")
+  p.add_argument('--workers', type=int, default=photoapp_bulk.DEFAULT_WORKERS)
+  p.add_argument('--manifest', default=photoapp_bulk.DEFAULT_UPLOAD_MANIFEST,
+                 help="JSON lines file of uploaded files, used to resume")
+  p.add_argument('--force', action='store_true',
+                 help="upload every file, even if uploaded before (by path or by contents)")
+  add_transform_arguments(p)
+  p.set_defaults(func=cmd_bulk_upload)
+
+  p = subparsers.add_parser('bulk-download', help="download many assets in parallel")
+  p.add_argument('assetids', nargs='*', help="asset ids or ranges, e.g. 1001-1050")
+  p.add_argument('--to', required=True, help="directory to download into")
+  p.add_argument('--user', type=int, help="also all assets of this user")
+  p.add_argument('--all', action='store_true', help="all assets")
+  p.add_argument('--workers', type=int, default=photoapp_bulk.DEFAULT_WORKERS)
+  p.set_defaults(func=cmd_bulk_download)
+
+  p = subparsers.add_parser('bulk-analyze', help="label many assets with Rekognition, skipping analyzed ones")
+  p.add_argument('assetids', nargs='*', help="asset ids or ranges; default is all assets")
+  p.add_argument('--user', type=int, help="all assets of this user")
+  p.add_argument('--all', action='store_true', help="all assets")
+  p.add_argument('--workers', type=int, default=photoapp_bulk.DEFAULT_ANALYZE_WORKERS)
+  p.add_argument('--rate', type=float, default=photoapp_bulk.DEFAULT_ANALYZE_RATE,
+                 help="max /labels calls per second, 0 for no limit")
+  p.add_argument('--refresh', action='store_true', help="also re-analyze assets analyzed before")
+  p.set_defaults(func=cmd_bulk_analyze)
+
+  p = subparsers.add_parser('cache-stats', help="download, label and response cache sizes, hit rates, bytes saved")
+  p.set_defaults(func=cmd_cache_stats)
+
+  p = subparsers.add_parser('cache-clear', help="empty the caches, or drop one asset's labels or one search")
+  p.add_argument('--asset', type=int, help="only drop the cached labels of this asset")
+  p.add_argument('--label', help="only drop the cached search for this label")
+  p.add_argument('--labels-only', action='store_true', help="keep the download cache")
+  p.add_argument('--uploads', action='store_true',
+                 help="only forget which contents were uploaded (kept otherwise)")
+  p.set_defaults(func=cmd_cache_clear)
+
+  p = subparsers.add_parser('add-user', help="add or update a user")
+  p.add_argument('email')
+  p.add_argument('lastname')
+  p.add_argument('firstname')
+  p.add_argument('--folder', help="bucket folder, default is a new uuid")
+  p.set_defaults(func=cmd_add_user)
+
+  p = subparsers.add_parser('analyze', help="labels of an asset")
+  p.add_argument('assetid', type=int)
+  p.add_argument('--refresh', action='store_true', help="ignore the label cache")
+  p.set_defaults(func=cmd_analyze)
+
+  p = subparsers.add_parser('search', help="assets with a label")
+  p.add_argument('label')
+  p.add_argument('--refresh', action='store_true', help="ignore cached search results")
+  p.set_defaults(func=cmd_search)
+
+  p = subparsers.add_parser('query', help="search the local label index, e.g. 'dog AND NOT cat'")
+  p.add_argument('expression', help="labels with AND, OR, NOT, (), prefix* and label>=N")
+  p.add_argument('--min-confidence', type=int, default=0, help="for labels without their own >=N")
+  p.add_argument('--limit', type=int, help="list at most this many asset ids")
+  p.set_defaults(func=cmd_query)
+
+  p = subparsers.add_parser('index-stats', help="size of the local label index")
+  p.add_argument('--labels', type=int, default=0, help="also list the N most common labels")
+  p.set_defaults(func=cmd_index_stats)
+
+  p = subparsers.add_parser('index-rebuild', help="rebuild the local label index from the label cache")
+  p.set_defaults(func=cmd_index_rebuild)
+
+  p = subparsers.add_parser('metrics', help="latency, errors, retries and bytes per endpoint so far (e.g. in a batch)")
+  p.add_argument('--export', help="also write them to this file")
+  p.add_argument('--format', choices=['prometheus', 'jsonl'], default='jsonl',
+                 help="format of --export: Prometheus text (overwritten) or JSON lines (appended)")
+  p.add_argument('--reset', action='store_true', help="start counting again")
+  p.set_defaults(func=cmd_metrics)
+
+
+def add_transform_arguments(p):
+  """
+  Options of the image transform before upload; by default the
+  settings from the config are used.
+  """
+
+  p.add_argument('--max-dimension', type=int,
+                 help="scale images down to at most this many pixels wide and high (needs Pillow)")
+  p.add_argument('--quality', type=int, help="re-encode JPEGs at this quality, 1-95")
+  p.add_argument('--strip-exif', action='store_true', help="drop EXIF metadata from images")
+
+
+def emit(command, result=None, error=None):
+  """
+  Prints the outcome of a command as one line of JSON.
+  """
+
+  line = {"command": command, "ok": error is None}
+
+  if error is None:
+    line["result"] = result
+  else:
+    line["error"] = str(error)
+    if isinstance(error, ApiError):
+      line["status_code"] = error.status_code
+
+  print(json.dumps(line), flush=True)
+
+
+def run_command(baseurl, args):
+  """
+  Runs one parsed command and emits its result, returning True
+  if it succeeded.
+  """
+
+  try:
+    result = args.func(baseurl, args)
+    emit(args.command, result=result)
+    return True
+
+  except Exception as e:
+    emit(args.command, error=e)
+    return False
+
+
+def run_batch(baseurl, script, stop_on_error=False):
+  """
+  Runs the commands in a script file (or stdin if script is '-'),
+  one command per line with the same syntax as on the command
+  line. Blank lines and # comments are skipped. All commands share
+  the same web service session.
+
+  Parameters
+  ----------
+  baseurl: baseurl for web service
+  script: name of the script file, or '-'
+  stop_on_error: stop at the first command that fails
+
+  Returns
+  -------
+  True if every command succeeded
+  """
+
+  parser = CommandParser(prog='batch')
+  add_commands(parser.add_subparsers(dest='command', required=True))
+
+  if script == '-':
+    lines = sys.stdin
+  else:
+    lines = open(script, 'r')
+
+  all_ok = True
+
+  with lines:
+    for lineno, line in enumerate(lines, start=1):
+      try:
+        words = shlex.split(line, comments=True)
+        if len(words) == 0:
+          continue
+        args = parser.parse_args(words)
+      except ValueError as e:
+        emit(f"line {lineno}", error=e)
+        ok = False
+      else:
+        ok = run_command(baseurl, args)
+
+      all_ok = all_ok and ok
+      if not ok and stop_on_error:
+        break
+
+  return all_ok
+
+
+def build_parser():
+  """
+  Returns the parser for the program's command line.
+  """
+
+  parser = argparse.ArgumentParser(
+    prog='main.py',
+    description="PhotoApp client. Without a command, runs the interactive prompt.")
+
+  parser.add_argument('-c', '--config', help="client config file (default: photoapp-client-config.ini)")
+
+  subparsers = parser.add_subparsers(dest='command')
+  add_commands(subparsers)
+
+  p = subparsers.add_parser('batch', help="run the commands in a script file ('-' for stdin)")
+  p.add_argument('script')
+  p.add_argument('--stop-on-error', action='store_true')
+
+  return parser
+
+
+#########################################################################
+# main
+#
+def main(argv=None):
+  parser = build_parser()
+  args = parser.parse_args(argv)
+
+  if args.command is None:
+    interactive(args.config)
+    return 0
+
+  config_file = args.config if args.config else 'photoapp-client-config.ini'
+
+  try:
+    configur, baseurl = read_config(config_file)
+  except ValueError as e:
+    print("**ERROR:", str(e), file=sys.stderr)
+    return 2
+
+  configure(configur)
+
+  try:
+    if args.command == 'batch':
+      ok = run_batch(baseurl, args.script, args.stop_on_error)
+    else:
+      ok = run_command(baseurl, args)
+  finally:
+    close_session()
+    photoapp_index.save_index()
+    photoapp_metrics.save_metrics(args.command)
+
+  return 0 if ok else 1
+
+
+if __name__ == "__main__":
+  sys.exit(main())
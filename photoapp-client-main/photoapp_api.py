@@ -0,0 +1,978 @@
+#
+# photoapp_api.py
+#
+# One function per PhotoApp web service endpoint. Each calls the
+# web service (through photoapp_web), checks the response and
+# returns the deserialized result, so the same calls can be used
+# by the interactive prompt and by the command-line/batch mode
+# in main.py. A response other than 200 raises ApiError.
+#
+# Authors:
+#
+#   Neo Trovela-Villamiel
+#
+
+import hashlib
+import io
+import os
+import pathlib
+import queue
+import tempfile
+import threading
+import time
+import urllib.parse
+
+from configparser import ConfigParser
+
+import photoapp_cache
+import photoapp_index
+import photoapp_stream
+import photoapp_transform
+from photoapp_records import Record, RecordColumns, decode_rows
+from photoapp_web import web_service_get, web_service_put, web_service_post, WebServiceError
+
+
+# the web service returns the bucket contents 12 at a time:
+BUCKET_PAGE_SIZE = 12
+
+# rows per page when paging through /users and /assets; the
+# service returns at most MAX_PAGE_SIZE rows per page:
+DEFAULT_PAGE_SIZE = 1000
+MAX_PAGE_SIZE = 10000
+
+# bytes of a streamed response read at a time:
+STREAM_CHUNK_SIZE = 64 * 1024
+
+# how images are moved, see configure_transfer:
+TRANSFER_MODES = ('auto', 'binary', 'json')
+DEFAULT_TRANSFER = 'auto'
+
+# the download metadata sent as headers in binary mode:
+USER_ID_HEADER = 'X-PhotoApp-User-Id'
+ASSET_NAME_HEADER = 'X-PhotoApp-Asset-Name'
+BUCKET_KEY_HEADER = 'X-PhotoApp-Bucket-Key'
+
+# chunked uploads, see upload_chunked:
+DEFAULT_CHUNKED_UPLOAD_MB = 32
+DEFAULT_UPLOAD_CHUNK_MB = 8
+CHUNK_SHA256_HEADER = 'X-PhotoApp-Chunk-SHA256'
+
+# times a chunked upload asks the service how far it got and
+# resumes, without making progress, before giving up:
+MAX_UPLOAD_RESUMES = 5
+
+# seconds to wait before resuming when the service is still busy
+# with the previous chunk:
+RESUME_DELAY = 0.5
+
+
+###################################################################
+#
+# classes
+#
+class User(Record):
+  __slots__ = ('userid', 'email', 'lastname', 'firstname', 'bucketfolder')
+
+  userid: int  # these must match columns from DB table
+  email: str
+  lastname: str
+  firstname: str
+  bucketfolder: str
+
+
+class Asset(Record):
+  __slots__ = ('assetid', 'userid', 'assetname', 'bucketkey')
+
+  assetid: int  # these must match columns from DB table
+  userid: int
+  assetname: str
+  bucketkey: str
+
+
+class BucketItem(Record):
+  __slots__ = ('Key', 'LastModified', 'ETag', 'Size', 'StorageClass')
+
+  Key: str
+  LastModified: str
+  ETag: str
+  Size: int
+  StorageClass: str
+
+
+class ApiError(Exception):
+  """
+  The web service responded, but not with status code 200. For
+  400 and 500 the service also sends an error message.
+  """
+
+  def __init__(self, url, status_code, message=None):
+    super().__init__(message if message else f"status code {status_code}")
+    self.url = url
+    self.status_code = status_code
+    self.message = message
+
+
+def _check(res, url):
+  """
+  Returns the JSON body of a 200 response, raises ApiError otherwise.
+  """
+
+  if res.status_code != 200:
+    message = None
+    if res.status_code in [400, 500]:  # we'll have an error message
+      try:
+        message = res.json()["message"]
+      except Exception:
+        pass
+    raise ApiError(url, res.status_code, message)
+
+  return res.json()
+
+
+###################################################################
+#
+# GET /stats
+#
+def get_stats(baseurl):
+  """
+  Returns bucket status and # of users and assets in the database.
+
+  Parameters
+  ----------
+  baseurl: baseurl for web service
+
+  Returns
+  -------
+  dict with keys message, s3_status, db_numUsers, db_numAssets
+  """
+
+  url = baseurl + '/stats'
+
+  return _check(web_service_get(url), url)
+
+
+###################################################################
+#
+# GET /users
+#
+def get_users(baseurl, columnar=False):
+  """
+  Returns all the users in the database.
+
+  Parameters
+  ----------
+  baseurl: baseurl for web service
+  columnar: True to return a RecordColumns, which takes far less
+            memory for large listings
+
+  Returns
+  -------
+  list of User objects, or RecordColumns of User
+  """
+
+  url = baseurl + '/users'
+  body = _check(web_service_get(url), url)
+
+  if columnar:
+    return RecordColumns(User, body["data"])
+
+  return decode_rows(User, body["data"])
+
+
+###################################################################
+#
+# GET /assets
+#
+def get_assets(baseurl, columnar=False):
+  """
+  Returns all the assets in the database.
+
+  Parameters
+  ----------
+  baseurl: baseurl for web service
+  columnar: True to return a RecordColumns, which takes far less
+            memory for large listings
+
+  Returns
+  -------
+  list of Asset objects, or RecordColumns of Asset
+  """
+
+  url = baseurl + '/assets'
+  body = _check(web_service_get(url), url)
+
+  if columnar:
+    return RecordColumns(Asset, body["data"])
+
+  return decode_rows(Asset, body["data"])
+
+
+def _iter_rows(baseurl, endpoint, cls, key, page_size):
+  """
+  Generates the rows of /users or /assets as records, a page at a
+  time (?limit=<page_size>&after=<last key>). Each page is parsed
+  as it arrives, so memory stays constant however many rows there
+  are. A service that does not page returns every row at once,
+  which is then streamed the same way.
+  """
+
+  page_size = max(1, min(page_size, MAX_PAGE_SIZE))
+  after = None
+
+  while True:
+    url = baseurl + endpoint + '?limit=' + str(page_size)
+    if after is not None:
+      url += '&after=' + str(after)
+
+    res = web_service_get(url, stream=True)
+    try:
+      if res.status_code != 200:
+        _check(res, url)
+
+      n = 0
+      chunks = res.iter_content(chunk_size=STREAM_CHUNK_SIZE)
+      for row in photoapp_stream.iter_json_array(chunks, 'data'):
+        if n == 0 and after is not None and row[key] <= after:
+          return  # the service ignored after=, we have seen it all
+        yield cls.from_row(row)
+        after = row[key]
+        n += 1
+    finally:
+      res.close()
+
+    if n != page_size:  # a short page, or every row at once
+      return
+
+
+def iter_users(baseurl, page_size=DEFAULT_PAGE_SIZE):
+  """
+  Generates all the users in the database, in userid order,
+  fetching them page_size at a time in constant memory.
+
+  Parameters
+  ----------
+  baseurl: baseurl for web service
+  page_size: # of users per call
+
+  Returns
+  -------
+  generator of User objects
+  """
+
+  return _iter_rows(baseurl, '/users', User, 'userid', page_size)
+
+
+def iter_assets(baseurl, page_size=DEFAULT_PAGE_SIZE):
+  """
+  Generates all the assets in the database, in assetid order,
+  fetching them page_size at a time in constant memory.
+
+  Parameters
+  ----------
+  baseurl: baseurl for web service
+  page_size: # of assets per call
+
+  Returns
+  -------
+  generator of Asset objects
+  """
+
+  return _iter_rows(baseurl, '/assets', Asset, 'assetid', page_size)
+
+
+###################################################################
+#
+# image transfer mode
+#
+_transfer = DEFAULT_TRANSFER
+_chunked_min_bytes = DEFAULT_CHUNKED_UPLOAD_MB * 1024 * 1024
+_chunk_size = DEFAULT_UPLOAD_CHUNK_MB * 1024 * 1024
+_service_transfers = {}  # baseurl => transfer modes the service supports
+_transfer_lock = threading.Lock()
+
+
+def configure_transfer(configur=None):
+  """
+  Sets how images are moved, from the [client] section of the
+  config (transfer):
+
+    json    base64 inside JSON, the original contract
+    binary  raw application/octet-stream bodies, no base64
+    auto    binary if the service supports it, else json (default)
+
+  and which uploads are sent in resumable chunks, if the service
+  supports it and transfer is not json (see upload_chunked):
+
+    chunked_upload_mb = 32   files at least this large, 0 = none
+    upload_chunk_mb = 8      size of a chunk; the service may ask
+                             for larger ones
+
+  Parameters
+  ----------
+  configur: ConfigParser with the client config, or None for defaults
+
+  Returns
+  -------
+  nothing
+  """
+
+  global _transfer, _chunked_min_bytes, _chunk_size
+
+  if configur is None:
+    configur = ConfigParser()
+
+  transfer = configur.get('client', 'transfer', fallback=DEFAULT_TRANSFER)
+  if transfer not in TRANSFER_MODES:
+    raise ValueError(f"transfer must be one of {', '.join(TRANSFER_MODES)}, not '{transfer}'")
+
+  chunked_mb = configur.getfloat('client', 'chunked_upload_mb', fallback=DEFAULT_CHUNKED_UPLOAD_MB)
+  chunk_mb = configur.getfloat('client', 'upload_chunk_mb', fallback=DEFAULT_UPLOAD_CHUNK_MB)
+  if chunk_mb <= 0:
+    raise ValueError(f"upload_chunk_mb must be > 0, not {chunk_mb}")
+
+  with _transfer_lock:
+    _transfer = transfer
+    _chunked_min_bytes = int(chunked_mb * 1024 * 1024)
+    _chunk_size = max(1, int(chunk_mb * 1024 * 1024))
+    _service_transfers.clear()
+
+
+def service_transfers(baseurl):
+  """
+  The ways of moving images the service supports: 'json', and
+  'binary' and 'chunked' if it lists them under "transfer" at
+  GET /. Asked once, and remembered for the base URL.
+  """
+
+  with _transfer_lock:
+    if baseurl in _service_transfers:
+      return _service_transfers[baseurl]
+
+  try:
+    res = web_service_get(baseurl + '/')
+    transfers = tuple(res.json().get('transfer', ['json'])) if res.status_code == 200 else ('json',)
+  except Exception:
+    transfers = ('json',)
+
+  with _transfer_lock:
+    return _service_transfers.setdefault(baseurl, transfers)
+
+
+def binary_supported(baseurl):
+  """
+  True if the service takes binary uploads; see service_transfers.
+  """
+
+  return 'binary' in service_transfers(baseurl)
+
+
+###################################################################
+#
+# GET /image/:assetid
+#
+def _bucket_key(baseurl, assetid):
+  """
+  Returns the bucket key of an asset, or None if there is no such
+  asset. Asks for the one row of /assets starting at the asset,
+  which once seen is revalidated with an ETag (see photoapp_web).
+  """
+
+  try:
+    assetid = int(assetid)
+  except ValueError:
+    return None
+
+  url = baseurl + '/assets?limit=1&after=' + str(assetid - 1)
+  res = web_service_get(url)
+  if res.status_code != 200:
+    return None
+
+  #
+  # a service that does not page returns every asset:
+  #
+  for row in res.json()['data']:
+    if row['assetid'] == assetid:
+      return row['bucketkey']
+  return None
+
+
+def download_image(baseurl, assetid, filename=None, bucketkey=None, use_cache=True):
+  """
+  Downloads an asset (image) and writes it to a local file. The
+  local download cache (see photoapp_cache) is consulted first,
+  and downloads are added to it. The response is streamed: the
+  image (raw bytes if the service supports binary transfer, else
+  base64 data decoded on the fly) is written to a temporary file
+  as it arrives, which is then renamed to filename, so memory use
+  does not grow with the size of the image.
+
+  Parameters
+  ----------
+  baseurl: baseurl for web service
+  assetid: asset to download
+  filename: local file to write, defaults to the asset's name
+  bucketkey: the asset's bucket key if known; otherwise it is
+             looked up to validate the download cache
+  use_cache: False to bypass the download cache
+
+  Returns
+  -------
+  dict with keys asset_id, user_id, asset_name, bucket_key,
+  filename, size (# of bytes written), sha256 (hex digest of
+  the bytes written), cached (True if served from the cache) and,
+  if downloaded, transfer ('binary' or 'json', see
+  configure_transfer)
+  """
+
+  cache = photoapp_cache.get_download_cache() if use_cache else None
+  if cache is not None and bucketkey is None:
+    bucketkey = _bucket_key(baseurl, assetid)
+    if bucketkey is None:
+      cache = None  # no such asset: let the service answer
+  if cache is not None:
+    result = cache.fetch(baseurl, assetid, bucketkey, filename)
+    if result is not None:
+      return result
+
+  #
+  # in binary mode, ask for the raw bytes; a service that does
+  # not support them ignores the Accept header and sends JSON:
+  #
+  headers = None
+  if _transfer != 'json':
+    headers = {'Accept': 'application/octet-stream, application/json;q=0.5'}
+
+  url = baseurl + '/image/' + str(assetid)
+  res = web_service_get(url, stream=True, headers=headers)
+
+  with res:
+    if res.status_code != 200:
+      _check(res, url)
+
+    binary = res.headers.get('Content-Type', '').startswith('application/octet-stream')
+
+    #
+    # write the binary data to a file (as a binary file, not
+    # a text file) while it is being decoded:
+    #
+    directory = pathlib.Path(filename).parent if filename is not None else pathlib.Path('.')
+    tmp = tempfile.NamedTemporaryFile(dir=directory, prefix='.download-', suffix='.part', delete=False)
+    try:
+      with tmp:
+        chunks = res.iter_content(chunk_size=photoapp_stream.DECODE_CHUNK_SIZE)
+        if binary:
+          size, sha256 = photoapp_stream.copy_streaming(chunks, tmp)
+          body = {
+            'user_id': int(res.headers[USER_ID_HEADER]),
+            'asset_name': urllib.parse.unquote(res.headers[ASSET_NAME_HEADER]),
+            'bucket_key': urllib.parse.unquote(res.headers[BUCKET_KEY_HEADER])
+          }
+        else:
+          body, size, sha256 = photoapp_stream.read_json_streaming(chunks, 'data', tmp)
+
+      if filename is None:
+        filename = body['asset_name']
+
+      result = {
+        "asset_id": int(assetid),
+        "user_id": body['user_id'],
+        "asset_name": body['asset_name'],
+        "bucket_key": body['bucket_key'],
+        "filename": str(filename),
+        "size": size,
+        "sha256": sha256,
+        "cached": False,
+        "transfer": 'binary' if binary else 'json'
+      }
+
+      if cache is not None:
+        cache.add(baseurl, result, tmp.name)
+
+      os.replace(tmp.name, filename)
+    except BaseException:
+      pathlib.Path(tmp.name).unlink(missing_ok=True)
+      raise
+
+  return result
+
+
+###################################################################
+#
+# GET /bucket?startafter=bucketkey
+#
+def get_bucket_page(baseurl, startafter=None, prefix=None):
+  """
+  Returns one page (the service returns 12 at a time) of the S3
+  bucket contents, starting after the given bucket key.
+
+  Parameters
+  ----------
+  baseurl: baseurl for web service
+  startafter: last bucket key of the previous page, or None
+  prefix: only keys starting with this, e.g. a user's bucket
+          folder; a service that ignores it returns all keys
+
+  Returns
+  -------
+  list of BucketItem objects, empty when there are no more
+  """
+
+  params = {}
+  if startafter:
+    params["startafter"] = startafter
+  if prefix:
+    params["prefix"] = prefix
+
+  url = baseurl + '/bucket'
+  if params:
+    url += "?" + urllib.parse.urlencode(params, quote_via=urllib.parse.quote)
+
+  body = _check(web_service_get(url), url)
+
+  return decode_rows(BucketItem, body["data"])
+
+
+_DONE = object()  # marks the end of the pages in iter_bucket_pages
+
+
+def iter_bucket_pages(baseurl, startafter=None, prefix=None, prefetch=1):
+  """
+  Generates the pages of the bucket contents, following startafter
+  from page to page. A background thread fetches up to `prefetch`
+  pages ahead of the page being consumed; closing the generator
+  (or stopping to iterate it) cancels the fetching.
+
+  Parameters
+  ----------
+  baseurl: baseurl for web service
+  startafter: bucket key to start after, or None for the start
+  prefix: only keys starting with this; also filtered here, since
+          the service may ignore it, and listing stops at the
+          first key past the prefix (keys come in sorted order)
+  prefetch: # of pages fetched ahead, 0 to fetch on demand
+
+  Returns
+  -------
+  generator of lists of BucketItem objects (never empty)
+  """
+
+  def fetch(lastkey):
+    """
+    Returns (page, lastkey of page or None if it was the last).
+    """
+
+    page = get_bucket_page(baseurl, lastkey, prefix)
+    last = page[-1].Key if len(page) == BUCKET_PAGE_SIZE else None
+
+    if prefix:
+      matching = [item for item in page if item.Key.startswith(prefix)]
+      if page and page[-1].Key > prefix and not page[-1].Key.startswith(prefix):
+        last = None  # sorted past the prefix, nothing more to find
+      page = matching
+
+    return page, last
+
+  if prefetch <= 0:
+    lastkey = startafter
+    while True:
+      page, lastkey = fetch(lastkey)
+      if page:
+        yield page
+      if lastkey is None:
+        return
+
+  pages = queue.Queue(maxsize=prefetch)
+  cancelled = threading.Event()
+
+  def put(item):
+    while not cancelled.is_set():
+      try:
+        pages.put(item, timeout=0.1)
+        return True
+      except queue.Full:
+        continue
+    return False
+
+  def producer():
+    lastkey = startafter
+    try:
+      while not cancelled.is_set():
+        page, lastkey = fetch(lastkey)
+        if page and not put(page):
+          return
+        if lastkey is None:
+          break
+      put(_DONE)
+    except Exception as e:
+      put(e)
+
+  thread = threading.Thread(target=producer, name="bucket-prefetch", daemon=True)
+  thread.start()
+
+  try:
+    while True:
+      item = pages.get()
+      if item is _DONE:
+        return
+      if isinstance(item, Exception):
+        raise item
+      yield item
+  finally:
+    cancelled.set()
+
+
+def iter_bucket(baseurl, startafter=None, prefix=None, prefetch=1):
+  """
+  Generates the bucket contents one BucketItem at a time, in
+  constant memory; see iter_bucket_pages.
+  """
+
+  for page in iter_bucket_pages(baseurl, startafter, prefix, prefetch):
+    yield from page
+
+
+###################################################################
+#
+# POST /uploads/:userid, PUT /uploads/:uploadid
+#
+def _upload_status(baseurl, uploadid):
+  """
+  Returns how far the chunked upload got (see upload_chunked), or
+  None if the service does not know it (e.g. it restarted).
+  """
+
+  url = baseurl + '/uploads/' + uploadid
+  res = web_service_get(url)
+  if res.status_code == 404:
+    return None
+  return _check(res, url)
+
+
+def upload_chunked(baseurl, userid, local_filename, assetname, sha256=None):
+  """
+  Uploads a local file in chunks, each checked and stored by the
+  service as it arrives, so a failure costs at most one chunk. An
+  upload that did not finish (e.g. the client was interrupted)
+  is recorded in the local upload index and resumed from where the
+  service says it got the next time the same contents are uploaded
+  for the user. Chunks sent twice because a response was lost are
+  rejected by the service (409) and skipped.
+
+  Parameters
+  ----------
+  baseurl: baseurl for web service
+  userid: user who owns the new asset
+  local_filename: file to upload
+  assetname: name recorded for the asset
+  sha256: hex digest of the file, computed if not given
+
+  Returns
+  -------
+  dict with keys asset_id, upload_id, chunks (# of chunks sent)
+  and resumed_bytes (# of bytes the service had before this call)
+  """
+
+  size = os.path.getsize(local_filename)
+  if sha256 is None:
+    sha256 = photoapp_cache.file_sha256(local_filename)
+
+  index = photoapp_cache.get_upload_index()
+
+  status = None
+  uploadid = index.find_pending(baseurl, userid, sha256) if index is not None else None
+  if uploadid is not None:
+    status = _upload_status(baseurl, uploadid)
+
+  if status is None:
+    url = baseurl + '/uploads/' + str(userid)
+    data = {"assetname": assetname, "size": size, "sha256": sha256, "chunk_size": _chunk_size}
+    status = _check(web_service_post(url, data), url)
+    uploadid = status["upload_id"]
+    if index is not None:
+      index.add_pending(baseurl, userid, sha256, uploadid)
+
+  chunk_size = status["chunk_size"]
+  received = resumed = status["received"]
+  asset_id = status.get("asset_id", -1)
+  chunks = 0
+  stalls = 0
+
+  with open(local_filename, 'rb') as infile:
+    while received < size and asset_id == -1:
+      infile.seek(received)
+      chunk = infile.read(chunk_size)
+      headers = {'Content-Type': 'application/octet-stream',
+                 CHUNK_SHA256_HEADER: hashlib.sha256(chunk).hexdigest()}
+
+      url = baseurl + '/uploads/' + uploadid + '?offset=' + str(received)
+      try:
+        res = web_service_put(url, io.BytesIO(chunk), headers)
+      except WebServiceError:
+        res = None
+
+      if res is not None and res.status_code == 200:
+        received = res.json()["received"]
+        chunks += 1
+        stalls = 0
+        continue
+
+      if res is not None and res.status_code != 409:
+        _check(res, url)
+
+      #
+      # no response, or the service expected another offset (this
+      # chunk arrived before, or another is being stored): resume
+      # from what the service has:
+      #
+      stalls += 1
+      if stalls > MAX_UPLOAD_RESUMES:
+        raise WebServiceError(f"chunked upload {uploadid} made no progress after {MAX_UPLOAD_RESUMES} resumes")
+
+      time.sleep(RESUME_DELAY)
+
+      status = _upload_status(baseurl, uploadid)
+      if status is None:
+        raise ApiError(url, 404, "upload no longer known to the service")
+      if status["received"] > received:
+        stalls = 0
+      received = status["received"]
+      asset_id = status["asset_id"]
+
+  if asset_id == -1:
+    url = baseurl + '/uploads/' + uploadid + '/complete'
+    try:
+      asset_id = _check(web_service_post(url, {}), url)["asset_id"]
+    except WebServiceError:
+      #
+      # completing is not retried when the response is lost, since
+      # the service may have completed it; ask, and complete again
+      # if not (the service returns the same asset if it had):
+      #
+      status = _upload_status(baseurl, uploadid)
+      asset_id = status["asset_id"] if status is not None else -1
+      if asset_id == -1:
+        asset_id = _check(web_service_post(url, {}), url)["asset_id"]
+
+  if index is not None:
+    index.remove_pending(baseurl, userid, sha256)
+
+  return {"asset_id": asset_id, "upload_id": uploadid, "chunks": chunks, "resumed_bytes": resumed}
+
+
+###################################################################
+#
+# POST /image/:userid
+#
+def upload_image(baseurl, userid, local_filename, assetname=None, force=False,
+                 transform=None):
+  """
+  Uploads a local file (image) to the user's folder in the bucket.
+  Unless forced, a file whose contents the user has uploaded
+  before (according to the local upload index, see photoapp_cache)
+  is not sent again; the earlier asset is returned instead. If an
+  image transform is enabled (see photoapp_transform), a scaled
+  down / recompressed copy is sent instead of the file itself.
+
+  Parameters
+  ----------
+  baseurl: baseurl for web service
+  userid: user who owns the new asset
+  local_filename: file to upload
+  assetname: name recorded for the asset, defaults to local_filename
+  force: upload even if the contents were uploaded before
+  transform: ImageTransform applied before sending, default is the
+             configured one
+
+  Returns
+  -------
+  dict with keys asset_id, size, sha256, duplicate (True if nothing
+  was sent since asset_id already has these contents), sent_bytes
+  (size of the file actually sent), transform_seconds and, if
+  sent, transfer ('binary', 'json' or 'chunked', see
+  configure_transfer) and, if chunked, resumed_bytes
+  """
+
+  if assetname is None:
+    assetname = str(local_filename)
+
+  index = photoapp_cache.get_upload_index()
+  size = os.path.getsize(local_filename)
+  sha256 = photoapp_cache.file_sha256(local_filename) if index is not None else None
+
+  result = {"asset_id": None, "size": size, "sha256": sha256, "duplicate": False,
+            "sent_bytes": 0, "transform_seconds": 0.0}
+
+  if index is not None and not force:
+    asset_id = index.find(baseurl, userid, sha256)
+    if asset_id is not None:
+      result["asset_id"] = asset_id
+      result["duplicate"] = True
+      return result
+
+  if transform is None:
+    transform = photoapp_transform.get_upload_transform()
+
+  with tempfile.TemporaryDirectory(prefix='photoapp-upload-') as tmpdir:
+    #
+    # the upload index records the original contents, so the
+    # transformed copy is only made once the file is to be sent:
+    #
+    send_filename = local_filename
+    if transform.enabled:
+      transformed = os.path.join(tmpdir, os.path.basename(local_filename))
+      stats = transform.apply(local_filename, transformed)
+      result["transform_seconds"] = round(stats["seconds"], 4)
+      if stats["transformed"]:
+        send_filename = transformed
+
+    result["sent_bytes"] = os.path.getsize(send_filename)
+
+    binary = _transfer == 'binary' or (_transfer == 'auto' and binary_supported(baseurl))
+
+    chunked = (binary and 0 < _chunked_min_bytes <= result["sent_bytes"]
+               and 'chunked' in service_transfers(baseurl))
+
+    url = baseurl + '/image/' + str(userid)
+
+    if chunked:
+      #
+      # large files go in resumable chunks; the service checks them
+      # against the digest of what is sent, the transformed copy if any:
+      #
+      send_sha256 = sha256 if send_filename == local_filename else None
+      uploaded = upload_chunked(baseurl, userid, send_filename, assetname, send_sha256)
+      body = {"asset_id": uploaded["asset_id"]}
+      result["resumed_bytes"] = uploaded["resumed_bytes"]
+    elif binary:
+      #
+      # the file itself is the body, and the asset name a parameter:
+      #
+      url += '?' + urllib.parse.urlencode({'assetname': assetname})
+      with open(send_filename, 'rb') as data:
+        body = _check(web_service_post(url, data, {'Content-Type': 'application/octet-stream'}), url)
+    else:
+      #
+      # the image is sent base64-encoded inside JSON. Rather than
+      # encoding the whole file in memory, the body is a stream that
+      # encodes the file chunk by chunk as it is sent:
+      #
+      data = photoapp_stream.Base64JsonBody(send_filename, {"assetname": assetname})
+      with data:
+        body = _check(web_service_post(url, data), url)
+
+    result["transfer"] = 'chunked' if chunked else 'binary' if binary else 'json'
+
+  result["asset_id"] = body["asset_id"]
+
+  if index is not None:
+    index.add(baseurl, userid, sha256, result["asset_id"], assetname, size)
+
+  return result
+
+
+###################################################################
+#
+# PUT /user
+#
+def put_user(baseurl, email, lastname, firstname, bucketfolder):
+  """
+  Inserts a new user, or updates the user with this email.
+
+  Parameters
+  ----------
+  baseurl: baseurl for web service
+  email, lastname, firstname: the user's info
+  bucketfolder: the user's (unique) folder in the bucket
+
+  Returns
+  -------
+  (user_id, message) where message is 'inserted' or 'updated'
+  """
+
+  data = {
+    "email": email,
+    "lastname": lastname,
+    "firstname": firstname,
+    "bucketfolder": bucketfolder
+  }
+
+  url = baseurl + '/user'
+  body = _check(web_service_put(url, data), url)
+
+  return body["user_id"], body["message"]
+
+
+###################################################################
+#
+# GET /labels/:assetid
+#
+def get_labels(baseurl, assetid, use_cache=True):
+  """
+  Analyzes an asset (image) with Rekognition, or returns the
+  labels found by an earlier analysis. Labels never change once
+  computed, so they are answered from the label cache (see
+  photoapp_cache) when possible. Either way the asset is added to
+  the local label index (see photoapp_index).
+
+  Parameters
+  ----------
+  baseurl: baseurl for web service
+  assetid: asset to analyze
+  use_cache: False to ask the web service (and refresh the cache)
+
+  Returns
+  -------
+  (asset_name, labels) where labels is a list of dicts with
+  keys name and confidence
+  """
+
+  cache = photoapp_cache.get_label_cache()
+  index = photoapp_index.get_label_index(baseurl)
+
+  if use_cache:
+    found = cache.get_labels(baseurl, assetid)
+    if found is not None:
+      index.add(assetid, found[1])
+      return found
+
+  url = baseurl + '/labels/' + str(assetid)
+  body = _check(web_service_get(url), url)
+
+  cache.put_labels(baseurl, assetid, body['asset_name'], body['data'])
+  index.add(assetid, body['data'])
+
+  return body['asset_name'], body['data']
+
+
+###################################################################
+#
+# GET /images/:label
+#
+def search_images(baseurl, label, use_cache=True):
+  """
+  Returns the analyzed assets that have the given label. Results
+  are reused from the label cache for up to its TTL.
+
+  Parameters
+  ----------
+  baseurl: baseurl for web service
+  label: label to search for
+  use_cache: False to ask the web service (and refresh the cache)
+
+  Returns
+  -------
+  list of dicts with keys asset_id and confidence
+  """
+
+  cache = photoapp_cache.get_label_cache()
+  if use_cache:
+    found = cache.get_search(baseurl, label)
+    if found is not None:
+      return found
+
+  url = baseurl + '/images/' + urllib.parse.quote(label, safe='')
+  body = _check(web_service_get(url), url)
+
+  cache.put_search(baseurl, label, body['data'])
+
+  return body['data']
@@ -0,0 +1,1095 @@
+#
+# photoapp_bench.py
+#
+# Micro-benchmarks for the client, run locally without a web
+# service. Each prints its results as one JSON object:
+#
+#   python photoapp_bench.py decode --rows 1000000
+#
+#     per-row decode time and memory of a listing of assets
+#     (or users, bucket items): decode_rows() records and a
+#     RecordColumns container, versus the jsons.load() the
+#     client used before, if jsons is installed.
+#
+#   python photoapp_bench.py startup --threshold-ms 100
+#
+#     import time of main.py (python -X importtime) and the wall
+#     time of `python main.py --help`, median over several runs;
+#     exits with status 1 if the import time is over the
+#     threshold, so it can guard against startup regressions.
+#
+#   python photoapp_bench.py upload photos/ --max-dimension 1600 \
+#          [-c photoapp-client-config.ini --user 80001] [--link-mbps 20]
+#
+#     bytes saved by the image transform before upload, and with a
+#     config and user, the wall time of bulk-uploading the files
+#     as they are versus transformed (uploads are forced, so the
+#     files are uploaded twice). Since a local test service hides
+#     the transfer time, the time at a given link speed is also
+#     estimated.
+#
+#   python photoapp_bench.py load -c photoapp-client-config.ini \
+#          --mix download=3,labels=2,search=2,stats=1 --concurrency 16 \
+#          --rps 50 --duration 60
+#
+#     replays a weighted mix of the client's calls (stats, users,
+#     assets, download, bucket, upload, labels, search) against the
+#     service at a given concurrency and, optionally, rate; reports
+#     calls/s, errors and p50/p95/p99 latency overall and per call.
+#     Caches are bypassed and failed calls are not retried (unless
+#     --retries), so the numbers are the service's.
+#
+#   python photoapp_bench.py transfer --size-kb 4096 --runs 5 \
+#          [-c photoapp-client-config.ini --user 80001]
+#
+#     upload and download of one image with base64 in JSON versus
+#     raw bytes (see photoapp_api.configure_transfer): median wall
+#     time and bytes on the wire of each. Without a config, runs
+#     against a local mock service (photoapp_mock).
+#
+#   python photoapp_bench.py compression --runs 5 --link-mbps 20 \
+#          [-c photoapp-client-config.ini --user 80001]
+#
+#     the listings (/users, /assets, /bucket, /images/:label) with
+#     and without compressed responses, and a JSON upload with and
+#     without a gzipped body: median time, bytes on the wire and the
+#     time estimated at a given link speed. Without a config, runs
+#     against a local mock service.
+#
+#   python photoapp_bench.py index --assets 1000000 --threshold-ms 1
+#
+#     queries of the local label index (photoapp_index) over a
+#     synthetic index of that many assets: median time to evaluate
+#     each (count of matches) and to return its ids, and the time of
+#     the first evaluation, which builds the label bitmaps; exits
+#     with status 1 if an evaluation is over the threshold.
+#
+# Authors:
+#
+#   Neo Trovela-Villamiel
+#
+
+import argparse
+import array
+import base64
+import gc
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+from photoapp_api import User, Asset, BucketItem
+from photoapp_records import RecordColumns, decode_rows
+
+
+###################################################################
+#
+# decode
+#
+def make_rows(kind, n):
+  """
+  Returns n rows shaped like the web service's JSON rows.
+  """
+
+  if kind == 'users':
+    return [{"userid": 80001 + i,
+             "email": f"user{i}@example.com",
+             "lastname": f"Last{i}",
+             "firstname": f"First{i}",
+             "bucketfolder": f"f1c0a3e2-{i:012d}"} for i in range(n)]
+
+  if kind == 'assets':
+    return [{"assetid": 1001 + i,
+             "userid": 80001 + i % 1000,
+             "assetname": f"photo{i}.jpg",
+             "bucketkey": f"f1c0a3e2-{i % 1000:012d}/{i:08d}.jpg"} for i in range(n)]
+
+  return [{"Key": f"f1c0a3e2-{i % 1000:012d}/{i:08d}.jpg",
+           "LastModified": "2024-03-01T12:00:00.000Z",
+           "ETag": '"9b2cf535f27731c974343645a3985328"',
+           "Size": 100000 + i,
+           "StorageClass": "STANDARD"} for i in range(n)]
+
+
+def _measure(decode, rows):
+  """
+  Returns (seconds, bytes allocated by the result) of decode(rows).
+  """
+
+  gc.collect()
+  start = time.perf_counter()
+  result = decode(rows)
+  seconds = time.perf_counter() - start
+  del result
+
+  gc.collect()
+  tracemalloc.start()
+  result = decode(rows)
+  allocated, _ = tracemalloc.get_traced_memory()
+  tracemalloc.stop()
+  del result
+
+  return seconds, allocated
+
+
+def bench_decode(kind='assets', n=1000000, jsons_sample=10000):
+  """
+  Benchmarks decoding n rows of the given kind.
+
+  Parameters
+  ----------
+  kind: 'users', 'assets' or 'bucket'
+  n: # of rows
+  jsons_sample: # of rows decoded with jsons.load, which is too
+                slow to run on all of them; 0 to skip
+
+  Returns
+  -------
+  dict with, per decoder, ns per row and bytes per row
+  """
+
+  cls = {'users': User, 'assets': Asset, 'bucket': BucketItem}[kind]
+  rows = make_rows(kind, n)
+
+  decoders = {
+    "records": lambda rows: decode_rows(cls, rows),
+    "columns": lambda rows: RecordColumns(cls, rows),
+  }
+
+  result = {"kind": kind, "rows": n}
+
+  for name, decode in decoders.items():
+    seconds, allocated = _measure(decode, rows)
+    result[name] = {
+      "seconds": round(seconds, 3),
+      "ns_per_row": round(seconds / n * 1e9, 1),
+      "bytes_per_row": round(allocated / n, 1),
+      "total_mb": round(allocated / 1e6, 1)
+    }
+
+  if jsons_sample > 0:
+    try:
+      import jsons
+    except ImportError:
+      result["jsons"] = "jsons is not installed"
+    else:
+      #
+      # jsons.load needs a plain annotated class, as before:
+      #
+      plain = type(cls.__name__, (), {"__annotations__": dict(cls.__annotations__)})
+      sample = rows[:jsons_sample]
+      seconds, allocated = _measure(lambda rows: [jsons.load(row, plain) for row in rows], sample)
+      result["jsons"] = {
+        "sample_rows": len(sample),
+        "ns_per_row": round(seconds / len(sample) * 1e9, 1),
+        "bytes_per_row": round(allocated / len(sample), 1),
+        "est_seconds_all_rows": round(seconds / len(sample) * n, 1)
+      }
+
+  return result
+
+
+###################################################################
+#
+# startup
+#
+DEFAULT_STARTUP_THRESHOLD_MS = 100.0
+
+
+def _import_times(module):
+  """
+  Imports module in a fresh interpreter with -X importtime and
+  returns (site us, {module imported by it: (self us, cumulative us)}).
+  """
+
+  here = os.path.dirname(os.path.abspath(__file__))
+  proc = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+                        cwd=here, capture_output=True, text=True, check=True)
+
+  site_us = 0
+  times = {}
+  for line in proc.stderr.splitlines():
+    if not line.startswith('import time:') or 'self [us]' in line:
+      continue
+    self_us, cumulative_us, name = line[len('import time:'):].split('|')
+    if name.strip() == 'site':
+      # what the interpreter imports at startup is listed before
+      # site, and is not the client's doing:
+      site_us = int(cumulative_us)
+      times = {}
+      continue
+    times[name.strip()] = (int(self_us), int(cumulative_us))
+
+  return site_us, times
+
+
+def bench_startup(module='main', runs=10, top=10):
+  """
+  Measures the startup cost of the client.
+
+  Parameters
+  ----------
+  module: module whose import is timed
+  runs: # of fresh interpreters to take the median over
+  top: # of slowest imports (cumulative) to list
+
+  Returns
+  -------
+  dict with the median import time of module, of the interpreter
+  alone (site), of `python main.py --help`, and the slowest imports
+  """
+
+  here = os.path.dirname(os.path.abspath(__file__))
+  imports = []
+  site = []
+  wall = []
+  last = None
+
+  for _ in range(runs):
+    site_us, last = _import_times(module)
+    imports.append(last[module][1] / 1000)
+    site.append(site_us / 1000)
+
+    start = time.perf_counter()
+    subprocess.run([sys.executable, 'main.py', '--help'], cwd=here,
+                   stdout=subprocess.DEVNULL, check=True)
+    wall.append((time.perf_counter() - start) * 1000)
+
+  slowest = sorted(((us / 1000, name) for name, (_, us) in last.items()
+                    if name != module), reverse=True)[:top]
+
+  return {
+    "module": module,
+    "runs": runs,
+    "import_ms": round(statistics.median(imports), 1),
+    "interpreter_site_ms": round(statistics.median(site), 1),
+    "help_wall_ms": round(statistics.median(wall), 1),
+    "slowest_imports_ms": [[name, round(ms, 1)] for ms, name in slowest]
+  }
+
+
+###################################################################
+#
+# upload
+#
+DEFAULT_LINK_MBPS = 20.0
+
+
+def _wire_seconds(nbytes, link_mbps):
+  """
+  Seconds to send nbytes of file base64-encoded over a link.
+  """
+  return (nbytes + 2) // 3 * 4 * 8 / (link_mbps * 1e6)
+
+
+def bench_upload(sources, transform, config_file=None, userid=None,
+                 workers=8, link_mbps=DEFAULT_LINK_MBPS):
+  """
+  Measures what an image transform saves on upload.
+
+  Parameters
+  ----------
+  sources: directories, files or glob patterns of images
+  transform: the enabled photoapp_transform.ImageTransform
+  config_file: client config of the service to upload to, None to
+               only transform the files
+  userid: user who owns the uploaded assets
+  workers: # of uploads in parallel
+  link_mbps: link speed for the estimated upload times
+
+  Returns
+  -------
+  dict with the bytes before and after the transform, the transform
+  time, and if uploading, the upload time without and with it
+  """
+
+  import photoapp_bulk
+  import photoapp_transform
+
+  files = list(photoapp_bulk.find_files(sources))
+  processes = min(workers, os.cpu_count() or 1)
+
+  result = {"files": len(files), "transform": transform.settings(),
+            "processes": processes, "link_mbps": link_mbps}
+
+  if config_file is None:
+    with tempfile.TemporaryDirectory() as tmpdir, \
+         photoapp_transform.process_pool(workers) as pool:
+      start = time.perf_counter()
+      stats = list(pool.map(transform_image_to, [tmpdir] * len(files), files,
+                            [transform] * len(files)))
+      seconds = time.perf_counter() - start
+
+    original = sum(s["original_bytes"] for s in stats)
+    sent = sum(s["bytes"] for s in stats)
+    result["original_bytes"] = original
+    result["sent_bytes"] = sent
+    result["bytes_saved"] = original - sent
+    result["transform_wall_seconds"] = round(seconds, 3)
+
+  else:
+    from photoapp_client import read_config, configure
+
+    configur, baseurl = read_config(config_file)
+    configure(configur)
+
+    runs = {}
+    for name, t in [("original", photoapp_transform.ImageTransform()), ("transformed", transform)]:
+      with tempfile.TemporaryDirectory() as tmpdir:
+        run = photoapp_bulk.bulk_upload(baseurl, userid, sources, workers=workers,
+                                        manifest=os.path.join(tmpdir, 'manifest.jsonl'),
+                                        force=True, transform=t, out=None)
+      if run["failed"]:
+        raise RuntimeError(f"{run['failed']} uploads failed, e.g. {run['failures'][0]}")
+      runs[name] = run
+
+    original = runs["original"]["bytes"]
+    sent = runs["transformed"]["bytes"]
+    result["original_bytes"] = original
+    result["sent_bytes"] = sent
+    result["bytes_saved"] = original - sent
+    result["upload_seconds"] = runs["original"]["seconds"]
+    result["transformed_upload_seconds"] = runs["transformed"]["seconds"]
+    result["transform_cpu_seconds"] = runs["transformed"]["transform_seconds"]
+    result["speedup"] = round(runs["original"]["seconds"] / max(runs["transformed"]["seconds"], 1e-9), 2)
+    seconds = runs["transformed"]["transform_seconds"] / processes
+
+  #
+  # estimate: the transfer at link speed, plus (for the transformed
+  # files) the transform time spread over the processes:
+  #
+  estimate = _wire_seconds(original, link_mbps)
+  estimate_transformed = _wire_seconds(sent, link_mbps) + seconds
+  result["est_upload_seconds"] = round(estimate, 2)
+  result["est_transformed_upload_seconds"] = round(estimate_transformed, 2)
+  result["est_speedup"] = round(estimate / max(estimate_transformed, 1e-9), 2)
+
+  return result
+
+
+def transform_image_to(tmpdir, file, transform):
+  """
+  Transforms file into tmpdir, returning transform_image's stats.
+  """
+
+  import photoapp_transform
+
+  dst = os.path.join(tmpdir, f"{os.getpid()}-{file.name}")
+  stats = photoapp_transform.transform_image(str(file), dst, transform.max_dimension,
+                                             transform.quality, transform.strip_exif)
+  if stats["transformed"]:
+    os.remove(dst)
+  return stats
+
+
+###################################################################
+#
+# load
+#
+LOAD_OPERATIONS = ('stats', 'users', 'assets', 'download', 'bucket', 'upload', 'labels', 'search')
+
+DEFAULT_LOAD_MIX = 'stats=1,users=1,assets=1,download=3,bucket=2,labels=2,search=2'
+DEFAULT_SEARCH_LABELS = 'dog,cat,person'
+
+
+def parse_mix(text):
+  """
+  Parses an operation mix such as 'download=3,labels=1,stats' (an
+  operation without a weight has weight 1) into {operation: weight}.
+  """
+
+  mix = {}
+  for part in text.split(','):
+    name, _, weight = part.strip().partition('=')
+    if name not in LOAD_OPERATIONS:
+      raise ValueError(f"unknown operation '{name}' in mix, expected one of {', '.join(LOAD_OPERATIONS)}")
+    mix[name] = float(weight) if weight else 1.0
+    if mix[name] < 0:
+      raise ValueError(f"weight of '{name}' must be >= 0")
+
+  mix = {name: weight for name, weight in mix.items() if weight > 0}
+  if not mix:
+    raise ValueError("the mix has no operation with a weight > 0")
+  return mix
+
+
+class LoadTarget:
+  """
+  The calls of the load test: one per operation, each making the
+  same photoapp_api call the client makes, with the caches bypassed
+  so every call reaches the service.
+  """
+
+  def __init__(self, baseurl, mix, tmpdir, userid=None, upload_file=None,
+               search_labels=DEFAULT_SEARCH_LABELS):
+    import photoapp_api
+    import photoapp_transform
+
+    self.api = photoapp_api
+    self.baseurl = baseurl
+    self.tmpdir = tmpdir
+    self.userid = userid
+    self.upload_file = upload_file
+    self.no_transform = photoapp_transform.ImageTransform()
+    self.search_labels = [label.strip() for label in search_labels.split(',') if label.strip()]
+    self.assetids = []
+    self.bucketkeys = [None]
+
+    if 'upload' in mix and (userid is None or upload_file is None):
+      raise ValueError("the upload operation needs --user and --upload-file")
+    if 'search' in mix and not self.search_labels:
+      raise ValueError("the search operation needs --search-labels")
+
+    if {'download', 'labels', 'bucket'} & set(mix):
+      assets = photoapp_api.get_assets(baseurl)
+      self.assetids = [asset.assetid for asset in assets]
+      self.bucketkeys += [asset.bucketkey for asset in assets]
+      if not self.assetids and {'download', 'labels'} & set(mix):
+        raise ValueError("the service has no assets to download or analyze")
+
+  def call(self, operation, rng):
+    api = self.api
+
+    if operation == 'stats':
+      api.get_stats(self.baseurl)
+    elif operation == 'users':
+      api.get_users(self.baseurl)
+    elif operation == 'assets':
+      api.get_assets(self.baseurl)
+    elif operation == 'download':
+      filename = os.path.join(self.tmpdir, f"download-{threading.get_ident()}")
+      api.download_image(self.baseurl, rng.choice(self.assetids), filename, use_cache=False)
+    elif operation == 'bucket':
+      api.get_bucket_page(self.baseurl, rng.choice(self.bucketkeys))
+    elif operation == 'upload':
+      api.upload_image(self.baseurl, self.userid, self.upload_file, force=True,
+                       transform=self.no_transform)
+    elif operation == 'labels':
+      api.get_labels(self.baseurl, rng.choice(self.assetids), use_cache=False)
+    elif operation == 'search':
+      api.search_images(self.baseurl, rng.choice(self.search_labels), use_cache=False)
+
+
+def bench_load(target, mix, concurrency=8, rps=0, duration=30.0, requests=None,
+               warmup=0.0, seed=None):
+  """
+  Replays a weighted mix of operations against the service from
+  `concurrency` threads, optionally paced to a total of `rps` calls
+  per second. Each thread waits for its call to finish before
+  starting the next (a closed loop), so if the service cannot keep
+  up, fewer calls than `rps` are made and the shortfall shows in
+  the throughput rather than in the latencies.
+
+  Parameters
+  ----------
+  target: LoadTarget making the calls
+  mix: {operation: weight}, see parse_mix
+  concurrency: # of calls in flight
+  rps: target calls per second, 0 = as fast as possible
+  duration: seconds to run (after the warmup)
+  requests: stop after this many calls instead, if not None
+  warmup: seconds of calls made first and not counted
+  seed: seed of the random choice of operations and arguments
+
+  Returns
+  -------
+  dict with the overall throughput and latencies, and per operation
+  the count, errors, calls/s and p50/p95/p99 latencies
+  """
+
+  import random
+  import photoapp_bulk
+
+  operations = list(mix)
+  weights = [mix[op] for op in operations]
+  limiter = photoapp_bulk.RateLimiter(rps, burst=max(1, concurrency))
+
+  lock = threading.Lock()
+  issued = 0
+  start = time.monotonic()
+  measure_from = start + warmup
+  stop_at = None if requests is not None else measure_from + duration
+
+  def worker(n):
+    nonlocal issued
+    rng = random.Random(None if seed is None else seed + n)
+    latencies = {op: [] for op in operations}
+    errors = {op: [] for op in operations}
+
+    while True:
+      limiter.acquire()
+      began = time.monotonic()
+
+      if stop_at is not None and began >= stop_at:
+        break
+      if requests is not None and began >= measure_from:
+        with lock:
+          if issued >= requests:
+            break
+          issued += 1
+
+      op = rng.choices(operations, weights)[0]
+      try:
+        target.call(op, rng)
+        error = None
+      except Exception as e:
+        error = f"{type(e).__name__}: {e}"
+      latency = time.monotonic() - began
+
+      if began >= measure_from:
+        if error is None:
+          latencies[op].append(latency)
+        else:
+          errors[op].append(error)
+
+    return latencies, errors
+
+  threads = []
+  results = [None] * concurrency
+  for n in range(concurrency):
+    thread = threading.Thread(target=lambda n=n: results.__setitem__(n, worker(n)),
+                              name=f"load-{n}", daemon=True)
+    thread.start()
+    threads.append(thread)
+  for thread in threads:
+    thread.join()
+
+  seconds = max(time.monotonic() - measure_from, 1e-9)
+
+  per_op = {}
+  all_latencies = []
+  total_errors = 0
+  for op in operations:
+    latencies = [x for r in results for x in r[0][op]]
+    errors = [x for r in results for x in r[1][op]]
+    all_latencies += latencies
+    total_errors += len(errors)
+
+    summary = photoapp_bulk.latency_summary(latencies) or {"count": 0}
+    summary["errors"] = len(errors)
+    summary["calls_per_sec"] = round((len(latencies) + len(errors)) / seconds, 2)
+    if errors:
+      summary["error_sample"] = errors[0]
+    per_op[op] = summary
+
+  return {
+    "concurrency": concurrency,
+    "target_rps": rps,
+    "seconds": round(seconds, 3),
+    "calls": len(all_latencies) + total_errors,
+    "errors": total_errors,
+    "calls_per_sec": round((len(all_latencies) + total_errors) / seconds, 2),
+    "latency": photoapp_bulk.latency_summary(all_latencies),
+    "operations": per_op
+  }
+
+
+def load_configure(config_file, retries=False):
+  """
+  Reads the client config and configures the client for a load
+  test: unless retries is True, failed calls are not retried and
+  the circuit breaker never opens, so every call reaches the
+  service and every failure is counted. GETs are not made
+  conditional (http_cache_mb = 0), so they are not answered with
+  304s. The pool holds enough connections for the load's threads.
+
+  Returns
+  -------
+  baseurl of the service
+  """
+
+  import copy
+  from photoapp_client import read_config, configure
+
+  configur, baseurl = read_config(config_file)
+  configur = copy.deepcopy(configur)  # read_config's result is cached
+
+  configur.set('client', 'http_cache_mb', '0')
+
+  if not retries:
+    configur.set('client', 'max_attempts', '1')
+    configur.set('client', 'circuit_threshold', str(2 ** 31))
+
+  configure(configur)
+  return baseurl
+
+
+###################################################################
+#
+# transfer
+#
+def bench_transfer(baseurl, userid, size=4 * 1024 * 1024, runs=5, modes=('json', 'binary')):
+  """
+  Times uploading and downloading one image in each transfer mode.
+  The client must already be configured for baseurl.
+
+  Parameters
+  ----------
+  baseurl: the service
+  userid: user who owns the uploaded assets
+  size: # of bytes of the image (random, so incompressible)
+  runs: uploads and downloads per mode
+  modes: transfer modes to compare
+
+  Returns
+  -------
+  dict with, per mode, the median upload and download seconds and
+  the bytes sent and received per call, plus the speedup of the
+  last mode over the first
+  """
+
+  from configparser import ConfigParser
+  import photoapp_api
+  import photoapp_metrics
+  import photoapp_transform
+
+  metrics = photoapp_metrics.get_metrics()
+  no_transform = photoapp_transform.ImageTransform()
+
+  result = {"baseurl": baseurl, "size": size, "runs": runs}
+
+  with tempfile.TemporaryDirectory() as tmpdir:
+    image = os.path.join(tmpdir, 'image.jpg')
+    with open(image, 'wb') as outfile:
+      outfile.write(os.urandom(size))
+
+    for mode in modes:
+      configur = ConfigParser()
+      configur['client'] = {'transfer': mode}
+      photoapp_api.configure_transfer(configur)
+      metrics.reset()
+
+      uploads = []
+      downloads = []
+      for i in range(runs):
+        start = time.perf_counter()
+        up = photoapp_api.upload_image(baseurl, userid, image, f"bench-{mode}-{i}.jpg",
+                                       force=True, transform=no_transform)
+        uploads.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        down = photoapp_api.download_image(baseurl, up["asset_id"], os.path.join(tmpdir, 'download'),
+                                           use_cache=False)
+        downloads.append(time.perf_counter() - start)
+
+        if down["size"] != size:
+          raise RuntimeError(f"downloaded {down['size']} bytes of asset {up['asset_id']}, not {size}")
+
+      calls = {(c["method"], c["endpoint"]): c for c in metrics.snapshot()["calls"]}
+      sent = calls[('POST', '/image/:id')]["bytes_sent"]
+      received = calls[('GET', '/image/:id')]["bytes_received"]
+
+      result[mode] = {
+        "transfer": (up.get("transfer"), down.get("transfer")),
+        "upload_seconds": round(statistics.median(uploads), 4),
+        "download_seconds": round(statistics.median(downloads), 4),
+        "upload_bytes_per_call": sent // runs,
+        "download_bytes_per_call": received // runs,
+        "upload_mb_per_sec": round(size / statistics.median(uploads) / 1e6, 1),
+        "download_mb_per_sec": round(size / statistics.median(downloads) / 1e6, 1)
+      }
+
+  first, last = result[modes[0]], result[modes[-1]]
+  result["upload_speedup"] = round(first["upload_seconds"] / max(last["upload_seconds"], 1e-9), 2)
+  result["download_speedup"] = round(first["download_seconds"] / max(last["download_seconds"], 1e-9), 2)
+  result["wire_bytes_saved"] = round(1 - (last["upload_bytes_per_call"] + last["download_bytes_per_call"])
+                                     / max(first["upload_bytes_per_call"] + first["download_bytes_per_call"], 1), 3)
+  return result
+
+
+###################################################################
+#
+# compression
+#
+COMPRESSION_ENDPOINTS = ('/users', '/assets', '/bucket', '/images/dog')
+
+
+def bench_compression(baseurl, userid=None, runs=5, link_mbps=DEFAULT_LINK_MBPS,
+                      upload_size=1024 * 1024, endpoints=COMPRESSION_ENDPOINTS):
+  """
+  Times the listings with and without compressed responses and,
+  given a user, a JSON (base64) upload with and without a gzipped
+  body. Reconfigures the client's session, and clears the response
+  cache before every listing so each one is a full 200.
+
+  Parameters
+  ----------
+  baseurl: the service
+  userid: user who owns the uploaded image, None = no upload
+  runs: calls per endpoint and setting
+  link_mbps: link speed for the estimated times
+  upload_size: # of bytes of the uploaded image (random)
+  endpoints: paths of the listings
+
+  Returns
+  -------
+  dict with, per endpoint, the median seconds, bytes on the wire
+  per call, decoded bytes per call and estimated seconds at
+  link_mbps with compression off and on
+  """
+
+  from configparser import ConfigParser
+  import photoapp_api
+  import photoapp_cache
+  import photoapp_metrics
+  import photoapp_transform
+  import photoapp_web
+
+  metrics = photoapp_metrics.get_metrics()
+  cache = photoapp_cache.get_response_cache()
+
+  def configure_compression(compression, compress_requests):
+    configur = ConfigParser()
+    configur['client'] = {'compression': str(compression), 'compress_requests': str(compress_requests),
+                          'compress_min_bytes': '1024', 'transfer': 'json'}
+    photoapp_web.configure_session(configur)
+    photoapp_api.configure_transfer(configur)
+
+  def measure(call):
+    metrics.reset()
+    times = []
+    for i in range(runs):
+      start = time.perf_counter()
+      decoded = call()
+      times.append(time.perf_counter() - start)
+    stats = metrics.snapshot()["calls"][0]
+    seconds = statistics.median(times)
+    wire = (stats["bytes_sent"] + stats["bytes_received"]) // runs
+    return {"seconds": round(seconds, 4),
+            "wire_bytes": wire,
+            "decoded_bytes": decoded,
+            "est_seconds": round(seconds + wire * 8 / (link_mbps * 1e6), 4)}
+
+  def compare(results):
+    off, on = results["off"], results["on"]
+    results["ratio"] = round(off["wire_bytes"] / max(on["wire_bytes"], 1), 2)
+    results["est_speedup"] = round(off["est_seconds"] / max(on["est_seconds"], 1e-9), 2)
+    return results
+
+  result = {"baseurl": baseurl, "runs": runs, "link_mbps": link_mbps,
+            "accept_encoding": photoapp_web.accept_encoding(), "endpoints": {}}
+
+  for endpoint in endpoints:
+    url = baseurl + endpoint
+
+    def listing():
+      if cache is not None:
+        cache.clear()  # a 304 would measure revalidation, not compression
+      res = photoapp_web.web_service_get(url)
+      res.json()
+      return len(res.content)
+
+    results = {}
+    for name, compression in [("off", False), ("on", True)]:
+      configure_compression(compression, False)
+      results[name] = measure(listing)
+    result["endpoints"][endpoint] = compare(results)
+
+  if userid is not None:
+    with tempfile.TemporaryDirectory() as tmpdir:
+      image = os.path.join(tmpdir, 'image.jpg')
+      with open(image, 'wb') as outfile:
+        outfile.write(os.urandom(upload_size))
+      no_transform = photoapp_transform.ImageTransform()
+
+      def upload():
+        photoapp_api.upload_image(baseurl, userid, image, force=True, transform=no_transform)
+        return 4 * ((upload_size + 2) // 3)
+
+      results = {}
+      for name, compress_requests in [("off", False), ("on", True)]:
+        configure_compression(True, compress_requests)
+        results[name] = measure(upload)
+      result["json_upload"] = compare(results)
+
+  photoapp_web.configure_session()
+  return result
+
+
+###################################################################
+#
+# index
+#
+# (label, fraction of assets having it) of the synthetic index; the
+# other labels each go to about 1% of the assets:
+INDEX_LABELS = [("Outdoors", 0.5), ("Person", 0.35), ("Dog", 0.06), ("Cat", 0.05),
+                ("Beach", 0.03), ("Ocean", 0.03), ("Golden Retriever", 0.01)]
+INDEX_OTHER_LABELS = 200
+
+DEFAULT_INDEX_QUERIES = ['dog', 'dog AND NOT cat', '(beach OR ocean) AND person>=90',
+                         'NOT cat', 'golden*', 'person']
+
+DEFAULT_INDEX_THRESHOLD_MS = 1.0
+
+
+def make_label_index(n, seed=0):
+  """
+  Returns a LabelIndex of n analyzed assets (ids 1001, 1002, ...)
+  with the labels of INDEX_LABELS plus INDEX_OTHER_LABELS rare
+  ones, at confidences 55..100, as if loaded from its file.
+  """
+
+  import random
+
+  from photoapp_index import LabelIndex, _BYTEORDER
+
+  rng = random.Random(seed)
+  ids = range(1001, 1001 + n)
+  confidence = bytes.maketrans(bytes(range(256)), bytes(55 + b * 46 // 256 for b in range(256)))
+
+  def encode(values):
+    return base64.b64encode(values.tobytes()).decode()
+
+  labels = {}
+  for name, fraction in INDEX_LABELS + [(f"Label{i:03d}", 0.01) for i in range(INDEX_OTHER_LABELS)]:
+    posting = array.array('i', sorted(rng.sample(ids, round(fraction * n))))
+    confidences = array.array('B', rng.randbytes(len(posting)).translate(confidence))
+    labels[name.lower()] = [name, encode(posting), encode(confidences)]
+
+  return LabelIndex.from_json({"assets": encode(array.array('i', ids)), "labels": labels},
+                              _BYTEORDER != sys.byteorder)
+
+
+def bench_index(n=1000000, queries=DEFAULT_INDEX_QUERIES, runs=20, index=None):
+  """
+  Times queries of a label index over n assets.
+
+  Parameters
+  ----------
+  n: # of assets of the synthetic index (see make_label_index)
+  queries: the queries to time
+  runs: # of repetitions to take the median over
+  index: LabelIndex to query instead of a synthetic one
+
+  Returns
+  -------
+  dict with, per query, the # of matches and the median time of
+  evaluating it (count()) and of returning its ids (query()), and
+  the time of its first evaluation, which builds the bitmaps of
+  its labels
+  """
+
+  def ms(seconds):
+    return round(seconds * 1000, 3)
+
+  start = time.perf_counter()
+  if index is None:
+    index = make_label_index(n)
+  built = time.perf_counter() - start
+
+  results = {}
+  for expression in queries:
+    start = time.perf_counter()
+    count = index.count(expression)
+    first = time.perf_counter() - start
+
+    evaluate = []
+    for _ in range(runs):
+      start = time.perf_counter()
+      index.count(expression)
+      evaluate.append(time.perf_counter() - start)
+
+    ids = []
+    for _ in range(runs):
+      start = time.perf_counter()
+      index.query(expression)
+      ids.append(time.perf_counter() - start)
+
+    results[expression] = {
+      "matches": count,
+      "first_ms": ms(first),
+      "evaluate_ms": ms(statistics.median(evaluate)),
+      "query_ms": ms(statistics.median(ids))
+    }
+
+  return {"index": index.stats(), "build_s": round(built, 2), "runs": runs, "queries": results}
+
+
+###################################################################
+#
+# main
+#
+def build_parser():
+  parser = argparse.ArgumentParser(prog='photoapp_bench.py', description="PhotoApp client benchmarks.")
+  subparsers = parser.add_subparsers(dest='command', required=True)
+
+  p = subparsers.add_parser('decode', help="per-row decode cost and memory of listings")
+  p.add_argument('--kind', choices=['users', 'assets', 'bucket'], default='assets')
+  p.add_argument('--rows', type=int, default=1000000)
+  p.add_argument('--jsons-sample', type=int, default=10000,
+                 help="rows to decode with jsons.load for comparison, 0 to skip")
+
+  p = subparsers.add_parser('startup', help="import and start-up time, with a regression threshold")
+  p.add_argument('--module', default='main')
+  p.add_argument('--runs', type=int, default=10)
+  p.add_argument('--threshold-ms', type=float, default=DEFAULT_STARTUP_THRESHOLD_MS,
+                 help="fail if the median import time is over this")
+
+  p = subparsers.add_parser('upload', help="bytes and upload time saved by the image transform")
+  p.add_argument('sources', nargs='+', help="directories, files or glob patterns of images")
+  p.add_argument('--max-dimension', type=int, default=0)
+  p.add_argument('--quality', type=int, default=0)
+  p.add_argument('--strip-exif', action='store_true')
+  p.add_argument('-c', '--config', help="client config of the service to upload to; without it, only transforms")
+  p.add_argument('--user', type=int, help="user id the files are uploaded for (with -c)")
+  p.add_argument('--workers', type=int, default=8)
+  p.add_argument('--link-mbps', type=float, default=DEFAULT_LINK_MBPS,
+                 help="link speed for the estimated upload times")
+
+  p = subparsers.add_parser('load', help="latency and throughput under a mix of client calls")
+  p.add_argument('-c', '--config', default='photoapp-client-config.ini', help="client config of the service")
+  p.add_argument('--mix', default=DEFAULT_LOAD_MIX,
+                 help=f"weighted operations, of {', '.join(LOAD_OPERATIONS)} (default: {DEFAULT_LOAD_MIX})")
+  p.add_argument('--concurrency', type=int, default=8, help="calls in flight")
+  p.add_argument('--rps', type=float, default=0, help="target calls per second, 0 = as fast as possible")
+  p.add_argument('--duration', type=float, default=30.0, help="seconds to run")
+  p.add_argument('--requests', type=int, help="stop after this many calls instead")
+  p.add_argument('--warmup', type=float, default=2.0, help="seconds of calls not counted")
+  p.add_argument('--seed', type=int)
+  p.add_argument('--user', type=int, help="user id for uploads")
+  p.add_argument('--upload-file', help="file to upload")
+  p.add_argument('--search-labels', default=DEFAULT_SEARCH_LABELS, help="labels to search for")
+  p.add_argument('--retries', action='store_true', help="retry failed calls as the client does")
+
+  p = subparsers.add_parser('transfer', help="image upload/download with base64 in JSON versus raw bytes")
+  p.add_argument('-c', '--config', help="client config of the service; without it, a local mock service")
+  p.add_argument('--user', type=int, help="user id the image is uploaded for (with -c)")
+  p.add_argument('--size-kb', type=int, default=4096, help="size of the image")
+  p.add_argument('--runs', type=int, default=5)
+
+  p = subparsers.add_parser('compression', help="listings and JSON uploads with and without compression")
+  p.add_argument('-c', '--config', help="client config of the service; without it, a local mock service")
+  p.add_argument('--user', type=int, help="user id for the JSON upload (with -c; none = no upload)")
+  p.add_argument('--runs', type=int, default=5)
+  p.add_argument('--link-mbps', type=float, default=DEFAULT_LINK_MBPS,
+                 help="link speed for the estimated times")
+  p.add_argument('--users', type=int, default=1000, help="users of the mock service")
+  p.add_argument('--assets', type=int, default=10000, help="assets of the mock service")
+
+  p = subparsers.add_parser('index', help="query latency of the local label index")
+  p.add_argument('--assets', type=int, default=1000000, help="assets of the synthetic index")
+  p.add_argument('--query', action='append', dest='queries',
+                 help=f"query to time, may be repeated (default: {'; '.join(DEFAULT_INDEX_QUERIES)})")
+  p.add_argument('--runs', type=int, default=20)
+  p.add_argument('--threshold-ms', type=float, default=DEFAULT_INDEX_THRESHOLD_MS,
+                 help="fail if the median evaluation of a query is over this")
+
+  return parser
+
+
+def main(argv=None):
+  args = build_parser().parse_args(argv)
+
+  status = 0
+
+  if args.command == 'decode':
+    result = bench_decode(args.kind, args.rows, args.jsons_sample)
+
+  elif args.command == 'startup':
+    result = bench_startup(args.module, args.runs)
+    result["threshold_ms"] = args.threshold_ms
+    result["ok"] = result["import_ms"] <= args.threshold_ms
+    if not result["ok"]:
+      status = 1
+
+  elif args.command == 'upload':
+    import photoapp_transform
+
+    transform = photoapp_transform.ImageTransform(args.max_dimension, args.quality, args.strip_exif)
+    if not transform.enabled:
+      raise SystemExit("give --max-dimension, --quality and/or --strip-exif")
+    if args.config is not None and args.user is None:
+      raise SystemExit("--user is needed to upload")
+    result = bench_upload(args.sources, transform, args.config, args.user,
+                          args.workers, args.link_mbps)
+
+  elif args.command == 'load':
+    baseurl = load_configure(args.config, args.retries)
+    try:
+      with tempfile.TemporaryDirectory() as tmpdir:
+        try:
+          mix = parse_mix(args.mix)
+          target = LoadTarget(baseurl, mix, tmpdir, args.user, args.upload_file, args.search_labels)
+        except ValueError as e:
+          raise SystemExit(f"**ERROR: {e}")
+        result = bench_load(target, mix, args.concurrency, args.rps, args.duration,
+                            args.requests, args.warmup, args.seed)
+      result = {"baseurl": baseurl, "mix": mix, **result}
+    finally:
+      import photoapp_web
+      photoapp_web.close_session()
+
+  elif args.command == 'transfer':
+    import photoapp_web
+
+    if args.config is not None:
+      if args.user is None:
+        raise SystemExit("--user is needed with -c")
+      baseurl = load_configure(args.config)
+      try:
+        result = bench_transfer(baseurl, args.user, args.size_kb * 1024, args.runs)
+      finally:
+        photoapp_web.close_session()
+
+    else:
+      from configparser import ConfigParser
+      from photoapp_client import configure
+      from photoapp_mock import MockPhotoApp
+
+      configur = ConfigParser()
+      configur['client'] = {'dedup_uploads': 'false', 'http_cache_mb': '0'}
+      configure(configur)
+
+      with MockPhotoApp(users=1, assets=0) as server:
+        try:
+          userid = server.dataset.userids[0]
+          result = bench_transfer(server.baseurl, userid, args.size_kb * 1024, args.runs)
+        finally:
+          photoapp_web.close_session()
+      result["baseurl"] = "mock (in-process)"
+
+  elif args.command == 'compression':
+    import photoapp_web
+
+    if args.config is not None:
+      baseurl = load_configure(args.config)
+      try:
+        result = bench_compression(baseurl, args.user, args.runs, args.link_mbps)
+      finally:
+        photoapp_web.close_session()
+
+    else:
+      from configparser import ConfigParser
+      from photoapp_client import configure
+      from photoapp_mock import MockPhotoApp
+
+      configur = ConfigParser()
+      configur['client'] = {'dedup_uploads': 'false', 'http_cache_mb': '0'}
+      configure(configur)
+
+      with MockPhotoApp(users=args.users, assets=args.assets, analyzed=True) as server:
+        try:
+          userid = server.dataset.userids[0]
+          result = bench_compression(server.baseurl, userid, args.runs, args.link_mbps)
+        finally:
+          photoapp_web.close_session()
+      result["baseurl"] = "mock (in-process)"
+
+  elif args.command == 'index':
+    result = bench_index(args.assets, args.queries or DEFAULT_INDEX_QUERIES, args.runs)
+    result["threshold_ms"] = args.threshold_ms
+    result["ok"] = all(q["evaluate_ms"] <= args.threshold_ms for q in result["queries"].values())
+    if not result["ok"]:
+      status = 1
+
+  print(json.dumps(result, indent=2))
+  return status
+
+
+if __name__ == "__main__":
+  sys.exit(main())
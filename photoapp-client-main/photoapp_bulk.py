@@ -0,0 +1,638 @@
+#
+# photoapp_bulk.py
+#
+# Bulk operations over many assets, run with a bounded pool of
+# worker threads that share the pooled web service session.
+#
+#   bulk_upload: uploads every file under one or more directories
+#                (or matching glob patterns), recording each
+#                upload in a manifest so that an interrupted run
+#                can be resumed without re-uploading; images can
+#                be scaled down first in a pool of processes.
+#
+#   bulk_download: downloads many assets into a directory, skipping
+#                  files already downloaded with a matching size
+#                  and checksum.
+#
+#   bulk_analyze: labels many assets with Rekognition, skipping
+#                 assets already analyzed, at a limited rate of
+#                 calls per second.
+#
+#   export_rows: writes a listing (bucket contents, users, assets)
+#                as CSV or JSON lines, streaming page by page.
+#
+# Authors:
+#
+#   Neo Trovela-Villamiel
+#
+
+import concurrent.futures
+import contextlib
+import csv
+import glob
+import json
+import os
+import pathlib
+import sys
+import threading
+import time
+
+import photoapp_api
+import photoapp_cache
+import photoapp_index
+import photoapp_transform
+from photoapp_cache import file_sha256
+
+
+DEFAULT_WORKERS = 8
+DEFAULT_UPLOAD_MANIFEST = 'photoapp-upload-manifest.jsonl'
+DOWNLOAD_MANIFEST = '.photoapp-download-manifest.jsonl'
+
+
+###################################################################
+#
+# Progress
+#
+class Progress:
+  """
+  Thread-safe counters for a bulk operation, with throughput
+  (files/s and MB/s) reported at most every `interval` seconds.
+  """
+
+  def __init__(self, total, label, interval=2.0, out=sys.stderr, unit='files'):
+    self.total = total
+    self.label = label
+    self.unit = unit
+    self.interval = interval
+    self.out = out
+    self.done = 0
+    self.skipped = 0
+    self.failed = 0
+    self.bytes = 0
+    self.start = time.monotonic()
+    self.last_report = self.start
+    self.lock = threading.Lock()
+
+  def add(self, nbytes=0, skipped=False, failed=False):
+    with self.lock:
+      if failed:
+        self.failed += 1
+      elif skipped:
+        self.skipped += 1
+      else:
+        self.done += 1
+        self.bytes += nbytes
+
+  def elapsed(self):
+    return time.monotonic() - self.start
+
+  def summary(self):
+    with self.lock:
+      secs = max(self.elapsed(), 1e-9)
+      return {
+        "total": self.total,
+        "done": self.done,
+        "skipped": self.skipped,
+        "failed": self.failed,
+        "bytes": self.bytes,
+        "seconds": round(secs, 3),
+        "files_per_sec": round(self.done / secs, 2),
+        "mb_per_sec": round(self.bytes / secs / 1e6, 3)
+      }
+
+  def report(self, force=False):
+    now = time.monotonic()
+    if self.out is None or (not force and now - self.last_report < self.interval):
+      return
+    self.last_report = now
+
+    s = self.summary()
+    finished = s["done"] + s["skipped"] + s["failed"]
+    line = (f"{self.label}: {finished}/{s['total']} {self.unit}"
+            f" ({s['skipped']} skipped, {s['failed']} failed),"
+            f" {s['files_per_sec']} {self.unit}/s")
+    if self.unit == 'files':
+      line += f", {s['mb_per_sec']} MB/s"
+    print(line, file=self.out, flush=True)
+
+
+###################################################################
+#
+# RateLimiter
+#
+class RateLimiter:
+  """
+  Token bucket shared by worker threads: acquire() blocks until a
+  call may be made, so that on average at most `rate` calls are
+  made per second, with bursts of up to `burst` calls.
+  """
+
+  def __init__(self, rate, burst=1):
+    self.rate = rate
+    self.burst = burst
+    self.tokens = burst
+    self.last = time.monotonic()
+    self.lock = threading.Lock()
+
+  def acquire(self):
+    if self.rate is None or self.rate <= 0:
+      return  # unlimited
+
+    while True:
+      with self.lock:
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+
+        if self.tokens >= 1:
+          self.tokens -= 1
+          return
+
+        wait = (1 - self.tokens) / self.rate
+
+      time.sleep(wait)
+
+
+def latency_summary(latencies):
+  """
+  Returns min, mean, p50, p95, p99 and max of a list of call
+  latencies in seconds, as milliseconds.
+  """
+
+  if not latencies:
+    return None
+
+  ordered = sorted(latencies)
+
+  def percentile(p):
+    return ordered[min(len(ordered) - 1, int(p / 100 * len(ordered)))]
+
+  return {
+    "count": len(ordered),
+    "min_ms": round(ordered[0] * 1000, 1),
+    "mean_ms": round(sum(ordered) / len(ordered) * 1000, 1),
+    "p50_ms": round(percentile(50) * 1000, 1),
+    "p95_ms": round(percentile(95) * 1000, 1),
+    "p99_ms": round(percentile(99) * 1000, 1),
+    "max_ms": round(ordered[-1] * 1000, 1)
+  }
+
+
+def _run_bounded(func, items, workers, progress):
+  """
+  Calls func(item) for every item on a pool of `workers` threads,
+  keeping at most 2 * workers calls in flight so that huge item
+  lists are not turned into huge lists of futures. Progress is
+  reported from the calling thread while waiting.
+  """
+
+  items = iter(items)
+  pending = set()
+
+  with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+    while True:
+      for item in items:
+        pending.add(pool.submit(func, item))
+        if len(pending) >= 2 * workers:
+          break
+
+      if not pending:
+        break
+
+      finished, pending = concurrent.futures.wait(
+        pending, timeout=progress.interval,
+        return_when=concurrent.futures.FIRST_COMPLETED)
+
+      for future in finished:
+        future.result()  # func handles its own errors
+
+      progress.report()
+
+  progress.report(force=True)
+
+
+###################################################################
+#
+# bulk_upload
+#
+def find_files(sources, pattern='*'):
+  """
+  Yields the files to upload: each source is a directory (walked
+  recursively, keeping files whose name matches pattern), a file,
+  or a glob pattern. Hidden files such as .DS_Store are skipped.
+
+  Parameters
+  ----------
+  sources: list of directories, files or glob patterns
+  pattern: file name pattern for files found in directories
+
+  Returns
+  -------
+  generator of pathlib.Path, in sorted order per source
+  """
+
+  for source in sources:
+    path = pathlib.Path(source)
+
+    if path.is_dir():
+      for dirpath, dirnames, filenames in os.walk(path):
+        dirnames[:] = sorted(d for d in dirnames if not d.startswith('.'))
+        for filename in sorted(filenames):
+          if filename.startswith('.'):
+            continue
+          file = pathlib.Path(dirpath) / filename
+          if file.match(pattern):
+            yield file
+    elif path.is_file():
+      yield path
+    else:
+      for match in sorted(glob.glob(source, recursive=True)):
+        file = pathlib.Path(match)
+        if file.is_file() and not file.name.startswith('.'):
+          yield file
+
+
+def read_manifest(manifest, *fields):
+  """
+  Reads a manifest of a bulk operation (JSON lines, one per
+  completed file). Later lines win over earlier ones.
+
+  Parameters
+  ----------
+  manifest: name of the manifest file; need not exist
+  fields: the record fields that identify a file
+
+  Returns
+  -------
+  dict mapping tuple of the fields' values => manifest record
+  """
+
+  records = {}
+
+  if not pathlib.Path(manifest).is_file():
+    return records
+
+  with open(manifest, 'r') as infile:
+    for line in infile:
+      try:
+        record = json.loads(line)
+        records[tuple(record[field] for field in fields)] = record
+      except (ValueError, KeyError):
+        continue  # e.g. a line cut short by an interrupted run
+
+  return records
+
+
+def bulk_upload(baseurl, userid, sources, pattern='*',
+                workers=DEFAULT_WORKERS, manifest=DEFAULT_UPLOAD_MANIFEST,
+                force=False, transform=None, out=sys.stderr):
+  """
+  Uploads every file found in sources (see find_files) for the
+  given user, using a bounded pool of worker threads. Each upload
+  is appended to the manifest (local path => asset id) as soon as
+  it completes, and files already in the manifest with the same
+  size and modification time are skipped, so an interrupted run
+  picks up where it left off. Files whose contents the user has
+  uploaded before (from any path, see upload_image) are not sent
+  again either, and are counted as duplicates. If an image
+  transform is enabled, files are transformed in a pool of
+  processes (one per CPU at most) while the threads upload.
+
+  Parameters
+  ----------
+  baseurl: baseurl for web service
+  userid: user who owns the new assets
+  sources: list of directories, files or glob patterns
+  pattern: file name pattern for files found in directories
+  workers: # of uploads in parallel
+  manifest: name of the manifest file (JSON lines)
+  force: upload every file, ignoring the manifest and the upload
+         index
+  transform: ImageTransform applied before sending, default is the
+             configured one
+  out: where progress is reported, None for no progress
+
+  Returns
+  -------
+  dict with the counts, bytes sent, throughput, # of duplicates,
+  bytes saved by the transform and the failed files
+  """
+
+  files = list(find_files(sources, pattern))
+  uploaded = read_manifest(manifest, "userid", "path")
+
+  progress = Progress(len(files), "upload", out=out)
+  failures = []
+  duplicates = 0
+  original_bytes = 0
+  transform_seconds = 0.0
+  lock = threading.Lock()
+
+  if transform is None:
+    transform = photoapp_transform.get_upload_transform()
+
+  pool = None
+  if transform.enabled and transform.executor is None and len(files) > 1:
+    pool = photoapp_transform.process_pool(workers)
+    transform = transform.replace(executor=pool)
+
+  with contextlib.ExitStack() as stack:
+    if pool is not None:
+      stack.enter_context(pool)
+    manifest_file = stack.enter_context(open(manifest, 'a'))
+
+    def upload_one(file):
+      nonlocal duplicates, original_bytes, transform_seconds
+      path = str(file.resolve())
+      try:
+        st = file.stat()
+
+        previous = uploaded.get((userid, path))
+        if (not force
+            and previous is not None
+            and previous["size"] == st.st_size
+            and previous["mtime"] == st.st_mtime):
+          progress.add(skipped=True)
+          return
+
+        result = photoapp_api.upload_image(baseurl, userid, file, file.name,
+                                           force=force, transform=transform)
+
+        record = {
+          "userid": userid,
+          "path": path,
+          "asset_id": result["asset_id"],
+          "size": st.st_size,
+          "mtime": st.st_mtime
+        }
+        with lock:
+          manifest_file.write(json.dumps(record) + "\n")
+          manifest_file.flush()
+          if result["duplicate"]:
+            duplicates += 1
+          else:
+            original_bytes += st.st_size
+            transform_seconds += result["transform_seconds"]
+
+        progress.add(skipped=result["duplicate"], nbytes=result["sent_bytes"])
+
+      except Exception as e:
+        with lock:
+          failures.append({"path": str(file), "error": str(e)})
+        progress.add(failed=True)
+
+    _run_bounded(upload_one, files, workers, progress)
+
+  result = progress.summary()
+  result["duplicates"] = duplicates
+  if transform.enabled:
+    result["transform"] = transform.settings()
+    result["original_bytes"] = original_bytes
+    result["bytes_saved"] = original_bytes - result["bytes"]
+    result["transform_seconds"] = round(transform_seconds, 3)
+  result["manifest"] = str(manifest)
+  result["failures"] = failures
+
+  return result
+
+
+###################################################################
+#
+# bulk_download
+#
+def parse_asset_ids(specs):
+  """
+  Parses asset ids given as numbers and inclusive ranges, e.g.
+  ["1001-1005", "1010,1012"].
+
+  Parameters
+  ----------
+  specs: list of strings
+
+  Returns
+  -------
+  list of asset ids in the given order, without duplicates
+  """
+
+  ids = []
+
+  for spec in specs:
+    for part in spec.split(','):
+      part = part.strip()
+      if part == "":
+        continue
+      if '-' in part:
+        first, last = part.split('-', 1)
+        ids.extend(range(int(first), int(last) + 1))
+      else:
+        ids.append(int(part))
+
+  return list(dict.fromkeys(ids))
+
+
+def _safe_name(assetname):
+  """
+  The asset name reduced to a plain file name (no directories).
+  """
+
+  name = pathlib.PurePath(assetname.replace('\\', '/')).name
+  return name if name not in ('', '.', '..') else 'asset'
+
+
+def bulk_download(baseurl, assetids, target_dir, bucketkeys=None,
+                  workers=DEFAULT_WORKERS, out=sys.stderr):
+  """
+  Downloads the given assets into target_dir using a bounded pool
+  of worker threads. Each asset is saved as <assetid>-<assetname>,
+  written once to a temporary file and renamed when complete. A
+  manifest in target_dir records the size and SHA-256 checksum of
+  each download; an asset whose file is still present with the
+  same size and checksum is skipped.
+
+  Parameters
+  ----------
+  baseurl: baseurl for web service
+  assetids: list of asset ids
+  target_dir: directory to download into, created if needed
+  bucketkeys: optional dict asset id => bucket key, used to
+              validate the download cache
+  workers: # of downloads in parallel
+  out: where progress is reported, None for no progress
+
+  Returns
+  -------
+  dict with the counts, bytes, throughput and the failed assets
+  """
+
+  target = pathlib.Path(target_dir)
+  target.mkdir(parents=True, exist_ok=True)
+
+  manifest = target / DOWNLOAD_MANIFEST
+  downloaded = read_manifest(manifest, "asset_id")
+
+  progress = Progress(len(assetids), "download", out=out)
+  failures = []
+  lock = threading.Lock()
+
+  with open(manifest, 'a') as manifest_file:
+
+    def download_one(assetid):
+      partfile = target / f".{assetid}.part"
+      try:
+        previous = downloaded.get((assetid,))
+        if previous is not None:
+          file = target / previous["file"]
+          if (file.is_file()
+              and file.stat().st_size == previous["size"]
+              and file_sha256(file) == previous["sha256"]):
+            progress.add(skipped=True)
+            return
+
+        bucketkey = bucketkeys.get(assetid) if bucketkeys else None
+        result = photoapp_api.download_image(baseurl, assetid, partfile, bucketkey)
+
+        file = target / f"{assetid}-{_safe_name(result['asset_name'])}"
+        os.replace(partfile, file)
+
+        record = {
+          "asset_id": assetid,
+          "file": file.name,
+          "bucket_key": result["bucket_key"],
+          "size": result["size"],
+          "sha256": result["sha256"]
+        }
+        with lock:
+          manifest_file.write(json.dumps(record) + "\n")
+          manifest_file.flush()
+
+        progress.add(result["size"])
+
+      except Exception as e:
+        partfile.unlink(missing_ok=True)
+        with lock:
+          failures.append({"asset_id": assetid, "error": str(e)})
+        progress.add(failed=True)
+
+    _run_bounded(download_one, assetids, workers, progress)
+
+  result = progress.summary()
+  result["target_dir"] = str(target)
+  result["failures"] = failures
+
+  return result
+
+
+###################################################################
+#
+# bulk_analyze
+#
+DEFAULT_ANALYZE_WORKERS = 4
+DEFAULT_ANALYZE_RATE = 5.0  # Rekognition's DetectLabels default quota is 5+ TPS
+
+
+def bulk_analyze(baseurl, assetids, workers=DEFAULT_ANALYZE_WORKERS,
+                 rate=DEFAULT_ANALYZE_RATE, refresh=False, out=sys.stderr):
+  """
+  Analyzes the given assets with Rekognition (/labels/:assetid)
+  on a bounded pool of worker threads, making at most `rate` calls
+  per second across all workers. Assets already in the local label
+  index or label cache are skipped, and each analyzed asset is
+  added to both, so an interrupted run can simply be repeated.
+
+  Parameters
+  ----------
+  baseurl: baseurl for web service
+  assetids: list of asset ids
+  workers: # of calls in parallel
+  rate: max calls per second, None or 0 for no limit
+  refresh: analyze every asset, even if analyzed before
+  out: where progress is reported, None for no progress
+
+  Returns
+  -------
+  dict with the counts, throughput, per-call latency and the
+  failed assets
+  """
+
+  index = photoapp_index.get_label_index(baseurl)
+  cache = photoapp_cache.get_label_cache()
+  limiter = RateLimiter(rate, burst=max(1, workers))
+
+  progress = Progress(len(assetids), "analyze", out=out, unit='assets')
+  latencies = []
+  failures = []
+  lock = threading.Lock()
+
+  def analyze_one(assetid):
+    try:
+      if not refresh and (assetid in index or cache.get_labels(baseurl, assetid) is not None):
+        progress.add(skipped=True)
+        return
+
+      limiter.acquire()
+
+      start = time.monotonic()
+      photoapp_api.get_labels(baseurl, assetid, use_cache=False)
+      elapsed = time.monotonic() - start
+
+      with lock:
+        latencies.append(elapsed)
+      progress.add()
+
+    except Exception as e:
+      with lock:
+        failures.append({"asset_id": assetid, "error": str(e)})
+      progress.add(failed=True)
+
+  _run_bounded(analyze_one, assetids, workers, progress)
+
+  result = progress.summary()
+  del result["bytes"], result["mb_per_sec"]
+  result["assets_per_sec"] = result.pop("files_per_sec")
+  result["latency"] = latency_summary(latencies)
+  result["failures"] = failures
+
+  return result
+
+
+###################################################################
+#
+# export_rows
+#
+def export_rows(rows, outfile, format='jsonl'):
+  """
+  Writes records (User, Asset, BucketItem, ...) to outfile as JSON
+  lines or CSV (with a header row), one per line, as they are
+  generated, so a listing of any size streams through in constant
+  memory, e.g. from photoapp_api.iter_bucket or iter_assets.
+
+  Parameters
+  ----------
+  rows: iterable of records
+  outfile: text file to write to
+  format: 'jsonl' or 'csv'
+
+  Returns
+  -------
+  dict with the # of rows written
+  """
+
+  if format not in ('jsonl', 'csv'):
+    raise ValueError(f"unknown format '{format}', expected jsonl or csv")
+
+  count = 0
+  writer = None
+
+  for row in rows:
+    if format == 'jsonl':
+      outfile.write(json.dumps(row.as_dict()) + "\n")
+    else:
+      if writer is None:
+        writer = csv.writer(outfile)
+        writer.writerow(row._fields)
+      writer.writerow([getattr(row, field) for field in row._fields])
+    count += 1
+
+  outfile.flush()
+
+  return {"rows": count}
@@ -0,0 +1,900 @@
+#
+# photoapp_cache.py
+#
+# Client-side caches.
+#
+# DownloadCache: local on-disk cache of downloaded assets, so
+# re-opening the same image does not refetch the whole base64
+# payload from the web service. An asset's contents never change
+# once uploaded (the server gives every upload a new asset id and
+# bucket key), so an entry is keyed by web service and asset id,
+# and only used if its bucket key is the asset's: asset ids are
+# reused when a service's database is reset.
+#
+# Contents are stored once per SHA-256 (content-addressed) under
+# <dir>/objects, with an SQLite index in <dir>/index.db holding
+# the entries, their last use (for LRU eviction once the cache
+# grows past its size limit) and hit/miss statistics. Cached
+# contents are re-hashed when used, so a damaged file is dropped
+# instead of being returned.
+#
+# LabelCache: labels per asset (/labels/:assetid) and search
+# results per label (/images/:label) of each web service (asset
+# ids are only unique within one), kept in memory for the
+# session and optionally persisted to an SQLite file. Labels of
+# an asset never change once computed; search results expire
+# after a TTL, since analyzing more assets adds to them.
+#
+# UploadIndex: SHA-256 of every uploaded file => the asset it
+# became, per web service and user, so uploading the same contents
+# again is detected before any bytes are sent. Also holds the
+# chunked uploads still in progress, so an interrupted upload of
+# the same contents resumes where it stopped.
+#
+# ResponseCache: the last body of each GET (/stats, /users,
+# /assets, /bucket, ...) that came with an ETag or Last-Modified,
+# in memory. photoapp_web asks again with If-None-Match /
+# If-Modified-Since, and a 304 Not Modified is answered from the
+# stored body, so polling an unchanged endpoint transfers only
+# headers.
+#
+# Configured from the [client] section of the client config:
+#
+#   cache_dir = .photoapp-cache
+#   cache_max_mb = 1024      # 0 disables the download cache
+#   label_cache_file =       # SQLite file, empty = memory only
+#   search_ttl = 300         # seconds search results are reused
+#   dedup_uploads = true     # keep <cache_dir>/uploads.db
+#   http_cache_mb = 64       # 0 disables the response cache
+#
+# Authors:
+#
+#   Neo Trovela-Villamiel
+#
+
+import hashlib
+import json
+import os
+import pathlib
+import shutil
+import sqlite3
+import threading
+import time
+
+from configparser import ConfigParser
+
+
+DEFAULT_CACHE_DIR = '.photoapp-cache'
+DEFAULT_CACHE_MAX_MB = 1024
+DEFAULT_SEARCH_TTL = 300.0
+DEFAULT_HTTP_CACHE_MB = 64
+
+# response headers kept with a cached body; the body is stored
+# decoded, so Content-Encoding and Content-Length are not:
+RESPONSE_CACHE_HEADERS = ('Content-Type', 'ETag', 'Last-Modified', 'Cache-Control', 'Vary')
+
+COPY_CHUNK_SIZE = 1024 * 1024
+
+
+def file_sha256(filename):
+  """
+  Returns the hex SHA-256 digest of a file, read in chunks.
+  """
+
+  h = hashlib.sha256()
+  with open(filename, 'rb') as infile:
+    for chunk in iter(lambda: infile.read(1024 * 1024), b''):
+      h.update(chunk)
+  return h.hexdigest()
+
+
+###################################################################
+#
+# DownloadCache
+#
+class DownloadCache:
+  """
+  LRU cache of downloaded assets, shared by all threads.
+  """
+
+  def __init__(self, directory, max_bytes):
+    self.directory = pathlib.Path(directory)
+    self.objects = self.directory / 'objects'
+    self.objects.mkdir(parents=True, exist_ok=True)
+    self.max_bytes = max_bytes
+    self.lock = threading.Lock()
+
+    self.db = sqlite3.connect(str(self.directory / 'index.db'), check_same_thread=False)
+    with self.db:
+      #
+      # entries of caches made before they were kept per service
+      # cannot be trusted, so they are dropped:
+      #
+      columns = [row[1] for row in self.db.execute("PRAGMA table_info(entries)")]
+      if columns and 'baseurl' not in columns:
+        self.db.execute("DROP TABLE entries")
+        shutil.rmtree(self.objects, ignore_errors=True)
+        self.objects.mkdir(parents=True, exist_ok=True)
+
+      self.db.execute("""
+        CREATE TABLE IF NOT EXISTS entries
+        (
+          baseurl    TEXT NOT NULL,
+          assetid    INTEGER NOT NULL,
+          userid     INTEGER,
+          assetname  TEXT NOT NULL,
+          bucketkey  TEXT NOT NULL,
+          sha256     TEXT NOT NULL,
+          size       INTEGER NOT NULL,
+          lastused   REAL NOT NULL,
+          PRIMARY KEY (baseurl, assetid)
+        )""")
+      self.db.execute("CREATE INDEX IF NOT EXISTS entries_lastused ON entries(lastused)")
+      self.db.execute("""
+        CREATE TABLE IF NOT EXISTS stats
+        (
+          name   TEXT PRIMARY KEY,
+          value  INTEGER NOT NULL
+        )""")
+
+  def _object_path(self, sha256):
+    return self.objects / sha256[:2] / sha256
+
+  def _count(self, name, amount=1):
+    self.db.execute("""
+      INSERT INTO stats (name, value) VALUES (?, ?)
+      ON CONFLICT(name) DO UPDATE SET value = value + excluded.value
+      """, [name, amount])
+
+  def _remove(self, baseurl, assetid, sha256):
+    """
+    Removes an entry, and its contents unless another entry
+    (another asset with the same contents) still uses them.
+    """
+    self.db.execute("DELETE FROM entries WHERE baseurl = ? AND assetid = ?", [baseurl, assetid])
+    row = self.db.execute("SELECT 1 FROM entries WHERE sha256 = ? LIMIT 1", [sha256]).fetchone()
+    if row is None:
+      self._object_path(sha256).unlink(missing_ok=True)
+
+  def fetch(self, baseurl, assetid, bucketkey, filename=None):
+    """
+    Copies a cached asset to a local file, verifying its checksum
+    on the way.
+
+    Parameters
+    ----------
+    baseurl: the web service the asset belongs to
+    assetid: asset to look for
+    bucketkey: the asset's bucket key; an entry with a different
+               bucket key is stale (the asset id was reused) and
+               dropped
+    filename: local file to write, defaults to the asset's name
+
+    Returns
+    -------
+    the same dict download_image() returns, or None on a miss
+    """
+
+    with self.lock:
+      row = self.db.execute("""
+        SELECT userid, assetname, bucketkey, sha256, size
+        FROM entries WHERE baseurl = ? AND assetid = ?
+        """, [baseurl, int(assetid)]).fetchone()
+
+    if row is not None and row[2] != bucketkey:
+      with self.lock, self.db:
+        self._remove(baseurl, int(assetid), row[3])
+      row = None
+
+    if row is None:
+      with self.lock, self.db:
+        self._count('misses')
+      return None
+
+    userid, assetname, cached_bucketkey, sha256, size = row
+    if filename is None:
+      filename = assetname
+
+    #
+    # copy and re-hash in one pass, into a temporary file that is
+    # renamed only if the contents are intact:
+    #
+    tmp = pathlib.Path(str(filename) + '.cache-part')
+    h = hashlib.sha256()
+    try:
+      with open(self._object_path(sha256), 'rb') as infile, open(tmp, 'wb') as outfile:
+        for chunk in iter(lambda: infile.read(COPY_CHUNK_SIZE), b''):
+          h.update(chunk)
+          outfile.write(chunk)
+    except FileNotFoundError:
+      tmp.unlink(missing_ok=True)
+      h = None
+
+    if h is None or h.hexdigest() != sha256:
+      tmp.unlink(missing_ok=True)
+      with self.lock, self.db:
+        self._remove(baseurl, int(assetid), sha256)
+        self._count('misses')
+        self._count('corrupt')
+      return None
+
+    os.replace(tmp, filename)
+
+    with self.lock, self.db:
+      self.db.execute("UPDATE entries SET lastused = ? WHERE baseurl = ? AND assetid = ?",
+                      [time.time(), baseurl, int(assetid)])
+      self._count('hits')
+      self._count('bytes_saved', size)
+
+    return {
+      "asset_id": int(assetid),
+      "user_id": userid,
+      "asset_name": assetname,
+      "bucket_key": cached_bucketkey,
+      "filename": str(filename),
+      "size": size,
+      "sha256": sha256,
+      "cached": True
+    }
+
+  def add(self, baseurl, result, filename):
+    """
+    Adds a freshly downloaded asset to the cache, then evicts the
+    least recently used entries while the cache is over its limit.
+
+    Parameters
+    ----------
+    baseurl: the web service the asset belongs to
+    result: dict returned by download_image()
+    filename: local file holding the downloaded contents
+
+    Returns
+    -------
+    nothing
+    """
+
+    if result["size"] > self.max_bytes:
+      return
+
+    sha256 = result["sha256"]
+    path = self._object_path(sha256)
+
+    if not path.is_file():
+      path.parent.mkdir(exist_ok=True)
+      tmp = path.with_name(path.name + f'.{threading.get_ident()}.part')
+      shutil.copyfile(filename, tmp)
+      os.replace(tmp, path)
+
+    with self.lock, self.db:
+      self.db.execute("""
+        INSERT OR REPLACE INTO entries
+        (baseurl, assetid, userid, assetname, bucketkey, sha256, size, lastused)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        """, [baseurl, result["asset_id"], result["user_id"], result["asset_name"],
+              result["bucket_key"], sha256, result["size"], time.time()])
+      self._evict()
+
+  def _evict(self):
+    """
+    Drops least recently used entries until the distinct contents
+    fit in max_bytes. Caller holds the lock.
+    """
+
+    (total,) = self.db.execute("""
+      SELECT COALESCE(SUM(size), 0) FROM
+        (SELECT sha256, MAX(size) AS size FROM entries GROUP BY sha256)
+      """).fetchone()
+
+    if total <= self.max_bytes:
+      return
+
+    rows = self.db.execute("SELECT baseurl, assetid, sha256, size FROM entries ORDER BY lastused").fetchall()
+    for baseurl, assetid, sha256, size in rows:
+      if total <= self.max_bytes:
+        break
+      self._remove(baseurl, assetid, sha256)
+      if not self._object_path(sha256).exists():
+        total -= size
+      self._count('evictions')
+
+  def stats(self):
+    """
+    Returns the cache's size and its hit/miss statistics.
+    """
+
+    with self.lock:
+      counts = dict(self.db.execute("SELECT name, value FROM stats").fetchall())
+      entries, = self.db.execute("SELECT COUNT(*) FROM entries").fetchone()
+      size, = self.db.execute("""
+        SELECT COALESCE(SUM(size), 0) FROM
+          (SELECT sha256, MAX(size) AS size FROM entries GROUP BY sha256)
+        """).fetchone()
+
+    hits = counts.get('hits', 0)
+    misses = counts.get('misses', 0)
+
+    return {
+      "dir": str(self.directory),
+      "entries": entries,
+      "bytes": size,
+      "max_bytes": self.max_bytes,
+      "hits": hits,
+      "misses": misses,
+      "hit_rate": round(hits / (hits + misses), 4) if hits + misses > 0 else 0.0,
+      "bytes_saved": counts.get('bytes_saved', 0),
+      "evictions": counts.get('evictions', 0),
+      "corrupt": counts.get('corrupt', 0)
+    }
+
+  def clear(self):
+    """
+    Removes every entry and all cached contents (statistics are kept).
+    """
+
+    with self.lock, self.db:
+      self.db.execute("DELETE FROM entries")
+      shutil.rmtree(self.objects, ignore_errors=True)
+      self.objects.mkdir(parents=True, exist_ok=True)
+
+  def close(self):
+    with self.lock:
+      self.db.close()
+
+
+###################################################################
+#
+# LabelCache
+#
+class LabelCache:
+  """
+  Memoizes get_labels() per asset (forever) and search_images()
+  per label (for ttl seconds), in memory and, if a file is given,
+  in SQLite so the results survive between runs. Entries are kept
+  per web service, since asset ids are only unique within one.
+  """
+
+  def __init__(self, filename=None, ttl=DEFAULT_SEARCH_TTL):
+    self.ttl = ttl
+    self.labels = {}    # (baseurl, assetid) => (asset_name, labels)
+    self.searches = {}  # (baseurl, label.lower()) => (stored, results)
+    self.hits = 0
+    self.misses = 0
+    self.lock = threading.Lock()
+
+    self.db = None
+    if filename:
+      self.db = sqlite3.connect(str(filename), check_same_thread=False)
+      with self.db:
+        #
+        # entries of files made before they were kept per service
+        # cannot be trusted, so they are dropped:
+        #
+        columns = [row[1] for row in self.db.execute("PRAGMA table_info(labels)")]
+        if columns and 'baseurl' not in columns:
+          self.db.execute("DROP TABLE labels")
+          self.db.execute("DROP TABLE IF EXISTS searches")
+
+        self.db.execute("""
+          CREATE TABLE IF NOT EXISTS labels
+          (
+            baseurl    TEXT NOT NULL,
+            assetid    INTEGER NOT NULL,
+            assetname  TEXT NOT NULL,
+            data       TEXT NOT NULL,
+            PRIMARY KEY (baseurl, assetid)
+          )""")
+        self.db.execute("""
+          CREATE TABLE IF NOT EXISTS searches
+          (
+            baseurl  TEXT NOT NULL,
+            label    TEXT NOT NULL,
+            stored   REAL NOT NULL,
+            data     TEXT NOT NULL,
+            PRIMARY KEY (baseurl, label)
+          )""")
+
+  def _counted(self, found):
+    if found is None:
+      self.misses += 1
+    else:
+      self.hits += 1
+    return found
+
+  def get_labels(self, baseurl, assetid):
+    """
+    Returns (asset_name, labels) for an asset of the web service
+    at baseurl, or None on a miss.
+    """
+
+    key = (baseurl, int(assetid))
+
+    with self.lock:
+      found = self.labels.get(key)
+
+      if found is None and self.db is not None:
+        row = self.db.execute("SELECT assetname, data FROM labels WHERE baseurl = ? AND assetid = ?",
+                              key).fetchone()
+        if row is not None:
+          found = (row[0], json.loads(row[1]))
+          self.labels[key] = found
+
+      return self._counted(found)
+
+  def put_labels(self, baseurl, assetid, asset_name, labels):
+    """
+    Stores the labels of an asset. Since the asset may just have
+    been analyzed, cached searches for these labels are dropped.
+    """
+
+    assetid = int(assetid)
+
+    with self.lock:
+      self.labels[(baseurl, assetid)] = (asset_name, labels)
+      for label in labels:
+        self.searches.pop((baseurl, label['name'].lower()), None)
+
+      if self.db is not None:
+        with self.db:
+          self.db.execute("""
+            INSERT OR REPLACE INTO labels (baseurl, assetid, assetname, data) VALUES (?, ?, ?, ?)
+            """, [baseurl, assetid, asset_name, json.dumps(labels)])
+          self.db.executemany("DELETE FROM searches WHERE baseurl = ? AND label = ?",
+                              [[baseurl, label['name'].lower()] for label in labels])
+
+  def get_search(self, baseurl, label):
+    """
+    Returns the cached results of searching the web service at
+    baseurl for label, or None on a miss or if they are older than
+    the TTL.
+    """
+
+    key = (baseurl, label.lower())
+    now = time.time()
+
+    with self.lock:
+      found = self.searches.get(key)
+
+      if found is None and self.db is not None:
+        row = self.db.execute("SELECT stored, data FROM searches WHERE baseurl = ? AND label = ?",
+                              key).fetchone()
+        if row is not None:
+          found = (row[0], json.loads(row[1]))
+          self.searches[key] = found
+
+      if found is not None and now - found[0] > self.ttl:
+        found = None
+
+      return self._counted(None if found is None else found[1])
+
+  def put_search(self, baseurl, label, results):
+    """
+    Stores the results of searching for label.
+    """
+
+    key = (baseurl, label.lower())
+    now = time.time()
+
+    with self.lock:
+      self.searches[key] = (now, results)
+
+      if self.db is not None:
+        with self.db:
+          self.db.execute("""
+            INSERT OR REPLACE INTO searches (baseurl, label, stored, data) VALUES (?, ?, ?, ?)
+            """, [*key, now, json.dumps(results)])
+
+  def all_labels(self, baseurl):
+    """
+    Returns (assetid, labels) for every cached asset of the web
+    service at baseurl, e.g. to rebuild the local label index (see
+    photoapp_index).
+    """
+
+    with self.lock:
+      if self.db is None:
+        return sorted((assetid, labels) for (url, assetid), (_, labels) in self.labels.items()
+                      if url == baseurl)
+      rows = self.db.execute("SELECT assetid, data FROM labels WHERE baseurl = ? ORDER BY assetid",
+                             [baseurl]).fetchall()
+
+    return [(assetid, json.loads(data)) for assetid, data in rows]
+
+  def invalidate(self, baseurl=None, assetid=None, label=None):
+    """
+    Drops the cached labels of an asset and/or the cached results
+    of a search of the web service at baseurl; with neither given,
+    drops everything (of every service).
+    """
+
+    with self.lock:
+      if assetid is None and label is None:
+        self.labels.clear()
+        self.searches.clear()
+        if self.db is not None:
+          with self.db:
+            self.db.execute("DELETE FROM labels")
+            self.db.execute("DELETE FROM searches")
+        return
+
+      if assetid is not None:
+        self.labels.pop((baseurl, int(assetid)), None)
+        if self.db is not None:
+          with self.db:
+            self.db.execute("DELETE FROM labels WHERE baseurl = ? AND assetid = ?", [baseurl, int(assetid)])
+
+      if label is not None:
+        self.searches.pop((baseurl, label.lower()), None)
+        if self.db is not None:
+          with self.db:
+            self.db.execute("DELETE FROM searches WHERE baseurl = ? AND label = ?", [baseurl, label.lower()])
+
+  def stats(self):
+    """
+    Returns the # of cached assets and searches, and this session's
+    hits and misses.
+    """
+
+    with self.lock:
+      if self.db is not None:
+        assets, = self.db.execute("SELECT COUNT(*) FROM labels").fetchone()
+        searches, = self.db.execute("SELECT COUNT(*) FROM searches").fetchone()
+      else:
+        assets = len(self.labels)
+        searches = len(self.searches)
+
+      return {
+        "assets": assets,
+        "searches": searches,
+        "search_ttl": self.ttl,
+        "hits": self.hits,
+        "misses": self.misses
+      }
+
+  def close(self):
+    with self.lock:
+      if self.db is not None:
+        self.db.close()
+        self.db = None
+
+
+###################################################################
+#
+# UploadIndex
+#
+class UploadIndex:
+  """
+  Content hash => asset id of the files uploaded so far, in an
+  SQLite file, shared by all threads.
+  """
+
+  def __init__(self, filename):
+    pathlib.Path(filename).parent.mkdir(parents=True, exist_ok=True)
+    self.lock = threading.Lock()
+
+    self.db = sqlite3.connect(str(filename), check_same_thread=False)
+    with self.db:
+      self.db.execute("""
+        CREATE TABLE IF NOT EXISTS uploads
+        (
+          baseurl    TEXT NOT NULL,
+          userid     INTEGER NOT NULL,
+          sha256     TEXT NOT NULL,
+          assetid    INTEGER NOT NULL,
+          assetname  TEXT NOT NULL,
+          size       INTEGER NOT NULL,
+          uploaded   REAL NOT NULL,
+          PRIMARY KEY (baseurl, userid, sha256)
+        )""")
+      self.db.execute("""
+        CREATE TABLE IF NOT EXISTS pending
+        (
+          baseurl    TEXT NOT NULL,
+          userid     INTEGER NOT NULL,
+          sha256     TEXT NOT NULL,
+          uploadid   TEXT NOT NULL,
+          started    REAL NOT NULL,
+          PRIMARY KEY (baseurl, userid, sha256)
+        )""")
+
+  def find(self, baseurl, userid, sha256):
+    """
+    Returns the asset id the user's earlier upload of the same
+    contents became, or None.
+    """
+
+    with self.lock:
+      row = self.db.execute("""
+        SELECT assetid FROM uploads WHERE baseurl = ? AND userid = ? AND sha256 = ?
+        """, [baseurl, int(userid), sha256]).fetchone()
+
+    return None if row is None else row[0]
+
+  def add(self, baseurl, userid, sha256, assetid, assetname, size):
+    with self.lock, self.db:
+      self.db.execute("""
+        INSERT OR REPLACE INTO uploads (baseurl, userid, sha256, assetid, assetname, size, uploaded)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+        """, [baseurl, int(userid), sha256, assetid, str(assetname), size, time.time()])
+
+  def find_pending(self, baseurl, userid, sha256):
+    """
+    Returns the id of the chunked upload of these contents that was
+    started but not completed, or None.
+    """
+
+    with self.lock:
+      row = self.db.execute("""
+        SELECT uploadid FROM pending WHERE baseurl = ? AND userid = ? AND sha256 = ?
+        """, [baseurl, int(userid), sha256]).fetchone()
+
+    return None if row is None else row[0]
+
+  def add_pending(self, baseurl, userid, sha256, uploadid):
+    with self.lock, self.db:
+      self.db.execute("""
+        INSERT OR REPLACE INTO pending (baseurl, userid, sha256, uploadid, started)
+        VALUES (?, ?, ?, ?, ?)
+        """, [baseurl, int(userid), sha256, uploadid, time.time()])
+
+  def remove_pending(self, baseurl, userid, sha256):
+    with self.lock, self.db:
+      self.db.execute("""
+        DELETE FROM pending WHERE baseurl = ? AND userid = ? AND sha256 = ?
+        """, [baseurl, int(userid), sha256])
+
+  def stats(self):
+    with self.lock:
+      uploads, size = self.db.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM uploads").fetchone()
+      pending, = self.db.execute("SELECT COUNT(*) FROM pending").fetchone()
+    return {"uploads": uploads, "bytes": size, "pending": pending}
+
+  def clear(self):
+    with self.lock, self.db:
+      self.db.execute("DELETE FROM uploads")
+      self.db.execute("DELETE FROM pending")
+
+  def close(self):
+    with self.lock:
+      self.db.close()
+
+
+###################################################################
+#
+# ResponseCache
+#
+class ResponseCache:
+  """
+  LRU cache of GET response bodies and their validators (ETag,
+  Last-Modified), in memory, shared by all threads.
+  """
+
+  def __init__(self, max_bytes):
+    self.max_bytes = max_bytes
+    self.entries = {}  # key => {"content", "headers", "encoding"}, oldest use first
+    self.bytes = 0
+    self.revalidated = 0   # 304s answered from the cache
+    self.misses = 0        # full responses to a request
+    self.bytes_saved = 0   # bodies not transferred thanks to a 304
+    self.lock = threading.Lock()
+
+  def lookup(self, key):
+    """
+    Returns the entry for key (a url, or url and request headers),
+    or None.
+    """
+
+    with self.lock:
+      return self.entries.get(key)
+
+  def validators(self, entry):
+    """
+    The conditional request headers that revalidate an entry.
+    """
+
+    headers = {}
+    if 'ETag' in entry["headers"]:
+      headers['If-None-Match'] = entry["headers"]['ETag']
+    if 'Last-Modified' in entry["headers"]:
+      headers['If-Modified-Since'] = entry["headers"]['Last-Modified']
+    return headers
+
+  def _drop(self, key):
+    entry = self.entries.pop(key, None)
+    if entry is not None:
+      self.bytes -= len(entry["content"])
+
+  def update(self, key, entry, response):
+    """
+    Handles the response to a request for key that was sent with
+    entry's validators (entry None if there was none): stores a
+    cacheable 200, or answers a 304 from entry.
+
+    Returns
+    -------
+    the response to give the caller: response itself, or for a
+    304, a 200 response with the cached body
+    """
+
+    import requests  # already imported by photoapp_web
+
+    if response.status_code == 304 and entry is not None:
+      cached = requests.Response()
+      cached.status_code = 200
+      cached.reason = 'OK'
+      cached.headers = requests.structures.CaseInsensitiveDict(entry["headers"])
+      for name in RESPONSE_CACHE_HEADERS:
+        if name in response.headers:
+          cached.headers[name] = response.headers[name]
+      cached._content = entry["content"]
+      cached.encoding = entry["encoding"]
+      cached.url = response.url
+      cached.request = response.request
+      cached.elapsed = response.elapsed
+      cached.from_cache = True
+      response.close()
+
+      with self.lock:
+        self.revalidated += 1
+        self.bytes_saved += len(entry["content"])
+        if self.entries.get(key) is entry:
+          del self.entries[key]
+          entry["headers"] = {name: cached.headers[name]
+                              for name in RESPONSE_CACHE_HEADERS if name in cached.headers}
+          self.entries[key] = entry  # now the most recently used
+
+      return cached
+
+    if response.status_code != 200:
+      return response
+
+    headers = {name: response.headers[name] for name in RESPONSE_CACHE_HEADERS if name in response.headers}
+    storable = (('ETag' in headers or 'Last-Modified' in headers)
+                and 'no-store' not in headers.get('Cache-Control', ''))
+
+    content = response.content if storable else b''
+
+    with self.lock:
+      self.misses += 1
+      self._drop(key)
+
+      if storable and len(content) <= self.max_bytes:
+        self.entries[key] = {"content": content, "headers": headers, "encoding": response.encoding}
+        self.bytes += len(content)
+
+        while self.bytes > self.max_bytes:
+          self._drop(next(iter(self.entries)))
+
+    return response
+
+  def stats(self):
+    with self.lock:
+      return {
+        "entries": len(self.entries),
+        "bytes": self.bytes,
+        "max_bytes": self.max_bytes,
+        "revalidated": self.revalidated,
+        "misses": self.misses,
+        "bytes_saved": self.bytes_saved
+      }
+
+  def clear(self):
+    with self.lock:
+      self.entries = {}
+      self.bytes = 0
+
+
+###################################################################
+#
+# the caches used by photoapp_api
+#
+_download_cache = None
+_download_settings = (DEFAULT_CACHE_DIR, DEFAULT_CACHE_MAX_MB * 1024 * 1024)
+_label_cache = LabelCache()
+_upload_index = None
+_upload_index_file = pathlib.Path(DEFAULT_CACHE_DIR) / 'uploads.db'
+_response_cache = ResponseCache(DEFAULT_HTTP_CACHE_MB * 1024 * 1024)
+_cache_lock = threading.Lock()
+
+
+def configure_cache(configur=None):
+  """
+  Sets up the download cache and opens the label cache given by
+  the [client] section of the config (cache_dir, cache_max_mb,
+  label_cache_file, search_ttl, dedup_uploads, http_cache_mb);
+  cache_max_mb = 0 disables the download cache, http_cache_mb = 0
+  the response cache. The download cache and the upload
+  index are only opened when first used, so commands that do not
+  need them do not touch the disk.
+
+  Parameters
+  ----------
+  configur: ConfigParser with the client config, or None for defaults
+
+  Returns
+  -------
+  nothing
+  """
+
+  global _download_cache, _download_settings, _label_cache
+  global _upload_index, _upload_index_file, _response_cache
+
+  if configur is None:
+    configur = ConfigParser()
+
+  directory = configur.get('client', 'cache_dir', fallback=DEFAULT_CACHE_DIR)
+  max_mb = configur.getfloat('client', 'cache_max_mb', fallback=DEFAULT_CACHE_MAX_MB)
+
+  with _cache_lock:
+    if _download_cache is not None:
+      _download_cache.close()
+    _download_cache = None
+
+    if max_mb <= 0:
+      _download_settings = None
+    else:
+      _download_settings = (directory, int(max_mb * 1024 * 1024))
+
+    if _upload_index is not None:
+      _upload_index.close()
+    _upload_index = None
+
+    if configur.getboolean('client', 'dedup_uploads', fallback=True):
+      _upload_index_file = pathlib.Path(directory) / 'uploads.db'
+    else:
+      _upload_index_file = None
+
+    http_mb = configur.getfloat('client', 'http_cache_mb', fallback=DEFAULT_HTTP_CACHE_MB)
+    _response_cache = ResponseCache(int(http_mb * 1024 * 1024)) if http_mb > 0 else None
+
+  label_file = configur.get('client', 'label_cache_file', fallback='')
+  ttl = configur.getfloat('client', 'search_ttl', fallback=DEFAULT_SEARCH_TTL)
+
+  _label_cache.close()
+  _label_cache = LabelCache(label_file, ttl)
+
+
+def get_download_cache():
+  """
+  Returns the download cache, opening it on first use, or None if
+  it is disabled.
+  """
+
+  global _download_cache
+
+  with _cache_lock:
+    if _download_cache is None and _download_settings is not None:
+      _download_cache = DownloadCache(*_download_settings)
+
+    return _download_cache
+
+
+def get_upload_index():
+  """
+  Returns the upload index, opening it on first use, or None if
+  upload deduplication is disabled.
+  """
+
+  global _upload_index
+
+  with _cache_lock:
+    if _upload_index is None and _upload_index_file is not None:
+      _upload_index = UploadIndex(_upload_index_file)
+
+    return _upload_index
+
+
+def get_label_cache():
+  """
+  Returns the label cache (always present, memory only unless
+  configured with a file).
+  """
+
+  return _label_cache
+
+
+def get_response_cache():
+  """
+  Returns the response cache, or None if it is disabled.
+  """
+
+  return _response_cache
@@ -0,0 +1,431 @@
+#
+# photoapp_client.py
+#
+# Importable client library for the PhotoApp web service, for use
+# from other programs instead of the interactive prompt:
+#
+#   from photoapp_client import PhotoAppClient
+#
+#   with PhotoAppClient.from_config('photoapp-client-config.ini') as client:
+#     for user in client.users():
+#       print(user.userid, user.email)
+#
+# and the asyncio variant, where calls run concurrently on a
+# bounded pool of threads sharing the pooled web service session:
+#
+#   async with AsyncPhotoAppClient.from_config(...) as client:
+#     results = await asyncio.gather(*(client.labels(id) for id in ids))
+#
+# Methods return the typed objects of photoapp_api (User, Asset,
+# BucketItem) and raise photoapp_api.ApiError when the service
+# answers with an error.
+#
+# Authors:
+#
+#   Neo Trovela-Villamiel
+#
+
+import pathlib
+import uuid
+
+from configparser import ConfigParser
+
+import photoapp_api
+import photoapp_cache
+import photoapp_index
+import photoapp_metrics
+import photoapp_transform
+import photoapp_web
+from photoapp_api import ApiError, User, Asset, BucketItem
+
+
+###################################################################
+#
+# configuration
+#
+_config_cache = {}  # (path, mtime, size) => (configur, baseurl)
+
+
+def read_config(config_file):
+  """
+  Reads the client config file and checks the web service's
+  base URL. The result is cached until the file changes, so
+  reading the same config again (batch scripts, library use)
+  costs a stat() instead of a parse.
+
+  Parameters
+  ----------
+  config_file: name of the client config file
+
+  Returns
+  -------
+  (configur, baseurl) where baseurl does not end with /; raises
+  ValueError if the config file or base URL is not usable
+  """
+
+  #
+  # does config file exist?
+  #
+  path = pathlib.Path(config_file)
+  if not path.is_file():
+    raise ValueError(f"config file '{config_file}' does not exist")
+
+  st = path.stat()
+  key = (str(path.resolve()), st.st_mtime_ns, st.st_size)
+  if key in _config_cache:
+    return _config_cache[key]
+
+  #
+  # setup base URL to web service:
+  #
+  configur = ConfigParser()
+  configur.read(config_file)
+  baseurl = configur.get('client', 'webservice')
+
+  #
+  # make sure baseurl does not end with /, if so remove:
+  #
+  if len(baseurl) < 16:
+    raise ValueError(f"baseurl '{baseurl}' in .ini file is empty or not nearly long enough, please fix")
+
+  if baseurl.startswith('https'):
+    raise ValueError(f"baseurl '{baseurl}' in .ini file starts with https, which is not supported (use http)")
+
+  lastchar = baseurl[len(baseurl) - 1]
+  if lastchar == "/":
+    baseurl = baseurl[:-1]
+
+  _config_cache[key] = (configur, baseurl)
+  return configur, baseurl
+
+
+_configured = None  # the [client] settings last applied by configure()
+
+
+def _client_settings(configur):
+  if configur is None or not configur.has_section('client'):
+    return {}
+  return dict(configur.items('client'))
+
+
+def configure(configur=None):
+  """
+  Applies the [client] section of a config to the shared web
+  service session, retries, caches, label index, upload image
+  transform, metrics and image transfer mode. These are process-
+  wide: they apply to every client, existing or new.
+
+  Parameters
+  ----------
+  configur: ConfigParser with the client config, or None for defaults
+
+  Returns
+  -------
+  nothing
+  """
+
+  global _configured
+
+  photoapp_web.configure_session(configur)
+  photoapp_web.configure_retries(configur)
+  photoapp_cache.configure_cache(configur)
+  photoapp_index.configure_index(configur)
+  photoapp_transform.configure_transform(configur)
+  photoapp_metrics.configure_metrics(configur)
+  photoapp_api.configure_transfer(configur)
+
+  _configured = _client_settings(configur)
+
+
+###################################################################
+#
+# PhotoAppClient
+#
+class PhotoAppClient:
+  """
+  Synchronous client: one method per web service call. Methods
+  are safe to call from several threads at once.
+
+  The session, retries, caches and transfer mode are shared by
+  all the clients of a process (see configure), so clients may
+  differ in baseurl but not in settings: creating a client with
+  a config other than the one applied raises ValueError. Call
+  configure() to change the settings of every client.
+  """
+
+  def __init__(self, baseurl, configur=None):
+    """
+    baseurl: baseurl for web service, e.g. http://localhost:8080
+    configur: optional ConfigParser with [client] settings for the
+              session, retries and caches; applied unless the same
+              settings already are
+    """
+
+    self.baseurl = baseurl.rstrip('/')
+    if configur is not None:
+      settings = _client_settings(configur)
+      if _configured is None:
+        configure(configur)
+      elif settings != _configured:
+        raise ValueError("the client settings differ from those already applied, "
+                         "which all clients share; call photoapp_client.configure() to change them")
+
+  @classmethod
+  def from_config(cls, config_file='photoapp-client-config.ini'):
+    """
+    Creates a client for the web service named in a config file.
+    """
+
+    configur, baseurl = read_config(config_file)
+    return cls(baseurl, configur)
+
+  def stats(self):
+    """
+    Returns the service's stats: dict with keys message, s3_status,
+    db_numUsers and db_numAssets.
+    """
+    return photoapp_api.get_stats(self.baseurl)
+
+  def users(self):
+    """
+    Returns the list of User objects.
+    """
+    return photoapp_api.get_users(self.baseurl)
+
+  def assets(self):
+    """
+    Returns the list of Asset objects.
+    """
+    return photoapp_api.get_assets(self.baseurl)
+
+  def iter_users(self, page_size=photoapp_api.DEFAULT_PAGE_SIZE):
+    """
+    Generates the User objects a page at a time, in constant memory.
+    """
+    return photoapp_api.iter_users(self.baseurl, page_size)
+
+  def iter_assets(self, page_size=photoapp_api.DEFAULT_PAGE_SIZE):
+    """
+    Generates the Asset objects a page at a time, in constant memory.
+    """
+    return photoapp_api.iter_assets(self.baseurl, page_size)
+
+  def download(self, assetid, filename=None, use_cache=True):
+    """
+    Downloads an asset to filename (default: the asset's name);
+    returns a dict describing the download, see
+    photoapp_api.download_image.
+    """
+    return photoapp_api.download_image(self.baseurl, assetid, filename, use_cache=use_cache)
+
+  def bucket(self, startafter=None, prefix=None):
+    """
+    Generates the BucketItem objects of the whole bucket (or of
+    the keys starting with prefix), following the pages.
+    """
+    return photoapp_api.iter_bucket(self.baseurl, startafter, prefix)
+
+  def bucket_page(self, startafter=None, prefix=None):
+    """
+    Returns one page of the bucket as a list of BucketItem objects.
+    """
+    return photoapp_api.get_bucket_page(self.baseurl, startafter, prefix)
+
+  def upload(self, userid, filename, assetname=None, force=False, transform=None):
+    """
+    Uploads a local file for a user, unless the user uploaded the
+    same contents before (and not force), applying the configured
+    ImageTransform unless another is given; returns a dict with
+    keys asset_id, size, sha256, duplicate, sent_bytes and
+    transform_seconds.
+    """
+    return photoapp_api.upload_image(self.baseurl, userid, filename, assetname, force, transform)
+
+  def add_user(self, email, lastname, firstname, bucketfolder=None):
+    """
+    Adds or updates a user; returns (user_id, message) where
+    message is 'inserted' or 'updated'.
+    """
+    if bucketfolder is None:
+      bucketfolder = str(uuid.uuid4())
+    return photoapp_api.put_user(self.baseurl, email, lastname, firstname, bucketfolder)
+
+  def labels(self, assetid, use_cache=True):
+    """
+    Analyzes an asset; returns (asset_name, labels) where labels is
+    a list of dicts with keys name and confidence.
+    """
+    return photoapp_api.get_labels(self.baseurl, assetid, use_cache)
+
+  def search(self, label, use_cache=True):
+    """
+    Returns the analyzed assets having a label, as a list of dicts
+    with keys asset_id and confidence.
+    """
+    return photoapp_api.search_images(self.baseurl, label, use_cache)
+
+  def query(self, expression, min_confidence=0):
+    """
+    Searches the local label index (no web service call); returns
+    the sorted list of matching asset ids, see photoapp_index.
+    """
+    return photoapp_index.get_label_index(self.baseurl).query(expression, min_confidence)
+
+  def metrics(self):
+    """
+    Returns the latency, status, retry and byte counts of the calls
+    made so far, per endpoint; see photoapp_metrics.
+    """
+    return photoapp_metrics.get_metrics().snapshot()
+
+  def close(self):
+    """
+    Saves the label index and closes the pooled connections.
+    """
+    photoapp_index.save_index()
+    photoapp_web.close_session()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc_info):
+    self.close()
+
+
+###################################################################
+#
+# AsyncPhotoAppClient
+#
+def _asyncio():
+  """
+  The asyncio module, imported on first use: it is slow to import
+  and only needed by the async client (whose caller has already
+  imported it anyway).
+  """
+  import asyncio
+  return asyncio
+
+
+class AsyncPhotoAppClient:
+  """
+  asyncio client with the methods of PhotoAppClient as coroutines.
+  Each call runs on a bounded thread pool (concurrency threads,
+  by default the session's pool_maxsize), so any number of calls
+  can be awaited together from one event loop while at most
+  `concurrency` are on the wire at once, each on a pooled
+  keep-alive connection.
+  """
+
+  def __init__(self, baseurl, configur=None, concurrency=None):
+    """
+    baseurl: baseurl for web service
+    configur: optional ConfigParser with [client] settings
+    concurrency: max # of calls in flight
+    """
+
+    import concurrent.futures  # not needed by the sync client
+
+    self.client = PhotoAppClient(baseurl, configur)
+
+    if concurrency is None:
+      if configur is None:
+        configur = ConfigParser()
+      concurrency = configur.getint('client', 'pool_maxsize',
+                                    fallback=photoapp_web.DEFAULT_POOL_MAXSIZE)
+
+    self.executor = concurrent.futures.ThreadPoolExecutor(
+      max_workers=concurrency, thread_name_prefix="photoapp")
+
+  @classmethod
+  def from_config(cls, config_file='photoapp-client-config.ini', concurrency=None):
+    configur, baseurl = read_config(config_file)
+    return cls(baseurl, configur, concurrency)
+
+  @property
+  def baseurl(self):
+    return self.client.baseurl
+
+  async def _run(self, func, *args, **kwargs):
+    loop = _asyncio().get_running_loop()
+    return await loop.run_in_executor(self.executor, lambda: func(*args, **kwargs))
+
+  async def stats(self):
+    return await self._run(self.client.stats)
+
+  async def users(self):
+    return await self._run(self.client.users)
+
+  async def assets(self):
+    return await self._run(self.client.assets)
+
+  async def download(self, assetid, filename=None, use_cache=True):
+    return await self._run(self.client.download, assetid, filename, use_cache)
+
+  async def bucket(self, startafter=None, prefix=None):
+    """
+    Asynchronously generates the BucketItem objects of the bucket.
+    """
+
+    asyncio = _asyncio()
+    loop = asyncio.get_running_loop()
+
+    pages = photoapp_api.iter_bucket_pages(self.baseurl, startafter, prefix)
+    pending = None  # the next() running in the executor, if any
+    try:
+      while True:
+        #
+        # shielded, so cancelling the caller leaves next() running
+        # to completion rather than abandoned mid-call:
+        #
+        pending = loop.run_in_executor(self.executor, next, pages, None)
+        page = await asyncio.shield(pending)
+        pending = None
+        if page is None:
+          break
+        for item in page:
+          yield item
+    finally:
+      #
+      # a generator cannot be closed while it is executing, so wait
+      # for the pending next() first:
+      #
+      if pending is not None:
+        try:
+          await pending
+        except BaseException:
+          pass
+      await self._run(pages.close)
+
+  async def bucket_page(self, startafter=None, prefix=None):
+    return await self._run(self.client.bucket_page, startafter, prefix)
+
+  async def upload(self, userid, filename, assetname=None, force=False, transform=None):
+    return await self._run(self.client.upload, userid, filename, assetname, force, transform)
+
+  async def add_user(self, email, lastname, firstname, bucketfolder=None):
+    return await self._run(self.client.add_user, email, lastname, firstname, bucketfolder)
+
+  async def labels(self, assetid, use_cache=True):
+    return await self._run(self.client.labels, assetid, use_cache)
+
+  async def search(self, label, use_cache=True):
+    return await self._run(self.client.search, label, use_cache)
+
+  async def query(self, expression, min_confidence=0):
+    return self.client.query(expression, min_confidence)
+
+  def metrics(self):
+    return self.client.metrics()
+
+  async def close(self):
+    """
+    Waits for calls in flight, then closes the client.
+    """
+    await _asyncio().get_running_loop().run_in_executor(None, self.executor.shutdown)
+    self.client.close()
+
+  async def __aenter__(self):
+    return self
+
+  async def __aexit__(self, *exc_info):
+    await self.close()
@@ -0,0 +1,633 @@
+#
+# photoapp_index.py
+#
+# Local inverted index of asset labels, so label searches can be
+# answered offline: label => sorted asset ids, each with the
+# confidence of that label. The index is built from /labels
+# results (every get_labels() call adds the asset it analyzed)
+# and supports queries such as
+#
+#   dog AND NOT cat
+#   (beach OR ocean) AND person>=90
+#   golden*                          prefix match
+#   "golden retriever"               labels with spaces
+#
+# Matching is case-insensitive. Postings are kept in compact
+# arrays so an index over millions of assets stays small. Queries
+# are evaluated on bitmaps, Python ints with bit i set if asset i
+# matches (asset ids are the database's small, dense integers), so
+# AND, OR and NOT are each one operation on the whole index; only
+# the final bitmap is turned into asset ids. A label's bitmap is
+# built on its first use and then kept up to date by add(). There
+# is one index per web service, since asset ids are only unique
+# within one; all of them are saved to one JSON file between runs.
+#
+# Configured from the [client] section of the client config:
+#
+#   label_index_file = .photoapp-cache/label-index.json
+#
+# Authors:
+#
+#   Neo Trovela-Villamiel
+#
+
+import array
+import base64
+import bisect
+import itertools
+import json
+import os
+import pathlib
+import re
+import threading
+
+from configparser import ConfigParser
+
+
+DEFAULT_INDEX_FILE = '.photoapp-cache/label-index.json'
+
+INDEX_FORMAT = 2  # 1 had a single index, not one per web service
+
+MAX_BITMAPS = 256  # labels whose bitmaps are kept, least recently used dropped first
+
+
+###################################################################
+#
+# LabelIndex
+#
+class LabelIndex:
+  """
+  In-memory inverted index label => (sorted asset ids, confidences).
+  """
+
+  def __init__(self):
+    self.postings = {}   # label.lower() => (array of ids, array of confidences)
+    self.names = {}      # label.lower() => label as Rekognition spells it
+    self.sorted_labels = None  # sorted keys, for prefix matching; None = stale
+    self.assets = array.array('i')  # sorted ids of all indexed assets
+    self.bitmaps = {}    # label.lower() => {min_confidence: bitmap}, least recently used first
+    self.all_bitmap = None  # bitmap of self.assets; None = not built yet
+    self.id_list = None  # [0, 1, 2, ...], for turning dense bitmaps into ids
+    self.modified = False
+    self.lock = threading.Lock()
+
+  def add(self, assetid, labels):
+    """
+    Adds (or updates) the labels of one analyzed asset.
+
+    Parameters
+    ----------
+    assetid: the asset
+    labels: list of dicts with keys name and confidence, as
+            returned by /labels/:assetid
+
+    Returns
+    -------
+    nothing
+    """
+
+    assetid = int(assetid)
+    bit = 1 << assetid
+
+    with self.lock:
+      changed = _insert(self.assets, assetid)
+      if self.all_bitmap is not None:
+        self.all_bitmap |= bit
+
+      for label in labels:
+        key = label['name'].lower()
+        confidence = max(0, min(100, int(label['confidence'])))
+
+        if key not in self.postings:
+          self.postings[key] = (array.array('i'), array.array('B'))
+          self.names[key] = label['name']
+          self.sorted_labels = None
+
+        ids, confidences = self.postings[key]
+        i = bisect.bisect_left(ids, assetid)
+        if i < len(ids) and ids[i] == assetid:
+          if confidences[i] == confidence:
+            continue
+          confidences[i] = confidence
+        else:
+          ids.insert(i, assetid)
+          confidences.insert(i, confidence)
+        changed = True
+
+        # the label's bitmaps, if built, must agree with its postings:
+        cached = self.bitmaps.get(key)
+        if cached is not None:
+          for threshold, bitmap in cached.items():
+            cached[threshold] = (bitmap | bit) if confidence >= threshold else (bitmap & ~bit)
+
+      # re-adding an asset that is already indexed changes nothing,
+      # and does not force the index to be saved again:
+      self.modified = self.modified or changed
+
+  def __contains__(self, assetid):
+    """
+    True if the asset has been analyzed (added to the index).
+    """
+
+    assetid = int(assetid)
+    with self.lock:
+      i = bisect.bisect_left(self.assets, assetid)
+      return i < len(self.assets) and self.assets[i] == assetid
+
+  def _labels_matching(self, term):
+    """
+    Returns the keys of the labels a term refers to: the label
+    itself, or all labels starting with a prefix ending in *.
+    """
+
+    if not term.endswith('*'):
+      return [term] if term in self.postings else []
+
+    prefix = term[:-1]
+    if self.sorted_labels is None:
+      self.sorted_labels = sorted(self.postings)
+
+    start = bisect.bisect_left(self.sorted_labels, prefix)
+    matches = []
+    for key in self.sorted_labels[start:]:
+      if not key.startswith(prefix):
+        break
+      matches.append(key)
+    return matches
+
+  def bitmap(self, term, min_confidence=0):
+    """
+    Returns the bitmap of the assets having a label (or any label
+    with a prefix, if term ends with *) with at least min_confidence.
+    Caller holds self.lock.
+    """
+
+    result = 0
+    min_confidence = max(0, min_confidence)
+
+    for key in self._labels_matching(term.lower()):
+      cached = self.bitmaps.pop(key, None)
+      if cached is None:
+        cached = {}
+        if len(self.bitmaps) >= MAX_BITMAPS:
+          del self.bitmaps[next(iter(self.bitmaps))]
+      self.bitmaps[key] = cached  # now the most recently used
+
+      if min_confidence not in cached:
+        ids, confidences = self.postings[key]
+        if min_confidence > 0:
+          ids = itertools.compress(ids, map(min_confidence.__le__, confidences))
+        cached[min_confidence] = _to_bitmap(ids, self.assets[-1] + 1)
+
+      result |= cached[min_confidence]
+
+    return result
+
+  def all_assets(self):
+    """
+    Returns the bitmap of all indexed assets. Caller holds self.lock.
+    """
+
+    if self.all_bitmap is None:
+      self.all_bitmap = _to_bitmap(self.assets, self.assets[-1] + 1 if self.assets else 0)
+    return self.all_bitmap
+
+  def candidates(self, term):
+    """
+    Returns the sorted ids of the one label a term refers to, which
+    hold the assets having it at any confidence; None if the term
+    refers to no label or several. Caller holds self.lock.
+    """
+
+    keys = self._labels_matching(term.lower())
+    return self.postings[keys[0]][0] if len(keys) == 1 else None
+
+  def to_ids(self, bitmap, candidates=None):
+    """
+    Returns the sorted list of asset ids in a bitmap. Caller holds
+    self.lock.
+
+    Parameters
+    ----------
+    bitmap: the bitmap
+    candidates: sorted array of ids known to hold all of them (e.g.
+                the postings of a label ANDed in), or None
+
+    Returns
+    -------
+    sorted list of asset ids
+    """
+
+    count = bitmap.bit_count()
+    size = bitmap.bit_length()
+
+    if count == 0:
+      return []
+    if candidates is not None and len(candidates) == count:
+      return candidates.tolist()
+
+    if count * _SPARSE < size:
+      # few ids: visit the nonzero 64-bit words only
+      words = array.array('Q', bitmap.to_bytes((size + 63) // 64 * 8, 'little'))
+      if _BYTEORDER != 'little':
+        words.byteswap()
+      ids = []
+      for i in itertools.compress(range(len(words)), words):
+        word = words[i]
+        while word:
+          low = word & -word
+          ids.append(i * 64 + low.bit_length() - 1)
+          word ^= low
+      return ids
+
+    # many ids: one byte per bit, selecting from the candidates if
+    # they are few, else from [0, 1, 2, ...], whose ints are made once
+    mask = format(bitmap, 'b').encode()[::-1].translate(_FROM_ASCII)
+
+    if candidates is not None and len(candidates) * _SPARSE_CANDIDATES < size:
+      candidates = candidates[:bisect.bisect_left(candidates, size)].tolist()
+      return list(itertools.compress(candidates, map(mask.__getitem__, candidates)))
+
+    if self.id_list is None or len(self.id_list) < size:
+      self.id_list = list(range(size))
+    return list(itertools.compress(self.id_list, mask))
+
+  def lookup(self, term, min_confidence=0):
+    """
+    Returns the sorted list of asset ids having a label (or any label
+    with a prefix, if term ends with *) with at least min_confidence.
+    """
+
+    with self.lock:
+      return self.to_ids(self.bitmap(term, min_confidence), self.candidates(term))
+
+  def query(self, expression, min_confidence=0):
+    """
+    Evaluates a query: label terms combined with AND, OR, NOT and
+    parentheses; adjacent terms mean AND. A term may end with *
+    (prefix match) and/or >=N (its own confidence threshold), and
+    may be quoted if the label contains spaces.
+
+    Parameters
+    ----------
+    expression: the query, e.g. 'dog AND NOT cat'
+    min_confidence: threshold for terms without their own
+
+    Returns
+    -------
+    sorted list of matching asset ids
+    """
+
+    with self.lock:
+      parser = _QueryParser(expression, self, min_confidence)
+      return self.to_ids(*parser.parse())
+
+  def count(self, expression, min_confidence=0):
+    """
+    Returns the # of assets matching a query, see query(); cheaper
+    than len(query(...)) since no ids are made.
+    """
+
+    with self.lock:
+      parser = _QueryParser(expression, self, min_confidence)
+      bitmap, _ = parser.parse()
+      return bitmap.bit_count()
+
+  def stats(self):
+    with self.lock:
+      return {
+        "assets": len(self.assets),
+        "labels": len(self.postings),
+        "postings": sum(len(ids) for ids, _ in self.postings.values())
+      }
+
+  def labels(self):
+    """
+    Returns (label, # of assets) for every label, most common first.
+    """
+
+    with self.lock:
+      counts = [(self.names[key], len(ids)) for key, (ids, _) in self.postings.items()]
+    return sorted(counts, key=lambda lc: (-lc[1], lc[0].lower()))
+
+  def to_json(self):
+    """
+    Returns the index as a JSON-ready dict, see save_indexes().
+    """
+
+    with self.lock:
+      self.modified = False
+      return {
+        "assets": _encode(self.assets),
+        "labels": {
+          key: [self.names[key], _encode(ids), _encode(confidences)]
+          for key, (ids, confidences) in self.postings.items()
+        }
+      }
+
+  @staticmethod
+  def from_json(data, swap=False):
+    """
+    Returns the index to_json() returned, its arrays byte-swapped
+    if written on a machine of the other byte order.
+    """
+
+    index = LabelIndex()
+    index.assets = _decode('i', data["assets"], swap)
+    for key, (name, ids, confidences) in data["labels"].items():
+      index.postings[key] = (_decode('i', ids, swap), _decode('B', confidences, swap))
+      index.names[key] = name
+
+    return index
+
+
+def save_indexes(filename, indexes):
+  """
+  Writes the indexes (dict baseurl => LabelIndex) to a JSON file,
+  via a temporary file so an interrupted save does not destroy the
+  previous one.
+  """
+
+  data = {
+    "format": INDEX_FORMAT,
+    "byteorder": _BYTEORDER,
+    "services": {baseurl: index.to_json() for baseurl, index in indexes.items()}
+  }
+
+  path = pathlib.Path(filename)
+  path.parent.mkdir(parents=True, exist_ok=True)
+  tmp = path.with_name(path.name + '.part')
+  with open(tmp, 'w') as outfile:
+    json.dump(data, outfile)
+  os.replace(tmp, path)
+
+
+def load_indexes(filename):
+  """
+  Reads the indexes written by save_indexes(). A file of format 1
+  does not say which web service its asset ids belong to, so it
+  is ignored (index-rebuild recreates an index from the label
+  cache).
+  """
+
+  with open(filename, 'r') as infile:
+    data = json.load(infile)
+
+  if data.get("format") == 1:
+    return {}
+  if data.get("format") != INDEX_FORMAT:
+    raise ValueError(f"label index '{filename}' has an unknown format")
+
+  swap = data["byteorder"] != _BYTEORDER
+  return {baseurl: LabelIndex.from_json(index, swap) for baseurl, index in data["services"].items()}
+
+
+def _to_bitmap(ids, size):
+  """
+  Returns the bitmap of ids (all < size): set one byte per id, then
+  let int() parse the bytes as binary digits.
+  """
+  mask = bytearray(size)
+  for assetid in ids:
+    mask[assetid] = 1
+  return int(mask.translate(_TO_ASCII)[::-1] or b'0', 2)
+
+
+_TO_ASCII = bytes.maketrans(b'\x00\x01', b'01')
+_FROM_ASCII = bytes.maketrans(b'01', b'\x00\x01')
+
+# a bitmap with fewer than 1 in _SPARSE bits set is turned into ids
+# word by word, otherwise byte by byte, looking up only the
+# candidates if there are fewer than 1 in _SPARSE_CANDIDATES:
+_SPARSE = 32
+_SPARSE_CANDIDATES = 10
+
+
+def _insert(ids, assetid):
+  """
+  Inserts assetid into the sorted array ids unless already there,
+  returning True if it was inserted.
+  """
+  i = bisect.bisect_left(ids, assetid)
+  if i < len(ids) and ids[i] == assetid:
+    return False
+  ids.insert(i, assetid)
+  return True
+
+
+_BYTEORDER = 'little' if array.array('i', [1]).tobytes()[0] == 1 else 'big'
+
+
+def _encode(values):
+  return base64.b64encode(values.tobytes()).decode()
+
+
+def _decode(typecode, text, swap):
+  values = array.array(typecode)
+  values.frombytes(base64.b64decode(text))
+  if swap:
+    values.byteswap()
+  return values
+
+
+###################################################################
+#
+# query parsing
+#
+_TOKEN = re.compile(r'\s*(\(|\)|"[^"]*"[^\s()]*|[^\s()]+)')
+_THRESHOLD = re.compile(r'^(.*?)>=(\d+)$')
+
+
+class _QueryParser:
+  """
+  Recursive-descent evaluator for
+    expr := term_and ('OR' term_and)*
+    term_and := unary (['AND'] unary)*
+    unary := 'NOT' unary | '(' expr ')' | LABEL
+  Each returns (bitmap of the matching assets, sorted array of ids
+  known to hold them or None), see LabelIndex.to_ids().
+  """
+
+  def __init__(self, expression, index, min_confidence):
+    self.tokens = []
+    pos = 0
+    expression = expression.strip()
+    while pos < len(expression):
+      match = _TOKEN.match(expression, pos)
+      if match is None:
+        raise ValueError(f"cannot parse query at: {expression[pos:]!r}")
+      self.tokens.append(match.group(1))
+      pos = match.end()
+      while pos < len(expression) and expression[pos].isspace():
+        pos += 1
+
+    self.pos = 0
+    self.index = index
+    self.min_confidence = min_confidence
+
+  def peek(self):
+    return self.tokens[self.pos] if self.pos < len(self.tokens) else None
+
+  def take(self):
+    token = self.peek()
+    self.pos += 1
+    return token
+
+  def parse(self):
+    if not self.tokens:
+      raise ValueError("empty query")
+    result = self.expr()
+    if self.peek() is not None:
+      raise ValueError(f"unexpected {self.peek()!r} in query")
+    return result
+
+  def expr(self):
+    result, candidates = self.term_and()
+    while self.peek() == 'OR':
+      self.take()
+      result |= self.term_and()[0]
+      candidates = None
+    return result, candidates
+
+  def term_and(self):
+    # NOT operands are masked out of the other operands, so that the
+    # bitmap of all assets is only needed for a query like 'NOT cat':
+    included = None
+    excluded = 0
+    candidates = None
+
+    while True:
+      if self.peek() == 'NOT':
+        self.take()
+        excluded |= self.unary()[0]
+      else:
+        bitmap, ids = self.unary()
+        included = bitmap if included is None else included & bitmap
+        if ids is not None and (candidates is None or len(ids) < len(candidates)):
+          candidates = ids
+
+      if self.peek() in (None, 'OR', ')'):
+        break
+      if self.peek() == 'AND':
+        self.take()
+
+    if included is None:
+      included = self.index.all_assets()
+
+    return (included & ~excluded if excluded else included), candidates
+
+  def unary(self):
+    token = self.take()
+
+    if token is None:
+      raise ValueError("query ends unexpectedly")
+
+    if token == 'NOT':
+      return self.index.all_assets() & ~self.unary()[0], None
+
+    if token == '(':
+      result = self.expr()
+      if self.take() != ')':
+        raise ValueError("missing ) in query")
+      return result
+
+    if token in (')', 'AND', 'OR'):
+      raise ValueError(f"unexpected {token!r} in query")
+
+    min_confidence = self.min_confidence
+    match = _THRESHOLD.match(token)
+    if match is not None:
+      token = match.group(1)
+      min_confidence = int(match.group(2))
+
+    if token.startswith('"'):
+      closing = token.index('"', 1)
+      token = token[1:closing] + token[closing + 1:]
+
+    return self.index.bitmap(token, min_confidence), self.index.candidates(token)
+
+
+###################################################################
+#
+# the index maintained by photoapp_api
+#
+_index_file = DEFAULT_INDEX_FILE
+_label_indexes = None  # baseurl => LabelIndex, None = not loaded yet
+_index_lock = threading.Lock()
+
+
+def configure_index(configur=None):
+  """
+  Sets the file the label indexes are loaded from and saved to,
+  from the [client] section of the config (label_index_file); an
+  empty value keeps them in memory only.
+
+  Parameters
+  ----------
+  configur: ConfigParser with the client config, or None for defaults
+
+  Returns
+  -------
+  nothing
+  """
+
+  global _index_file, _label_indexes
+
+  if configur is None:
+    configur = ConfigParser()
+
+  with _index_lock:
+    _index_file = configur.get('client', 'label_index_file', fallback=DEFAULT_INDEX_FILE)
+    _label_indexes = None
+
+
+def _loaded():
+  """
+  The indexes, loaded from their file on first use. Caller holds
+  _index_lock.
+  """
+
+  global _label_indexes
+
+  if _label_indexes is None:
+    if _index_file and pathlib.Path(_index_file).is_file():
+      _label_indexes = load_indexes(_index_file)
+    else:
+      _label_indexes = {}
+
+  return _label_indexes
+
+
+def get_label_index(baseurl):
+  """
+  Returns the label index of the web service at baseurl.
+  """
+
+  with _index_lock:
+    indexes = _loaded()
+    if baseurl not in indexes:
+      indexes[baseurl] = LabelIndex()
+    return indexes[baseurl]
+
+
+def set_label_index(baseurl, index):
+  """
+  Replaces the label index of a web service, e.g. with one rebuilt
+  from scratch; it is saved by the next save_index().
+  """
+
+  index.modified = True
+  with _index_lock:
+    _loaded()[baseurl] = index
+
+
+def save_index():
+  """
+  Saves the label indexes to their file if any was changed.
+  """
+
+  with _index_lock:
+    indexes = dict(_label_indexes) if _label_indexes is not None else {}
+
+  if _index_file and any(index.modified for index in indexes.values()):
+    save_indexes(_index_file, indexes)
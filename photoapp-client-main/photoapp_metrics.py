@@ -0,0 +1,386 @@
+#
+# photoapp_metrics.py
+#
+# Instrumentation of the client's web service calls. Every call
+# made through photoapp_web.web_service_call is recorded per
+# endpoint (method + path with ids replaced, e.g. GET /image/:id):
+# latency, status code, # of retries and bytes sent and received
+# (as on the wire, i.e. compressed); the base64 encoding of uploads,
+# decoding of downloads and gzipping of request bodies
+# (photoapp_stream) is timed as well. Latencies go into fixed-bucket
+# histograms, so recording costs a few additions and memory does
+# not grow with the # of calls.
+#
+# The metrics of the running process are shown by the `metrics`
+# command (python main.py batch ..., or the library), and can be
+# exported as Prometheus text or as JSON lines. Configured from
+# the [client] section of the client config:
+#
+#   metrics = true      # false turns recording off
+#   metrics_file =      # JSON lines file a snapshot is appended
+#                       # to when the client exits
+#
+# Authors:
+#
+#   Neo Trovela-Villamiel
+#
+
+import bisect
+import json
+import threading
+import time
+import urllib.parse
+
+from configparser import ConfigParser
+
+
+# upper bounds (seconds) of the latency histogram buckets, as in
+# Prometheus client libraries; the last bucket is +Inf:
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+PROMETHEUS_PREFIX = 'photoapp_client'
+
+
+###################################################################
+#
+# Histogram
+#
+class Histogram:
+  """
+  Counts of observations per bucket, plus their sum, min and max.
+  Not thread-safe by itself; Metrics holds a lock.
+  """
+
+  __slots__ = ('bounds', 'counts', 'count', 'sum', 'min', 'max')
+
+  def __init__(self, bounds=LATENCY_BUCKETS):
+    self.bounds = bounds
+    self.counts = [0] * (len(bounds) + 1)
+    self.count = 0
+    self.sum = 0.0
+    self.min = None
+    self.max = None
+
+  def observe(self, value):
+    self.counts[bisect.bisect_left(self.bounds, value)] += 1
+    self.count += 1
+    self.sum += value
+    if self.min is None or value < self.min:
+      self.min = value
+    if self.max is None or value > self.max:
+      self.max = value
+
+  def quantile(self, q):
+    """
+    Estimates the q-quantile (0 <= q <= 1) by interpolating within
+    its bucket, as Prometheus' histogram_quantile() does; exact for
+    the min and max.
+    """
+
+    if self.count == 0:
+      return None
+
+    rank = q * self.count
+    cumulative = 0
+    for i, n in enumerate(self.counts):
+      if n > 0 and cumulative + n >= rank:
+        lower = self.bounds[i - 1] if i > 0 else 0.0
+        upper = self.bounds[i] if i < len(self.bounds) else self.max
+        lower = max(lower, self.min)
+        upper = min(upper, self.max)
+        return lower + (upper - lower) * (rank - cumulative) / n
+      cumulative += n
+
+    return self.max
+
+  def summary(self):
+    """
+    Returns count, mean, p50, p95, p99 and max in milliseconds.
+    """
+
+    if self.count == 0:
+      return {"count": 0}
+
+    def ms(seconds):
+      return round(seconds * 1000, 2)
+
+    return {
+      "count": self.count,
+      "mean_ms": ms(self.sum / self.count),
+      "p50_ms": ms(self.quantile(0.50)),
+      "p95_ms": ms(self.quantile(0.95)),
+      "p99_ms": ms(self.quantile(0.99)),
+      "max_ms": ms(self.max)
+    }
+
+
+###################################################################
+#
+# Metrics
+#
+class CallStats:
+  """
+  What was recorded for one endpoint.
+  """
+
+  __slots__ = ('latency', 'statuses', 'errors', 'retries', 'bytes_sent', 'bytes_received')
+
+  def __init__(self):
+    self.latency = Histogram()
+    self.statuses = {}     # status code => # of calls; 0 = no response
+    self.errors = 0        # calls that did not end with 200 or 304
+    self.retries = 0
+    self.bytes_sent = 0
+    self.bytes_received = 0
+
+
+class Metrics:
+  """
+  Thread-safe registry of the metrics of web service calls and of
+  base64 encoding/decoding and compression of request bodies.
+  """
+
+  def __init__(self):
+    self.lock = threading.Lock()
+    self.started = time.time()
+    self.calls = {}   # (method, endpoint) => CallStats
+    self.codecs = {}  # operation => [Histogram of seconds, bytes]
+
+  def record_call(self, method, url, status, seconds, retries=0, bytes_sent=0, bytes_received=0):
+    """
+    Records one web service call (all its attempts).
+
+    Parameters
+    ----------
+    method: 'GET', 'PUT' or 'POST'
+    url: the url called
+    status: status code of the final response, 0 if none
+    seconds: time until the final response (its headers, if the
+             body is streamed) or failure
+    retries: # of attempts after the first
+    bytes_sent: size of the request body, as sent
+    bytes_received: size of the response body as received, if known
+
+    Returns
+    -------
+    nothing
+    """
+
+    key = (method, endpoint_of(url))
+
+    with self.lock:
+      stats = self.calls.get(key)
+      if stats is None:
+        stats = self.calls[key] = CallStats()
+
+      stats.latency.observe(seconds)
+      stats.statuses[status] = stats.statuses.get(status, 0) + 1
+      if status not in (200, 304):
+        stats.errors += 1
+      stats.retries += retries
+      stats.bytes_sent += bytes_sent
+      stats.bytes_received += bytes_received
+
+  def record_codec(self, operation, seconds, nbytes):
+    """
+    Records time spent on e.g. 'base64_encode' or 'gzip_compress'
+    of nbytes of data.
+    """
+
+    with self.lock:
+      codec = self.codecs.get(operation)
+      if codec is None:
+        codec = self.codecs[operation] = [Histogram(), 0]
+      codec[0].observe(seconds)
+      codec[1] += nbytes
+
+  def reset(self):
+    with self.lock:
+      self.started = time.time()
+      self.calls = {}
+      self.codecs = {}
+
+  def snapshot(self):
+    """
+    Returns the metrics as JSON-ready dicts: {"calls": [one per
+    endpoint], "codecs": [one per operation]}.
+    """
+
+    with self.lock:
+      elapsed = max(time.time() - self.started, 1e-9)
+      calls = []
+      for (method, endpoint), stats in sorted(self.calls.items(), key=lambda kv: kv[0][::-1]):
+        calls.append({
+          "method": method,
+          "endpoint": endpoint,
+          "calls": stats.latency.count,
+          "calls_per_sec": round(stats.latency.count / elapsed, 3),
+          "errors": stats.errors,
+          "statuses": {str(status): n for status, n in sorted(stats.statuses.items())},
+          "retries": stats.retries,
+          "bytes_sent": stats.bytes_sent,
+          "bytes_received": stats.bytes_received,
+          "latency": stats.latency.summary()
+        })
+
+      codecs = []
+      for operation, (histogram, nbytes) in sorted(self.codecs.items()):
+        codecs.append({
+          "operation": operation,
+          "calls": histogram.count,
+          "bytes": nbytes,
+          "seconds": round(histogram.sum, 4),
+          "mb_per_sec": round(nbytes / max(histogram.sum, 1e-9) / 1e6, 1)
+        })
+
+      return {"since": round(self.started, 3), "seconds": round(elapsed, 3),
+              "calls": calls, "codecs": codecs}
+
+  def to_json_lines(self):
+    """
+    Returns the metrics as JSON lines: one object per endpoint and
+    per codec operation, each with a "type" and a timestamp.
+    """
+
+    snapshot = self.snapshot()
+    now = round(time.time(), 3)
+    lines = [json.dumps({"type": "call", "time": now, **call}) for call in snapshot["calls"]]
+    lines += [json.dumps({"type": "codec", "time": now, **codec}) for codec in snapshot["codecs"]]
+    return "".join(line + "\n" for line in lines)
+
+  def to_prometheus(self):
+    """
+    Returns the metrics in the Prometheus text exposition format.
+    """
+
+    p = PROMETHEUS_PREFIX
+    out = []
+
+    def family(name, kind, help):
+      out.append(f"# HELP {p}_{name} {help}")
+      out.append(f"# TYPE {p}_{name} {kind}")
+
+    with self.lock:
+      calls = sorted(self.calls.items())
+      codecs = sorted((op, h.count, h.sum, n) for op, (h, n) in self.codecs.items())
+
+      family("request_duration_seconds", "histogram", "Latency of web service calls, including retries.")
+      for (method, endpoint), stats in calls:
+        labels = f'method="{method}",endpoint="{_escape(endpoint)}"'
+        h = stats.latency
+        cumulative = 0
+        for bound, n in zip(h.bounds + (float('inf'),), h.counts):
+          cumulative += n
+          le = "+Inf" if bound == float('inf') else repr(bound)
+          out.append(f'{p}_request_duration_seconds_bucket{{{labels},le="{le}"}} {cumulative}')
+        out.append(f'{p}_request_duration_seconds_sum{{{labels}}} {h.sum!r}')
+        out.append(f'{p}_request_duration_seconds_count{{{labels}}} {h.count}')
+
+      family("requests_total", "counter", "Web service calls by final status code (0 = no response).")
+      for (method, endpoint), stats in calls:
+        for status, n in sorted(stats.statuses.items()):
+          out.append(f'{p}_requests_total{{method="{method}",endpoint="{_escape(endpoint)}",status="{status}"}} {n}')
+
+      for name, attr, help in [("retries_total", "retries", "Retried attempts of web service calls."),
+                               ("request_bytes_total", "bytes_sent", "Bytes of request bodies sent."),
+                               ("response_bytes_total", "bytes_received", "Bytes of response bodies received.")]:
+        family(name, "counter", help)
+        for (method, endpoint), stats in calls:
+          out.append(f'{p}_{name}{{method="{method}",endpoint="{_escape(endpoint)}"}} {getattr(stats, attr)}')
+
+      family("codec_seconds_total", "counter", "Seconds spent base64 encoding uploads, decoding downloads and gzipping request bodies.")
+      for operation, count, seconds, nbytes in codecs:
+        out.append(f'{p}_codec_seconds_total{{operation="{operation}"}} {seconds!r}')
+      family("codec_bytes_total", "counter", "Bytes base64 encoded or decoded, or gzipped.")
+      for operation, count, seconds, nbytes in codecs:
+        out.append(f'{p}_codec_bytes_total{{operation="{operation}"}} {nbytes}')
+
+    return "\n".join(out) + "\n"
+
+
+def _escape(value):
+  return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def endpoint_of(url):
+  """
+  The endpoint a url calls, with the ids in its path replaced so
+  calls aggregate: http://host/image/1001 => /image/:id,
+  http://host/images/dog => /images/:label,
+  http://host/users?limit=10 => /users,
+  http://host/uploads/ab12/complete => /uploads/:id/complete.
+  """
+
+  parts = urllib.parse.urlsplit(url).path.split('/')[1:]
+  if not parts or parts == ['']:
+    return '/'
+  if len(parts) == 1:
+    return '/' + parts[0]
+  return '/' + parts[0] + ('/:label' if parts[0] == 'images' else '/:id') + ''.join('/' + part for part in parts[2:])
+
+
+###################################################################
+#
+# the metrics of this process
+#
+_metrics = Metrics()
+_enabled = True
+_metrics_file = None
+
+
+def configure_metrics(configur=None):
+  """
+  Turns recording on or off and sets the file a snapshot is
+  appended to at exit, from the [client] section of the config
+  (metrics, metrics_file).
+
+  Parameters
+  ----------
+  configur: ConfigParser with the client config, or None for defaults
+
+  Returns
+  -------
+  nothing
+  """
+
+  global _enabled, _metrics_file
+
+  if configur is None:
+    configur = ConfigParser()
+
+  _enabled = configur.getboolean('client', 'metrics', fallback=True)
+  _metrics_file = configur.get('client', 'metrics_file', fallback='') or None
+
+
+def get_metrics():
+  """
+  Returns the Metrics of this process.
+  """
+  return _metrics
+
+
+def record_call(method, url, status, seconds, retries=0, bytes_sent=0, bytes_received=0):
+  if _enabled:
+    _metrics.record_call(method, url, status, seconds, retries, bytes_sent, bytes_received)
+
+
+def record_codec(operation, seconds, nbytes):
+  if _enabled:
+    _metrics.record_codec(operation, seconds, nbytes)
+
+
+def save_metrics(command=None):
+  """
+  Appends a snapshot of the metrics to the configured metrics_file
+  as one JSON line, if there is one and anything was recorded.
+  """
+
+  if _metrics_file is None:
+    return
+
+  snapshot = _metrics.snapshot()
+  if not snapshot["calls"] and not snapshot["codecs"]:
+    return
+
+  with open(_metrics_file, 'a') as outfile:
+    outfile.write(json.dumps({"time": round(time.time(), 3), "command": command, **snapshot}) + "\n")
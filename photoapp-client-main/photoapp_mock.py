@@ -0,0 +1,831 @@
+#
+# photoapp_mock.py
+#
+# A local stand-in for the PhotoApp web service (photoapp-server-main),
+# so the client can be tested and benchmarked without S3, RDS or
+# Rekognition. It serves the same endpoints with the same JSON:
+#
+#   GET  /                          GET  /image/:assetid
+#   GET  /stats                     POST /image/:userid
+#   GET  /users[?limit=&after=]     PUT  /user
+#   GET  /assets[?limit=&after=]    GET  /labels/:assetid
+#   GET  /bucket[?startafter=&prefix=]
+#   GET  /images/:label
+#   POST /uploads/:userid           GET  /uploads/:uploadid
+#   PUT  /uploads/:uploadid?offset= POST /uploads/:uploadid/complete
+#
+# Images move as raw application/octet-stream bodies instead of
+# base64 in JSON when the client asks for it (binary transfer),
+# and large files can be uploaded in resumable chunks. Both can
+# be turned off (binary=False) to act like a service that only
+# speaks JSON.
+#
+# As the service does through its compression middleware, JSON
+# responses of 1 KB or more are compressed when the client accepts
+# it (gzip or deflate, br with brotli installed, zstd with
+# zstandard), and gzipped request bodies are accepted. JSON
+# responses to GETs carry a weak ETag computed as Express does,
+# and If-None-Match is answered with 304 Not Modified.
+#
+# Data comes from a dataset generated in memory: users, assets
+# (whose contents are generated on demand, so large datasets stay
+# small) and labels. Everything is derived from a seed, so two
+# servers with the same settings return the same data.
+#
+# Each request can be slowed down (latency + random jitter, overall
+# or per endpoint) and made to fail (at a random rate, or the next
+# N requests), to exercise the client's retries, timeouts and
+# caches.
+#
+# In a test:
+#
+#   with MockPhotoApp(users=10, assets=100, latency=0.01) as server:
+#     client = PhotoAppClient(server.baseurl)
+#     ...
+#     server.fail_next(2, status=503)
+#
+# or from the command line, e.g. for photoapp_bench.py load:
+#
+#   python photoapp_mock.py --port 8080 --assets 10000 --latency 0.02
+#
+# Authors:
+#
+#   Neo Trovela-Villamiel
+#
+
+import argparse
+import base64
+import binascii
+import bisect
+import collections
+import gzip
+import hashlib
+import http.server
+import json
+import random
+import threading
+import time
+import urllib.parse
+import uuid
+import zlib
+
+
+# as the real service:
+BUCKET_PAGE_SIZE = 12
+MAX_PAGE_SIZE = 10000
+MIN_CONFIDENCE = 80
+
+DEFAULT_IMAGE_BYTES = 16 * 1024
+
+LAST_MODIFIED = "2024-01-01T00:00:00.000Z"
+
+OCTET_STREAM = 'application/octet-stream'
+
+# as the service's chunked uploads (S3 multipart uploads):
+MIN_CHUNK_SIZE = 5 * 1024 * 1024
+MAX_PARTS = 10000
+
+# as the service's compression middleware: bodies smaller than this
+# are sent uncompressed
+COMPRESSION_THRESHOLD = 1024
+
+
+def _encoders():
+  """
+  Returns {content coding: function compressing bytes}, most
+  preferred first; br and zstd only if their modules are installed.
+  """
+
+  encoders = {}
+
+  try:
+    import zstandard
+    encoders['zstd'] = zstandard.ZstdCompressor(level=3).compress
+  except ImportError:
+    pass
+
+  try:
+    import brotli
+    encoders['br'] = lambda data: brotli.compress(data, quality=4)
+  except ImportError:
+    pass
+
+  encoders['gzip'] = lambda data: gzip.compress(data, compresslevel=6, mtime=0)
+  encoders['deflate'] = lambda data: zlib.compress(data, 6)
+  return encoders
+
+
+_ENCODERS = _encoders()
+
+# request bodies the service inflates (as express.json):
+_DECODERS = {
+  'identity': lambda data: data,
+  'gzip': gzip.decompress,
+  'deflate': zlib.decompress
+}
+
+LABEL_NAMES = [
+  "Animal", "Beach", "Bird", "Building", "Car", "Cat", "City", "Cloud",
+  "Coast", "Dog", "Flower", "Food", "Forest", "Golden Retriever", "Grass",
+  "Mammal", "Mountain", "Nature", "Ocean", "Outdoors", "Person", "Pet",
+  "Plant", "Road", "Sand", "Sky", "Snow", "Sunset", "Tree", "Water"
+]
+
+
+###################################################################
+#
+# MockDataset
+#
+class MockDataset:
+  """
+  The service's data: users, assets, their contents and labels, as
+  the database and bucket would hold them. Generated assets have
+  no stored contents; their bytes are derived from the seed when
+  downloaded.
+  """
+
+  def __init__(self, users=10, assets=100, image_bytes=DEFAULT_IMAGE_BYTES,
+               analyzed=False, seed=0):
+    """
+    users: # of users
+    assets: # of assets, spread evenly over the users
+    image_bytes: size of each generated asset's contents
+    analyzed: True to label every asset up front (otherwise assets
+              are labeled when /labels is first called, as by the
+              real service, and only then found by /images)
+    seed: seed of everything generated
+    """
+
+    self.seed = seed
+    self.image_bytes = image_bytes
+    self.lock = threading.RLock()
+
+    rng = random.Random(seed)
+
+    self.users = {}      # userid => user row
+    self.userids = []    # sorted
+    self.emails = {}     # email => userid
+    self.assets = {}     # assetid => asset row
+    self.assetids = []   # sorted
+    self.keys = []       # sorted bucket keys
+    self.key_assets = {} # bucket key => assetid
+    self.contents = {}   # assetid => bytes, for uploaded assets
+    self.etags = {}      # assetid => ETag, computed when listed
+    self.labels = {}     # assetid => [(name, confidence)], once analyzed
+    self.uploads = {}    # upload id => state of a chunked upload
+
+    for i in range(users):
+      self.add_user(f"user{i}@example.com", f"Last{i}", f"First{i}",
+                    str(uuid.UUID(int=rng.getrandbits(128), version=4)))
+
+    for i in range(assets if self.userids else 0):
+      user = self.users[self.userids[i % len(self.userids)]]
+      key = f"{user['bucketfolder']}/{uuid.UUID(int=rng.getrandbits(128), version=4)}.jpg"
+      self.add_asset(user['userid'], f"photo{i:05d}.jpg", key)
+
+    if analyzed:
+      for assetid in self.assetids:
+        self.analyze(assetid)
+
+  def add_user(self, email, lastname, firstname, bucketfolder):
+    """
+    Inserts or updates a user by email, as PUT /user; returns
+    (userid, 'inserted' or 'updated').
+    """
+
+    with self.lock:
+      if email in self.emails:
+        user = self.users[self.emails[email]]
+        user.update(lastname=lastname, firstname=firstname, bucketfolder=bucketfolder)
+        return user['userid'], 'updated'
+
+      userid = (self.userids[-1] if self.userids else 80000) + 1
+      self.users[userid] = {"userid": userid, "email": email, "lastname": lastname,
+                            "firstname": firstname, "bucketfolder": bucketfolder}
+      self.userids.append(userid)
+      self.emails[email] = userid
+      return userid, 'inserted'
+
+  def add_asset(self, userid, assetname, bucketkey, contents=None):
+    """
+    Inserts an asset; returns its id.
+    """
+
+    with self.lock:
+      assetid = (self.assetids[-1] if self.assetids else 1000) + 1
+      self.assets[assetid] = {"assetid": assetid, "userid": userid,
+                              "assetname": assetname, "bucketkey": bucketkey}
+      self.assetids.append(assetid)
+      bisect.insort(self.keys, bucketkey)
+      self.key_assets[bucketkey] = assetid
+      if contents is not None:
+        self.contents[assetid] = contents
+      return assetid
+
+  def asset_contents(self, assetid):
+    with self.lock:
+      if assetid in self.contents:
+        return self.contents[assetid]
+    return random.Random(self.seed * 1000003 + assetid).randbytes(self.image_bytes)
+
+  def analyze(self, assetid):
+    """
+    Returns the labels of an asset as (name, confidence) sorted by
+    name, labeling it on first use like Rekognition would.
+    """
+
+    with self.lock:
+      if assetid not in self.labels:
+        rng = random.Random(self.seed * 1000033 + assetid)
+        names = rng.sample(LABEL_NAMES, rng.randint(2, 6))
+        self.labels[assetid] = sorted((name, rng.randint(MIN_CONFIDENCE, 99)) for name in names)
+      return self.labels[assetid]
+
+  def bucket_item(self, key):
+    """
+    Returns the S3 listing entry of a bucket key.
+    """
+
+    with self.lock:
+      assetid = self.key_assets[key]
+      if assetid not in self.etags:
+        self.etags[assetid] = '"' + hashlib.md5(self.asset_contents(assetid)).hexdigest() + '"'
+      size = len(self.contents[assetid]) if assetid in self.contents else self.image_bytes
+      return {"Key": key, "LastModified": LAST_MODIFIED,
+              "ETag": self.etags[assetid], "Size": size, "StorageClass": "STANDARD"}
+
+
+###################################################################
+#
+# MockPhotoApp
+#
+class MockPhotoApp:
+  """
+  HTTP server answering like the PhotoApp web service, on a
+  background thread. Latency and failures can be changed while
+  it runs.
+  """
+
+  def __init__(self, dataset=None, host='127.0.0.1', port=0, latency=0.0,
+               jitter=0.0, failure_rate=0.0, failure_status=500, seed=0, binary=True,
+               compression=True, min_chunk_size=MIN_CHUNK_SIZE, **dataset_options):
+    """
+    dataset: MockDataset to serve, default is one made from
+             dataset_options (users, assets, image_bytes, analyzed)
+    host, port: where to listen; port 0 picks a free port
+    latency: seconds added to every request, or a dict endpoint =>
+             seconds (endpoints: stats, users, assets, bucket,
+             download, upload, user, labels, search; key 'default'
+             for the others)
+    jitter: up to this many random seconds added on top
+    failure_rate: fraction of requests that fail
+    failure_status: HTTP status of a failed request, or 0 to close
+                    the connection without answering
+    seed: seed of the dataset and of the random latency and failures
+    binary: accept and send images as raw bytes when asked to, and
+            chunked uploads, as the current service does; False =
+            JSON only
+    compression: compress JSON responses the client accepts
+                 compressed; False = never
+    min_chunk_size: smallest chunk of a chunked upload (except the
+                    last); the service's is S3's minimum part size
+    """
+
+    self.dataset = dataset if dataset is not None else MockDataset(seed=seed, **dataset_options)
+    self.latency = latency
+    self.jitter = jitter
+    self.failure_rate = failure_rate
+    self.failure_status = failure_status
+    self.binary = binary
+    self.compression = compression
+    self.min_chunk_size = min_chunk_size
+    self.started = time.time()
+
+    self.rng = random.Random(seed)
+    self.lock = threading.Lock()
+    self.failures = collections.deque()  # (status, endpoint or None, after, retry_after) for fail_next
+    self.counts = collections.Counter()  # endpoint => # of requests
+
+    self.httpd = http.server.ThreadingHTTPServer((host, port), _Handler)
+    self.httpd.daemon_threads = True
+    self.httpd.app = self
+    self.thread = None
+
+  @property
+  def baseurl(self):
+    host, port = self.httpd.server_address[:2]
+    return f"http://{host}:{port}"
+
+  def start(self):
+    self.thread = threading.Thread(target=self.httpd.serve_forever, name="photoapp-mock", daemon=True)
+    self.thread.start()
+    return self
+
+  def stop(self):
+    self.httpd.shutdown()
+    self.httpd.server_close()
+    if self.thread is not None:
+      self.thread.join()
+
+  def __enter__(self):
+    return self.start()
+
+  def __exit__(self, *exc_info):
+    self.stop()
+
+  def fail_next(self, count=1, status=500, endpoint=None, after=False, retry_after=None):
+    """
+    Makes the next `count` requests (to endpoint, or to any endpoint)
+    fail with the given status, 0 = close the connection. With
+    after=True the requests are handled first, as if the response
+    were lost on the way back. retry_after is sent as the
+    Retry-After header of the failed responses.
+    """
+
+    with self.lock:
+      self.failures.extend([(status, endpoint, after, retry_after)] * count)
+
+  def reset_counts(self):
+    with self.lock:
+      self.counts.clear()
+
+  def _delay_and_failure(self, endpoint):
+    """
+    Counts a request, and returns (seconds to wait, (failure status,
+    Retry-After) or None, whether to fail after handling it) for it.
+    """
+
+    with self.lock:
+      self.counts[endpoint] += 1
+
+      if isinstance(self.latency, dict):
+        delay = self.latency.get(endpoint, self.latency.get('default', 0.0))
+      else:
+        delay = self.latency
+      if self.jitter > 0:
+        delay += self.rng.uniform(0, self.jitter)
+
+      for i, (status, only, after, retry_after) in enumerate(self.failures):
+        if only is None or only == endpoint:
+          del self.failures[i]
+          return delay, (status, retry_after), after
+
+      if self.failure_rate > 0 and self.rng.random() < self.failure_rate:
+        return delay, (self.failure_status, None), False
+
+      return delay, None, False
+
+
+###################################################################
+#
+# request handling
+#
+_ROUTES = {
+  ('GET', ''): 'status',
+  ('GET', 'stats'): 'stats',
+  ('GET', 'users'): 'users',
+  ('GET', 'assets'): 'assets',
+  ('GET', 'bucket'): 'bucket',
+  ('GET', 'image'): 'download',
+  ('POST', 'image'): 'upload',
+  ('PUT', 'user'): 'user',
+  ('GET', 'labels'): 'labels',
+  ('GET', 'images'): 'search',
+  ('POST', 'uploads'): 'upload_start',
+  ('GET', 'uploads'): 'upload_status',
+  ('PUT', 'uploads'): 'upload_chunk',
+  ('POST', 'uploads', 'complete'): 'upload_complete',
+}
+
+# a response body sent as is rather than as JSON:
+_Binary = collections.namedtuple('_Binary', ['data', 'headers'])
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+  protocol_version = 'HTTP/1.1'
+
+  # headers and body are written separately; without this, Nagle's
+  # algorithm and delayed ACKs add ~40ms to every response:
+  disable_nagle_algorithm = True
+
+  def handle(self):
+    try:
+      super().handle()
+    except (BrokenPipeError, ConnectionResetError):
+      pass  # the client gave up (e.g. timed out) before the response
+
+  def do_GET(self):
+    self.dispatch('GET')
+
+  def do_POST(self):
+    self.dispatch('POST')
+
+  def do_PUT(self):
+    self.dispatch('PUT')
+
+  def log_message(self, format, *args):
+    pass
+
+  def dispatch(self, method):
+    url = urllib.parse.urlsplit(self.path)
+    parts = [urllib.parse.unquote(part) for part in url.path.split('/')[1:]]
+    self.query = dict(urllib.parse.parse_qsl(url.query))
+
+    app = self.server.app
+
+    route = (method, parts[0]) if len(parts) in (1, 2) else (method, parts[0], *parts[2:])
+    endpoint = _ROUTES.get(route)
+    if (endpoint is None
+        or (len(parts) >= 2) != (parts[0] in ('image', 'labels', 'images', 'uploads'))
+        or (endpoint.startswith('upload_') and not app.binary)):
+      return self.reply_text(404, f"Cannot {method} {url.path}")
+
+    body = None
+    if method in ('POST', 'PUT'):
+      length = int(self.headers.get('Content-Length', 0))
+      raw = self.rfile.read(length)
+
+      coding = self.headers.get('Content-Encoding', 'identity').lower()
+      if coding not in _DECODERS:
+        return self.reply(415, {"message": f'unsupported content encoding "{coding}"'})
+      try:
+        raw = _DECODERS[coding](raw)
+      except (OSError, EOFError, zlib.error):
+        return self.reply_text(400, "Bad Request")
+
+      if app.binary and self.headers.get('Content-Type', '').startswith(OCTET_STREAM):
+        body = raw
+      else:
+        try:
+          body = json.loads(raw) if raw else {}
+        except ValueError:
+          return self.reply_text(400, "Bad Request")
+
+    delay, failure, after = app._delay_and_failure(endpoint)
+    if delay > 0:
+      time.sleep(delay)
+
+    if failure is not None and not after:
+      return self.fail(failure)
+
+    with app.dataset.lock:
+      handler = getattr(self, 'handle_' + endpoint)
+      status, result = handler(app.dataset, parts[1] if len(parts) >= 2 else None, body)
+
+    if failure is not None:
+      return self.fail(failure)
+
+    if isinstance(result, _Binary):
+      self.reply_binary(status, result.data, result.headers)
+    else:
+      self.reply(status, result)
+
+  def fail(self, failure):
+    """
+    Answers with an injected failure (status, Retry-After), status
+    0 = close the connection.
+    """
+
+    status, retry_after = failure
+    if status == 0:
+      self.close_connection = True
+    else:
+      headers = {} if retry_after is None else {'Retry-After': str(retry_after)}
+      self.reply(status, {"message": f"injected failure ({status})"}, headers)
+
+  def wants_binary(self):
+    """
+    True if images should be sent as raw bytes: binary transfer is
+    on and the client prefers application/octet-stream.
+    """
+
+    return self.server.app.binary and OCTET_STREAM in self.headers.get('Accept', '')
+
+  def content_coding(self):
+    """
+    The most preferred content coding the client accepts (not
+    with q=0), or None.
+    """
+
+    accepted = set()
+    for item in self.headers.get('Accept-Encoding', '').split(','):
+      coding, _, params = item.strip().partition(';')
+      q = params.strip()
+      if not q.startswith('q=') or _float(q[2:]) > 0:
+        accepted.add(coding.strip().lower())
+
+    for coding in _ENCODERS:
+      if coding in accepted or '*' in accepted:
+        return coding
+    return None
+
+  def reply(self, status, result, headers={}):
+    data = json.dumps(result).encode()
+
+    if self.command == 'GET' and status == 200:
+      etag = _etag(data)
+      if etag in [tag.strip() for tag in self.headers.get('If-None-Match', '').split(',')]:
+        self.send_response(304)
+        self.send_header('ETag', etag)
+        self.end_headers()
+        return
+    else:
+      etag = None
+
+    self.send_response(status)
+    self.send_header('Content-Type', 'application/json; charset=utf-8')
+    if etag is not None:
+      self.send_header('ETag', etag)
+
+    if self.server.app.compression:
+      self.send_header('Vary', 'Accept-Encoding')
+      coding = self.content_coding() if len(data) >= COMPRESSION_THRESHOLD else None
+      if coding is not None:
+        data = _ENCODERS[coding](data)
+        self.send_header('Content-Encoding', coding)
+
+    self.send_header('Content-Length', str(len(data)))
+    for name, value in headers.items():
+      self.send_header(name, value)
+    self.end_headers()
+    self.wfile.write(data)
+
+  def reply_binary(self, status, data, headers):
+    self.send_response(status)
+    self.send_header('Content-Type', OCTET_STREAM)
+    self.send_header('Content-Length', str(len(data)))
+    for name, value in headers.items():
+      self.send_header(name, value)
+    self.end_headers()
+    self.wfile.write(data)
+
+  def reply_text(self, status, text):
+    data = text.encode()
+    self.send_response(status)
+    self.send_header('Content-Type', 'text/html; charset=utf-8')
+    self.send_header('Content-Length', str(len(data)))
+    self.end_headers()
+    self.wfile.write(data)
+
+  #
+  # endpoints, each returning (status, JSON body or _Binary):
+  #
+  def handle_status(self, dataset, arg, body):
+    app = self.server.app
+    result = {"status": "running", "uptime-in-secs": round(time.time() - app.started),
+              "dbConnection": "authenticated"}
+    if app.binary:
+      result["transfer"] = ["json", "binary", "chunked"]
+    return 200, result
+
+  def handle_stats(self, dataset, arg, body):
+    return 200, {"message": "success", "s3_status": 200,
+                 "db_numUsers": len(dataset.users), "db_numAssets": len(dataset.assets)}
+
+  def _page(self, ids, rows):
+    """
+    The rows of a listing, or one page of them if ?limit is given.
+    """
+
+    if 'limit' not in self.query:
+      return 200, {"message": "success", "data": [rows[id] for id in ids]}
+
+    try:
+      limit = int(self.query['limit'])
+      after = int(self.query.get('after', -1))
+      if limit < 1:
+        raise ValueError()
+    except ValueError:
+      return 400, {"message": "limit must be a positive integer, after an integer", "data": []}
+
+    start = bisect.bisect_right(ids, after)
+    page = ids[start:start + min(limit, MAX_PAGE_SIZE)]
+    return 200, {"message": "success", "data": [rows[id] for id in page]}
+
+  def handle_users(self, dataset, arg, body):
+    return self._page(dataset.userids, dataset.users)
+
+  def handle_assets(self, dataset, arg, body):
+    return self._page(dataset.assetids, dataset.assets)
+
+  def handle_bucket(self, dataset, arg, body):
+    keys = dataset.keys
+    prefix = self.query.get('prefix', '')
+    startafter = self.query.get('startafter', '')
+
+    start = bisect.bisect_right(keys, startafter) if startafter else 0
+    start = max(start, bisect.bisect_left(keys, prefix))
+
+    page = [key for key in keys[start:start + BUCKET_PAGE_SIZE] if key.startswith(prefix)]
+
+    # (the real service misspells "message" here)
+    return 200, {"messgage": "success", "data": [dataset.bucket_item(key) for key in page]}
+
+  def handle_download(self, dataset, arg, body):
+    assetid = _int(arg)
+    if assetid not in dataset.assets:
+      return 400, {"message": "No such asset...", "user_id": -1, "asset_name": "?",
+                   "bucket_key": "?", "data": []}
+
+    asset = dataset.assets[assetid]
+    if self.wants_binary():
+      return 200, _Binary(dataset.asset_contents(assetid), {
+        "X-PhotoApp-User-Id": str(asset['userid']),
+        "X-PhotoApp-Asset-Name": urllib.parse.quote(asset['assetname'] or '', safe=''),
+        "X-PhotoApp-Bucket-Key": urllib.parse.quote(asset['bucketkey'], safe='')
+      })
+
+    return 200, {"message": "success", "user_id": asset['userid'],
+                 "asset_name": asset['assetname'], "bucket_key": asset['bucketkey'],
+                 "data": base64.b64encode(dataset.asset_contents(assetid)).decode()}
+
+  def handle_upload(self, dataset, arg, body):
+    if isinstance(body, bytes) and not self.query.get('assetname', '').strip():
+      return 400, {"message": "assetname is required in the query string...", "asset_id": -1}
+
+    userid = _int(arg)
+    if userid not in dataset.users:
+      return 400, {"message": "No such user...", "asset_id": -1}
+
+    if isinstance(body, bytes):
+      contents, assetname = body, self.query['assetname']
+    else:
+      try:
+        contents = base64.b64decode(body['data'], validate=True)
+      except (KeyError, TypeError, ValueError) as e:
+        return 500, {"message": f"invalid image data: {e}", "asset_id": -1}
+      assetname = body.get('assetname')
+
+    key = f"{dataset.users[userid]['bucketfolder']}/{uuid.uuid4()}.jpg"
+    assetid = dataset.add_asset(userid, assetname, key, contents)
+    return 200, {"message": "success", "asset_id": assetid}
+
+  def _upload_status(self, uploadid, upload):
+    return {"message": "success", "upload_id": uploadid, "size": upload["size"],
+            "chunk_size": upload["chunk_size"], "received": upload["received"],
+            "asset_id": upload["asset_id"]}
+
+  def handle_upload_start(self, dataset, arg, body):
+    userid = _int(arg)
+    if userid not in dataset.users:
+      return 400, {"message": "No such user...", "upload_id": ""}
+
+    size = body.get('size') if isinstance(body, dict) else None
+    sha256 = str(body.get('sha256')) if isinstance(body, dict) else ''
+    if (not isinstance(size, int) or size < 1 or len(sha256) != 64
+        or any(c not in '0123456789abcdef' for c in sha256)):
+      return 400, {"message": "size and sha256 (hex) of the file are required...", "upload_id": ""}
+
+    chunk_size = max(_int(body.get('chunk_size')) or 0, self.server.app.min_chunk_size,
+                     -(-size // MAX_PARTS))
+
+    uploadid = str(uuid.uuid4())
+    upload = dataset.uploads[uploadid] = {
+      "userid": userid, "assetname": body.get('assetname'), "size": size, "sha256": sha256,
+      "chunk_size": chunk_size, "data": bytearray(), "received": 0, "asset_id": -1
+    }
+    return 200, self._upload_status(uploadid, upload)
+
+  def handle_upload_status(self, dataset, arg, body):
+    upload = dataset.uploads.get(arg)
+    if upload is None:
+      return 404, {"message": "No such upload...", "received": -1}
+    return 200, self._upload_status(arg, upload)
+
+  def handle_upload_chunk(self, dataset, arg, body):
+    upload = dataset.uploads.get(arg)
+    if upload is None:
+      return 404, {"message": "No such upload...", "received": -1}
+
+    received = upload["received"]
+    if _int(self.query.get('offset')) != received or upload["asset_id"] != -1:
+      return 409, {"message": f"expected offset {received}", "received": received}
+
+    if not isinstance(body, bytes):
+      return 400, {"message": "chunk must be sent as application/octet-stream...", "received": received}
+
+    end = received + len(body)
+    if not body or end > upload["size"] or (len(body) != upload["chunk_size"] and end != upload["size"]):
+      return 400, {"message": f"chunks must be {upload['chunk_size']} bytes, except the last...",
+                   "received": received}
+
+    if hashlib.sha256(body).hexdigest() != self.headers.get('X-PhotoApp-Chunk-SHA256'):
+      return 400, {"message": "chunk checksum mismatch...", "received": received}
+
+    upload["data"] += body
+    upload["received"] = end
+    return 200, {"message": "success", "received": end}
+
+  def handle_upload_complete(self, dataset, arg, body):
+    upload = dataset.uploads.get(arg)
+    if upload is None:
+      return 404, {"message": "No such upload...", "asset_id": -1}
+
+    if upload["asset_id"] == -1:
+      if upload["received"] != upload["size"]:
+        return 400, {"message": f"upload incomplete, received {upload['received']} of {upload['size']} bytes...",
+                     "asset_id": -1}
+
+      contents = bytes(upload["data"])
+      if hashlib.sha256(contents).hexdigest() != upload["sha256"]:
+        del dataset.uploads[arg]
+        return 400, {"message": "file checksum mismatch, upload aborted...", "asset_id": -1}
+
+      key = f"{dataset.users[upload['userid']]['bucketfolder']}/{uuid.uuid4()}.jpg"
+      upload["asset_id"] = dataset.add_asset(upload["userid"], upload["assetname"], key, contents)
+      upload["data"] = None
+
+    return 200, {"message": "success", "asset_id": upload["asset_id"]}
+
+  def handle_user(self, dataset, arg, body):
+    userid, message = dataset.add_user(body.get('email'), body.get('lastname'),
+                                       body.get('firstname'), body.get('bucketfolder'))
+    return 200, {"message": message, "user_id": userid}
+
+  def handle_labels(self, dataset, arg, body):
+    assetid = _int(arg)
+    if assetid not in dataset.assets:
+      return 400, {"message": "No such asset...", "asset_name": "?", "data": []}
+
+    labels = dataset.analyze(assetid)
+    return 200, {"message": "success", "asset_name": dataset.assets[assetid]['assetname'],
+                 "data": [{"name": name, "confidence": c} for name, c in labels]}
+
+  def handle_search(self, dataset, arg, body):
+    label = arg.lower()  # MySQL compares case-insensitively
+    data = [{"asset_id": assetid, "confidence": c}
+            for assetid in sorted(dataset.labels)
+            for name, c in dataset.labels[assetid] if name.lower() == label]
+    return 200, {"message": "success", "data": data}
+
+
+def _int(text):
+  try:
+    return int(text)
+  except (TypeError, ValueError):
+    return None
+
+
+def _etag(data):
+  """
+  The weak ETag Express gives a response body:
+  W/"<length in hex>-<first 27 characters of its base64 SHA-1>".
+  """
+
+  digest = binascii.b2a_base64(hashlib.sha1(data).digest(), newline=False).decode()
+  return f'W/"{len(data):x}-{digest[:27]}"'
+
+
+def _float(text):
+  try:
+    return float(text)
+  except ValueError:
+    return 0.0
+
+
+###################################################################
+#
+# main
+#
+def main(argv=None):
+  parser = argparse.ArgumentParser(prog='photoapp_mock.py',
+                                   description="Local stand-in for the PhotoApp web service.")
+  parser.add_argument('--host', default='127.0.0.1')
+  parser.add_argument('--port', type=int, default=8080)
+  parser.add_argument('--users', type=int, default=10)
+  parser.add_argument('--assets', type=int, default=100)
+  parser.add_argument('--image-bytes', type=int, default=DEFAULT_IMAGE_BYTES, help="size of each asset")
+  parser.add_argument('--analyzed', action='store_true', help="label every asset up front")
+  parser.add_argument('--latency', type=float, default=0.0, help="seconds added to every request")
+  parser.add_argument('--jitter', type=float, default=0.0, help="up to this many random seconds more")
+  parser.add_argument('--failure-rate', type=float, default=0.0, help="fraction of requests that fail")
+  parser.add_argument('--failure-status', type=int, default=500,
+                      help="status of failed requests, 0 = drop the connection")
+  parser.add_argument('--seed', type=int, default=0)
+  parser.add_argument('--json-only', action='store_true',
+                      help="no binary transfer of images, as older versions of the service")
+  parser.add_argument('--no-compression', action='store_true', help="never compress responses")
+  parser.add_argument('--min-chunk-size', type=int, default=MIN_CHUNK_SIZE,
+                      help="smallest chunk of a chunked upload, except the last")
+  args = parser.parse_args(argv)
+
+  server = MockPhotoApp(host=args.host, port=args.port, latency=args.latency,
+                        jitter=args.jitter, failure_rate=args.failure_rate,
+                        failure_status=args.failure_status, seed=args.seed,
+                        binary=not args.json_only, compression=not args.no_compression,
+                        min_chunk_size=args.min_chunk_size, users=args.users, assets=args.assets,
+                        image_bytes=args.image_bytes, analyzed=args.analyzed)
+
+  print(f"**mock PhotoApp service listening on {server.baseurl}", flush=True)
+  try:
+    server.httpd.serve_forever()
+  except KeyboardInterrupt:
+    pass
+  finally:
+    server.httpd.server_close()
+
+  return 0
+
+
+if __name__ == "__main__":
+  raise SystemExit(main())
@@ -0,0 +1,174 @@
+#
+# photoapp_records.py
+#
+# Compact record types for the rows the web service returns
+# (users, assets, bucket contents), and fast decoding of those
+# rows from JSON dicts:
+#
+#   Record: base class of slotted record types; a subclass lists
+#           its fields in __slots__ and gets an __init__ taking
+#           them in that order, so instances have no __dict__.
+#
+#   decode_rows: turns a list of row dicts into records with a
+#                decoder built once per type (itemgetter + the
+#                generated __init__), instead of reflecting over
+#                the type for every row.
+#
+#   RecordColumns: a column-per-field container for very large
+#                  listings, with integer columns packed in arrays;
+#                  records are created only when accessed.
+#
+# Authors:
+#
+#   Neo Trovela-Villamiel
+#
+
+import array
+import itertools
+import operator
+
+
+###################################################################
+#
+# Record
+#
+class Record:
+  """
+  Base class of the record types. A subclass declares
+
+    class Asset(Record):
+      __slots__ = ('assetid', 'userid', 'assetname', 'bucketkey')
+      assetid: int
+      ...
+
+  and can then be created as Asset(assetid, userid, ...).
+  """
+
+  __slots__ = ()
+
+  def __init_subclass__(cls, **kwargs):
+    super().__init_subclass__(**kwargs)
+
+    fields = cls.__slots__
+    cls._fields = fields
+
+    #
+    # generate __init__(self, field1, field2, ...), which runs far
+    # faster than a loop of setattr calls:
+    #
+    source = (f"def __init__(self, {', '.join(fields)}):\n"
+              + "".join(f"  self.{field} = {field}\n" for field in fields))
+    namespace = {}
+    exec(source, namespace)
+    cls.__init__ = namespace['__init__']
+
+    cls._getter = operator.itemgetter(*fields) if len(fields) > 1 else \
+                  (lambda row, field=fields[0]: (row[field],))
+
+  @classmethod
+  def from_row(cls, row):
+    """
+    Decodes one row dict, see decode_rows.
+    """
+    return cls(*cls._getter(row))
+
+  def as_dict(self):
+    """
+    Returns the record as a dict field => value, e.g. for JSON.
+    """
+    return {field: getattr(self, field) for field in self._fields}
+
+  def __eq__(self, other):
+    if type(other) is not type(self):
+      return NotImplemented
+    return all(getattr(self, f) == getattr(other, f) for f in self._fields)
+
+  def __hash__(self):
+    # defining __eq__ alone would make records unhashable:
+    return hash((type(self),) + tuple(getattr(self, f) for f in self._fields))
+
+  def __repr__(self):
+    values = ", ".join(f"{f}={getattr(self, f)!r}" for f in self._fields)
+    return f"{type(self).__name__}({values})"
+
+
+def decode_rows(cls, rows):
+  """
+  Decodes row dicts (as returned by the web service) into records.
+  Extra keys in a row are ignored; a missing key raises KeyError.
+
+  Parameters
+  ----------
+  cls: Record subclass
+  rows: iterable of dicts
+
+  Returns
+  -------
+  list of cls objects
+  """
+
+  return list(itertools.starmap(cls, map(cls._getter, rows)))
+
+
+###################################################################
+#
+# RecordColumns
+#
+class RecordColumns:
+  """
+  Read-only sequence of records stored column by column: one
+  array('q') per int field and one list per other field. A record
+  object is only built when an element is accessed, so a million
+  rows cost a few pointers per field instead of a million objects.
+  """
+
+  def __init__(self, cls, rows=()):
+    """
+    cls: Record subclass whose fields become the columns
+    rows: iterable of row dicts to decode
+    """
+
+    self.cls = cls
+    self.columns = {}
+
+    for field in cls._fields:
+      if cls.__annotations__.get(field) is int:
+        self.columns[field] = array.array('q')
+      else:
+        self.columns[field] = []
+
+    self.extend(rows)
+
+  def extend(self, rows):
+    """
+    Appends row dicts, decoding them a batch at a time.
+    """
+
+    fields = self.cls._fields
+    getter = self.cls._getter
+    columns = [self.columns[field] for field in fields]
+
+    rows = iter(rows)
+    while True:
+      batch = list(map(getter, itertools.islice(rows, 10000)))
+      if not batch:
+        break
+      for column, values in zip(columns, zip(*batch)):
+        column.extend(values)
+
+  def column(self, field):
+    """
+    Returns a whole column, e.g. all asset ids.
+    """
+    return self.columns[field]
+
+  def __len__(self):
+    return len(self.columns[self.cls._fields[0]])
+
+  def __getitem__(self, i):
+    if isinstance(i, slice):
+      return [self[j] for j in range(*i.indices(len(self)))]
+    return self.cls(*(self.columns[field][i] for field in self.cls._fields))
+
+  def __iter__(self):
+    return itertools.starmap(self.cls, zip(*(self.columns[f] for f in self.cls._fields)))
@@ -0,0 +1,511 @@
+#
+# photoapp_stream.py
+#
+# Streaming base64 for the web service's JSON image contract, so
+# large images never have to be held in memory as a whole:
+#
+#   Base64JsonBody: a file-like JSON request body of the form
+#     {"assetname": "...", "data": "<base64 of a file>"} that
+#     base64-encodes the file chunk by chunk as it is sent.
+#
+#   read_json_streaming: parses a JSON object response as it
+#     arrives, base64-decoding one string field straight into a
+#     binary file and returning the other (small) fields.
+#
+#   gzip_body: compresses a request body chunk by chunk, for
+#     sending with Content-Encoding: gzip.
+#
+#   copy_streaming: writes a binary (octet-stream) response to a
+#     file as it arrives, the counterpart of read_json_streaming
+#     when the service sends images without base64.
+#
+#   iter_json_array: parses a JSON object response as it arrives,
+#     yielding the elements of one array field (e.g. the rows of
+#     /users) one at a time.
+#
+# Peak memory is a few chunks, independent of the image size.
+#
+# Authors:
+#
+#   Neo Trovela-Villamiel
+#
+
+import base64
+import codecs
+import gzip
+import hashlib
+import io
+import json
+import os
+import tempfile
+import time
+
+import photoapp_metrics
+
+
+# raw bytes encoded at a time; a multiple of 3 so each chunk
+# encodes to base64 without padding:
+ENCODE_CHUNK_SIZE = 3 * 64 * 1024
+
+# bytes of the response read at a time:
+DECODE_CHUNK_SIZE = 64 * 1024
+
+# bodies larger than this are gzipped into a temporary file
+# rather than into memory:
+GZIP_MEMORY_BYTES = 8 * 1024 * 1024
+
+
+###################################################################
+#
+# Base64JsonBody
+#
+class Base64JsonBody(io.RawIOBase):
+  """
+  Read-only stream producing the JSON body
+  {"assetname": <assetname>, "data": <base64 of the file>}
+  on the fly. The length is known up front (so the request has a
+  Content-Length), and the stream can be rewound with seek(0) to
+  send it again when a call is retried.
+  """
+
+  def __init__(self, filename, fields):
+    """
+    filename: file whose contents become the "data" field
+    fields: dict of the other (small) fields, sent before "data"
+    """
+
+    super().__init__()
+    self.filename = filename
+    if fields:
+      self.prefix = (json.dumps(fields)[:-1] + ', "data": "').encode()
+    else:
+      self.prefix = b'{"data": "'
+    self.suffix = b'"}'
+
+    filesize = os.path.getsize(filename)
+    self.length = len(self.prefix) + 4 * ((filesize + 2) // 3) + len(self.suffix)
+
+    self.infile = None
+    self.encode_seconds = 0.0
+    self.encoded_bytes = 0
+    self._rewind()
+
+  def _rewind(self):
+    if self.infile is not None:
+      self.infile.close()
+    self.infile = open(self.filename, 'rb')
+    self.pending = self.prefix
+    self.offset = 0
+    self.position = 0
+    self.done = False
+
+  def _refill(self):
+    self.offset = 0
+    chunk = self.infile.read(ENCODE_CHUNK_SIZE)
+    if chunk:
+      start = time.perf_counter()
+      self.pending = base64.b64encode(chunk)
+      self.encode_seconds += time.perf_counter() - start
+      self.encoded_bytes += len(chunk)
+    elif not self.done:
+      self.pending = self.suffix
+      self.done = True
+    else:
+      self.pending = b''
+
+  def __len__(self):
+    return self.length
+
+  def readable(self):
+    return True
+
+  def seekable(self):
+    return True
+
+  def tell(self):
+    return self.position
+
+  def seek(self, offset, whence=io.SEEK_SET):
+    if whence == io.SEEK_END and offset == 0:
+      return self.length  # only used to find the length
+    if whence != io.SEEK_SET or offset != 0:
+      raise io.UnsupportedOperation("can only rewind to the start")
+    self._rewind()
+    return 0
+
+  def readinto(self, buffer):
+    if self.offset >= len(self.pending):
+      self._refill()
+    n = min(len(buffer), len(self.pending) - self.offset)
+    buffer[:n] = self.pending[self.offset:self.offset + n]
+    self.offset += n
+    self.position += n
+    return n
+
+  def close(self):
+    if self.infile is not None:
+      self.infile.close()
+    if not self.closed and self.encoded_bytes:
+      photoapp_metrics.record_codec('base64_encode', self.encode_seconds, self.encoded_bytes)
+    super().close()
+
+
+###################################################################
+#
+# gzip_body
+#
+def gzip_body(source, level=1):
+  """
+  Compresses a request body with gzip, reading it chunk by chunk.
+
+  Parameters
+  ----------
+  source: readable binary stream with a length (len()), e.g. a
+          Base64JsonBody or io.BytesIO
+  level: gzip compression level, 1 (fastest) to 9
+
+  Returns
+  -------
+  binary file with the compressed body, positioned at its start;
+  in memory, or a temporary file if source is larger than
+  GZIP_MEMORY_BYTES. The caller closes it.
+  """
+
+  start = time.perf_counter()
+
+  if len(source) > GZIP_MEMORY_BYTES:
+    outfile = tempfile.TemporaryFile()
+  else:
+    outfile = io.BytesIO()
+
+  nbytes = 0
+  with gzip.GzipFile(fileobj=outfile, mode='wb', compresslevel=level, mtime=0) as compressor:
+    while True:
+      chunk = source.read(ENCODE_CHUNK_SIZE)
+      if not chunk:
+        break
+      compressor.write(chunk)
+      nbytes += len(chunk)
+
+  outfile.seek(0)
+  photoapp_metrics.record_codec('gzip_compress', time.perf_counter() - start, nbytes)
+  return outfile
+
+
+###################################################################
+#
+# read_json_streaming
+#
+class _Base64ToFile:
+  """
+  Incrementally decodes base64 text into a binary file, keeping
+  track of the # of bytes written and their SHA-256.
+  """
+
+  def __init__(self, outfile):
+    self.outfile = outfile
+    self.leftover = b''
+    self.size = 0
+    self.sha256 = hashlib.sha256()
+    self.decode_seconds = 0.0
+
+  def write(self, text):
+    text = self.leftover + text
+    n = len(text) - len(text) % 4
+    self.leftover = text[n:]
+    if n > 0:
+      start = time.perf_counter()
+      data = base64.b64decode(text[:n])
+      self.decode_seconds += time.perf_counter() - start
+      self._emit(data)
+
+  def finish(self):
+    if self.leftover:
+      self._emit(base64.b64decode(self.leftover))  # raises if truncated
+      self.leftover = b''
+    photoapp_metrics.record_codec('base64_decode', self.decode_seconds, self.size)
+
+  def _emit(self, data):
+    self.outfile.write(data)
+    self.size += len(data)
+    self.sha256.update(data)
+
+
+class _Reader:
+  """
+  Byte-level cursor over an iterator of byte chunks.
+  """
+
+  def __init__(self, chunks):
+    self.chunks = iter(chunks)
+    self.buf = b''
+    self.pos = 0
+
+  def _fill(self):
+    while self.pos >= len(self.buf):
+      try:
+        self.buf = next(self.chunks)
+      except StopIteration:
+        raise ValueError("response body ended in the middle of the JSON")
+      self.pos = 0
+
+  def next_token(self):
+    """
+    Skips whitespace and returns (without consuming) the next byte.
+    """
+    while True:
+      self._fill()
+      while self.pos < len(self.buf) and self.buf[self.pos] in b' \t\r\n':
+        self.pos += 1
+      if self.pos < len(self.buf):
+        return self.buf[self.pos:self.pos + 1]
+
+  def expect(self, token):
+    if self.next_token() != token:
+      raise ValueError(f"expected {token!r} in JSON response")
+    self.pos += 1
+
+  def string_segments(self):
+    """
+    Yields the raw (still escaped) bytes of a JSON string in
+    segments, having consumed the opening quote, up to and
+    including the closing quote.
+    """
+    self.expect(b'"')
+    while True:
+      self._fill()
+      quote = self.buf.find(b'"', self.pos)
+      backslash = self.buf.find(b'\\', self.pos)
+
+      if backslash != -1 and (quote == -1 or backslash < quote):
+        # an escape sequence: hand it over whole, it may span chunks
+        if backslash > self.pos:
+          yield self.buf[self.pos:backslash]
+        self.pos = backslash + 1
+        self._fill()
+        escaped = b'\\' + self.buf[self.pos:self.pos + 1]
+        self.pos += 1
+        yield escaped
+      elif quote != -1:
+        if quote > self.pos:
+          yield self.buf[self.pos:quote]
+        self.pos = quote + 1
+        return
+      else:
+        yield self.buf[self.pos:]
+        self.pos = len(self.buf)
+
+  def value_text(self):
+    """
+    Returns the raw text of a (small) JSON value of any kind.
+    """
+    token = self.next_token()
+
+    if token == b'"':
+      return b'"' + b''.join(self.string_segments()) + b'"'
+
+    if token in (b'[', b'{'):
+      text = []
+      depth = 0
+      while True:
+        token = self.next_token()
+        if token == b'"':
+          text.append(b'"' + b''.join(self.string_segments()) + b'"')
+          continue
+        self.pos += 1
+        text.append(token)
+        if token in (b'[', b'{'):
+          depth += 1
+        elif token in (b']', b'}'):
+          depth -= 1
+          if depth == 0:
+            return b''.join(text)
+
+    # number, true, false or null:
+    text = []
+    while True:
+      self._fill()
+      start = self.pos
+      while self.pos < len(self.buf) and self.buf[self.pos] not in b',}] \t\r\n':
+        self.pos += 1
+      text.append(self.buf[start:self.pos])
+      if self.pos < len(self.buf):
+        return b''.join(text)
+
+
+def read_json_streaming(chunks, field, outfile):
+  """
+  Parses a JSON object from an iterator of byte chunks (e.g. a
+  streamed response's iter_content), base64-decoding the string
+  value of `field` into outfile as it arrives.
+
+  Parameters
+  ----------
+  chunks: iterator of bytes
+  field: name of the base64 field, e.g. 'data'
+  outfile: binary file the decoded field is written to
+
+  Returns
+  -------
+  (fields, size, sha256) where fields is a dict of the other
+  fields, size the # of bytes written and sha256 their hex
+  digest; if `field` is present but not a string it is left in
+  fields and nothing is written
+  """
+
+  reader = _Reader(chunks)
+  decoder = _Base64ToFile(outfile)
+  fields = {}
+
+  reader.expect(b'{')
+  if reader.next_token() == b'}':
+    return fields, 0, decoder.sha256.hexdigest()
+
+  while True:
+    key = json.loads(reader.value_text())
+    reader.expect(b':')
+
+    if key == field and reader.next_token() == b'"':
+      for segment in reader.string_segments():
+        if segment.startswith(b'\\'):
+          segment = json.loads(b'"' + segment + b'"').encode()
+        decoder.write(segment)
+      decoder.finish()
+    else:
+      fields[key] = json.loads(reader.value_text())
+
+    if reader.next_token() == b'}':
+      break
+    reader.expect(b',')
+
+  return fields, decoder.size, decoder.sha256.hexdigest()
+
+
+def copy_streaming(chunks, outfile):
+  """
+  Writes a binary response (e.g. application/octet-stream) to
+  outfile as it arrives.
+
+  Parameters
+  ----------
+  chunks: iterator of bytes
+  outfile: binary file to write
+
+  Returns
+  -------
+  (size, sha256): # of bytes written and their hex digest
+  """
+
+  size = 0
+  sha256 = hashlib.sha256()
+  for chunk in chunks:
+    outfile.write(chunk)
+    sha256.update(chunk)
+    size += len(chunk)
+  return size, sha256.hexdigest()
+
+
+###################################################################
+#
+# iter_json_array
+#
+_decoder = json.JSONDecoder()
+
+
+def iter_json_array(chunks, field):
+  """
+  Parses a JSON object from an iterator of byte chunks, yielding
+  the elements of the array value of `field` as they arrive. Only
+  the element being parsed and the current chunk are in memory.
+  The fields after the array are not read.
+
+  Parameters
+  ----------
+  chunks: iterator of bytes
+  field: name of the array field, e.g. 'data'
+
+  Returns
+  -------
+  generator of the decoded elements; nothing if the object has no
+  such field or its value is not an array
+  """
+
+  reader = _Reader(chunks)
+
+  #
+  # find the field, skipping the (small) values before it:
+  #
+  reader.expect(b'{')
+  if reader.next_token() == b'}':
+    return
+
+  while True:
+    key = json.loads(reader.value_text())
+    reader.expect(b':')
+
+    if key == field and reader.next_token() == b'[':
+      reader.pos += 1
+      break
+
+    reader.value_text()
+    if reader.next_token() == b'}':
+      return
+    reader.expect(b',')
+
+  #
+  # the elements, each parsed by the C decoder from a text buffer
+  # that is refilled from the chunks whenever an element is cut
+  # off at its end:
+  #
+  utf8 = codecs.getincrementaldecoder('utf-8')()
+  text = utf8.decode(reader.buf[reader.pos:])
+  pos = 0
+  exhausted = False
+
+  def more():
+    nonlocal text, pos, exhausted
+    try:
+      chunk = next(reader.chunks)
+    except StopIteration:
+      if exhausted:
+        raise ValueError("response body ended in the middle of the JSON")
+      exhausted = True
+      chunk = b''
+    text = text[pos:] + utf8.decode(chunk, final=exhausted)
+    pos = 0
+
+  expect_element = True  # else a ',' or the closing ']'
+  first = True
+  while True:
+    while pos < len(text) and text[pos] in ' \t\r\n':
+      pos += 1
+    if pos >= len(text):
+      more()
+      continue
+
+    if text[pos] == ']' and (first or not expect_element):
+      return
+
+    if not expect_element:
+      if text[pos] != ',':
+        raise ValueError("expected ',' in JSON response")
+      pos += 1
+      expect_element = True
+      continue
+
+    try:
+      element, end = _decoder.raw_decode(text, pos)
+    except json.JSONDecodeError:
+      if exhausted:
+        raise
+      more()
+      continue
+
+    if end >= len(text) and not exhausted:
+      more()  # a number may continue in the next chunk
+      continue
+
+    yield element
+    pos = end
+    expect_element = False
+    first = False
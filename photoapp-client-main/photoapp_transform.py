@@ -0,0 +1,265 @@
+#
+# photoapp_transform.py
+#
+# Optional transform of images before they are uploaded: scale
+# down to a maximum width/height, recompress JPEGs at a given
+# quality and/or strip EXIF metadata. Label analysis does not need
+# full-size originals, and since uploads are sent base64-encoded
+# (4 bytes on the wire per 3 bytes of file), every byte saved here
+# saves a third more in transfer time.
+#
+# The transform is CPU-bound, so bulk uploads run it in a pool of
+# processes while the upload threads keep the network busy. It
+# needs Pillow, which is only imported when a transform is enabled:
+#
+#   pip3 install pillow
+#
+# Configured from the [client] section of the client config:
+#
+#   upload_max_dimension = 0    # max width/height in pixels, 0 = keep
+#   upload_jpeg_quality = 0     # 1-95, 0 = keep (85 if scaled down)
+#   upload_strip_exif = false
+#
+# Authors:
+#
+#   Neo Trovela-Villamiel
+#
+
+import os
+import threading
+import time
+
+from configparser import ConfigParser
+
+
+# quality of a JPEG that is scaled down, when none is configured:
+DEFAULT_JPEG_QUALITY = 85
+
+
+###################################################################
+#
+# transform_image
+#
+def _pillow():
+  """
+  Returns (Image, ImageOps) from Pillow, imported on first use.
+  """
+
+  try:
+    from PIL import Image, ImageOps
+  except ImportError:
+    raise RuntimeError("image transforms before upload need Pillow (pip3 install pillow)") from None
+
+  return Image, ImageOps
+
+
+def transform_image(src, dst, max_dimension=0, quality=0, strip_exif=False):
+  """
+  Writes a transformed copy of an image, in the same format: scaled
+  down (keeping its aspect ratio) so neither side is larger than
+  max_dimension, JPEGs re-encoded at the given quality, and EXIF
+  dropped if asked to. A module-level function, so it can run in
+  a process pool.
+
+  Parameters
+  ----------
+  src: image file to transform
+  dst: file to write
+  max_dimension: max width and height in pixels, 0 = keep size
+  quality: JPEG quality 1-95, 0 = keep (DEFAULT_JPEG_QUALITY if
+           the image is scaled down)
+  strip_exif: drop EXIF metadata (the image is rotated upright
+              first, so its orientation is not lost)
+
+  Returns
+  -------
+  dict with keys transformed, original_bytes, bytes, width, height
+  and seconds; transformed is False (and dst not written) if src
+  is not an image Pillow can read, or the result would not be
+  smaller than src
+  """
+
+  Image, ImageOps = _pillow()
+
+  start = time.perf_counter()
+  original_bytes = os.path.getsize(src)
+
+  result = {
+    "transformed": False,
+    "original_bytes": original_bytes,
+    "bytes": original_bytes,
+    "width": None,
+    "height": None
+  }
+
+  try:
+    image = Image.open(src)
+  except Image.UnidentifiedImageError:
+    result["seconds"] = time.perf_counter() - start
+    return result
+
+  with image:
+    format = image.format
+    exif = image.info.get('exif')
+    options = {}
+
+    if image.info.get('icc_profile'):
+      options['icc_profile'] = image.info['icc_profile']
+
+    if strip_exif and exif:
+      image = ImageOps.exif_transpose(image)
+    elif exif:
+      options['exif'] = exif
+
+    scaled = max_dimension > 0 and max(image.size) > max_dimension
+    if scaled:
+      image.thumbnail((max_dimension, max_dimension), Image.LANCZOS)
+
+    if format == 'JPEG':
+      if quality > 0:
+        options['quality'] = quality
+      elif scaled or strip_exif:
+        options['quality'] = DEFAULT_JPEG_QUALITY
+      else:
+        options['quality'] = 'keep'
+      options['optimize'] = True
+    elif format == 'PNG':
+      options['optimize'] = True
+
+    result["width"], result["height"] = image.size
+
+    image.save(dst, format=format, **options)
+
+  size = os.path.getsize(dst)
+  if size < original_bytes:
+    result["transformed"] = True
+    result["bytes"] = size
+  else:
+    os.remove(dst)
+    result["width"] = result["height"] = None
+
+  result["seconds"] = time.perf_counter() - start
+  return result
+
+
+###################################################################
+#
+# ImageTransform
+#
+class ImageTransform:
+  """
+  The transform settings used for uploads, and optionally the
+  process pool (concurrent.futures executor) to run them in.
+  """
+
+  def __init__(self, max_dimension=0, quality=0, strip_exif=False, executor=None):
+    if max_dimension < 0:
+      raise ValueError(f"max dimension must be >= 0, not {max_dimension}")
+    if not 0 <= quality <= 95:
+      raise ValueError(f"JPEG quality must be between 1 and 95 (0 = keep), not {quality}")
+
+    self.max_dimension = max_dimension
+    self.quality = quality
+    self.strip_exif = strip_exif
+    self.executor = executor
+
+  @property
+  def enabled(self):
+    """
+    True if the transform changes anything.
+    """
+    return self.max_dimension > 0 or self.quality > 0 or self.strip_exif
+
+  def replace(self, max_dimension=None, quality=None, strip_exif=None, executor=None):
+    """
+    Returns a copy with the given settings changed (None = keep).
+    """
+
+    return ImageTransform(
+      self.max_dimension if max_dimension is None else max_dimension,
+      self.quality if quality is None else quality,
+      self.strip_exif if strip_exif is None else strip_exif,
+      self.executor if executor is None else executor)
+
+  def settings(self):
+    return {
+      "max_dimension": self.max_dimension,
+      "quality": self.quality,
+      "strip_exif": self.strip_exif
+    }
+
+  def apply(self, src, dst):
+    """
+    Runs transform_image(src, dst) with these settings, in the
+    process pool if there is one; see transform_image.
+    """
+
+    args = (str(src), str(dst), self.max_dimension, self.quality, self.strip_exif)
+
+    if self.executor is None:
+      return transform_image(*args)
+
+    return self.executor.submit(transform_image, *args).result()
+
+
+def process_pool(workers=None):
+  """
+  Returns a pool of processes for ImageTransform.executor, with at
+  most one process per CPU. Processes are spawned rather than forked,
+  since the caller has upload threads (and their sockets) running.
+  """
+
+  import concurrent.futures
+  import multiprocessing
+
+  cpus = os.cpu_count() or 1
+  workers = cpus if workers is None else max(1, min(workers, cpus))
+
+  return concurrent.futures.ProcessPoolExecutor(
+    max_workers=workers, mp_context=multiprocessing.get_context('spawn'))
+
+
+###################################################################
+#
+# the transform used by photoapp_api.upload_image
+#
+_upload_transform = ImageTransform()
+_transform_lock = threading.Lock()
+
+
+def configure_transform(configur=None):
+  """
+  Sets the transform applied before uploads from the [client]
+  section of the config (upload_max_dimension, upload_jpeg_quality,
+  upload_strip_exif); by default nothing is transformed.
+
+  Parameters
+  ----------
+  configur: ConfigParser with the client config, or None for defaults
+
+  Returns
+  -------
+  nothing
+  """
+
+  global _upload_transform
+
+  if configur is None:
+    configur = ConfigParser()
+
+  transform = ImageTransform(
+    configur.getint('client', 'upload_max_dimension', fallback=0),
+    configur.getint('client', 'upload_jpeg_quality', fallback=0),
+    configur.getboolean('client', 'upload_strip_exif', fallback=False))
+
+  with _transform_lock:
+    _upload_transform = transform
+
+
+def get_upload_transform():
+  """
+  Returns the configured ImageTransform (possibly not enabled).
+  """
+
+  with _transform_lock:
+    return _upload_transform
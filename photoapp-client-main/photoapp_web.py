@@ -0,0 +1,664 @@
+#
+# photoapp_web.py
+#
+# Client-side access to the PhotoApp web service. All calls go
+# through one shared requests.Session, so repeated calls reuse
+# pooled keep-alive connections instead of opening a new TCP
+# connection (and paying the full handshake) every time. The
+# calls also share one retry engine (see web_service_call).
+#
+# The session is configured from the [client] section of the
+# client config file (photoapp-client-config.ini), all keys
+# are optional:
+#
+#   [client]
+#   webservice = http://...
+#   pool_connections = 4    # of hosts to keep connection pools for
+#   pool_maxsize = 16       # max keep-alive connections per host
+#   pool_block = false      # block instead of exceeding pool_maxsize
+#   connect_timeout = 5     # seconds
+#   read_timeout = 60       # seconds
+#   keep_alive = true
+#   compression = true      # accept compressed responses
+#   compress_requests = false   # gzip JSON request bodies...
+#   compress_min_bytes = 65536  # ...of at least this size
+#
+# plus the retry options listed under configure_retries(). Every
+# call is recorded in photoapp_metrics. GETs are conditional when
+# photoapp_cache's response cache holds an earlier response.
+#
+# Responses are accepted in every content coding the installed
+# urllib3 can decode: gzip and deflate, plus br if brotli is
+# installed and zstd if zstandard is (pip3 install brotli
+# zstandard); requests decodes them transparently. Request bodies
+# are only ever gzipped, which the web service (express.json)
+# inflates.
+#
+# Authors:
+#
+#   Neo Trovela-Villamiel
+#
+
+import io
+import json
+import random
+import threading
+import time
+
+from configparser import ConfigParser
+
+import photoapp_cache
+import photoapp_metrics
+import photoapp_stream
+
+
+###################################################################
+#
+# session configuration
+#
+DEFAULT_POOL_CONNECTIONS = 4
+DEFAULT_POOL_MAXSIZE = 16
+DEFAULT_POOL_BLOCK = False
+DEFAULT_CONNECT_TIMEOUT = 5.0
+DEFAULT_READ_TIMEOUT = 60.0
+DEFAULT_KEEP_ALIVE = True
+DEFAULT_COMPRESSION = True
+DEFAULT_COMPRESS_REQUESTS = False
+DEFAULT_COMPRESS_MIN_BYTES = 64 * 1024
+
+# gzip level of compressed request bodies; the fastest, since
+# JSON (and base64) shrinks nearly as much at level 1 as at 9:
+REQUEST_GZIP_LEVEL = 1
+
+_session = None
+_timeout = (DEFAULT_CONNECT_TIMEOUT, DEFAULT_READ_TIMEOUT)
+_compress_requests = DEFAULT_COMPRESS_REQUESTS
+_compress_min_bytes = DEFAULT_COMPRESS_MIN_BYTES
+_session_lock = threading.Lock()
+
+
+def accept_encoding(compression=True):
+  """
+  The Accept-Encoding header of requests: the content codings
+  the installed urllib3 can decode, e.g. 'gzip, deflate, br, zstd',
+  or 'identity' if compression is False.
+  """
+
+  if not compression:
+    return 'identity'
+
+  from urllib3.util.request import ACCEPT_ENCODING
+
+  return ', '.join(ACCEPT_ENCODING.split(','))
+
+
+def _new_session(pool_connections, pool_maxsize, pool_block, keep_alive,
+                 compression=DEFAULT_COMPRESSION):
+  """
+  Creates a requests.Session whose http/https adapters keep a
+  pool of connections per host.
+  """
+
+  #
+  # requests takes longer to import than the rest of the client,
+  # so it is only imported once a call is actually made:
+  #
+  import requests  # calling web service
+  from requests.adapters import HTTPAdapter
+
+  session = requests.Session()
+
+  adapter = HTTPAdapter(pool_connections=pool_connections,
+                        pool_maxsize=pool_maxsize,
+                        pool_block=pool_block)
+  session.mount('http://', adapter)
+  session.mount('https://', adapter)
+
+  if not keep_alive:
+    session.headers['Connection'] = 'close'
+
+  session.headers['Accept-Encoding'] = accept_encoding(compression)
+
+  return session
+
+
+def configure_session(configur=None):
+  """
+  (Re)creates the shared web service session from the [client]
+  section of the given config. Any option that is missing falls
+  back to its default. Calling this again closes the previous
+  session and its pooled connections.
+
+  Parameters
+  ----------
+  configur: ConfigParser with the client config, or None for defaults
+
+  Returns
+  -------
+  the new session
+  """
+
+  global _session, _timeout, _compress_requests, _compress_min_bytes
+
+  if configur is None:
+    configur = ConfigParser()
+
+  pool_connections = configur.getint('client', 'pool_connections', fallback=DEFAULT_POOL_CONNECTIONS)
+  pool_maxsize = configur.getint('client', 'pool_maxsize', fallback=DEFAULT_POOL_MAXSIZE)
+  pool_block = configur.getboolean('client', 'pool_block', fallback=DEFAULT_POOL_BLOCK)
+  connect_timeout = configur.getfloat('client', 'connect_timeout', fallback=DEFAULT_CONNECT_TIMEOUT)
+  read_timeout = configur.getfloat('client', 'read_timeout', fallback=DEFAULT_READ_TIMEOUT)
+  keep_alive = configur.getboolean('client', 'keep_alive', fallback=DEFAULT_KEEP_ALIVE)
+  compression = configur.getboolean('client', 'compression', fallback=DEFAULT_COMPRESSION)
+  compress_requests = configur.getboolean('client', 'compress_requests', fallback=DEFAULT_COMPRESS_REQUESTS)
+  compress_min_bytes = configur.getint('client', 'compress_min_bytes', fallback=DEFAULT_COMPRESS_MIN_BYTES)
+
+  session = _new_session(pool_connections, pool_maxsize, pool_block, keep_alive, compression)
+
+  with _session_lock:
+    old = _session
+    _session = session
+    _timeout = (connect_timeout, read_timeout)
+    _compress_requests = compress_requests
+    _compress_min_bytes = compress_min_bytes
+
+  if old is not None:
+    old.close()
+
+  return session
+
+
+def get_session():
+  """
+  Returns the shared web service session, creating one with the
+  default settings if configure_session() has not been called.
+  """
+
+  global _session
+
+  if _session is None:
+    with _session_lock:
+      if _session is None:
+        _session = _new_session(DEFAULT_POOL_CONNECTIONS,
+                                DEFAULT_POOL_MAXSIZE,
+                                DEFAULT_POOL_BLOCK,
+                                DEFAULT_KEEP_ALIVE)
+
+  return _session
+
+
+def close_session():
+  """
+  Closes the shared session and its pooled connections.
+  """
+
+  global _session
+
+  with _session_lock:
+    old = _session
+    _session = None
+
+  if old is not None:
+    old.close()
+
+
+###################################################################
+#
+# retries
+#
+# When calling servers on a network, calls can randomly fail.
+# Every verb shares one retry loop: exponential backoff with
+# jitter, a deadline per call, honoring Retry-After, and a
+# process-wide retry budget plus circuit breaker so a struggling
+# server is not hit by a storm of retries.
+#
+RETRYABLE_STATUS_CODES = [408, 429, 502, 503, 504]
+
+# the ones saying the request was not processed, so even a POST
+# can be sent again:
+UNPROCESSED_STATUS_CODES = [429, 503]
+
+DEFAULT_MAX_ATTEMPTS = 3
+DEFAULT_BACKOFF_BASE = 0.5
+DEFAULT_BACKOFF_MAX = 10.0
+DEFAULT_DEADLINE = 120.0
+DEFAULT_RETRY_BUDGET = 10.0
+DEFAULT_RETRY_REFILL = 0.1
+DEFAULT_CIRCUIT_THRESHOLD = 5
+DEFAULT_CIRCUIT_COOLDOWN = 30.0
+
+
+class WebServiceError(Exception):
+  """
+  Raised when a web service call could not get any response,
+  e.g. connection refused, timed out or the circuit is open.
+  """
+  pass
+
+
+class RetryPolicy:
+  """
+  How often and how long a single call may retry.
+  """
+
+  def __init__(self, max_attempts=DEFAULT_MAX_ATTEMPTS,
+               backoff_base=DEFAULT_BACKOFF_BASE,
+               backoff_max=DEFAULT_BACKOFF_MAX,
+               deadline=DEFAULT_DEADLINE):
+    self.max_attempts = max_attempts
+    self.backoff_base = backoff_base
+    self.backoff_max = backoff_max
+    self.deadline = deadline
+
+  def backoff(self, retries):
+    """
+    Returns the delay before retry #retries (1, 2, ...): a random
+    value between 0 and base * 2^(retries-1), capped ("full jitter").
+    """
+    ceiling = min(self.backoff_max, self.backoff_base * (2 ** (retries - 1)))
+    return random.uniform(0, ceiling)
+
+
+class RetryBudget:
+  """
+  Process-wide token bucket limiting retries. Every retry costs
+  one token, every successful call earns back a fraction of one,
+  so when most calls fail we stop retrying instead of multiplying
+  the load on the server.
+  """
+
+  def __init__(self, capacity=DEFAULT_RETRY_BUDGET, refill=DEFAULT_RETRY_REFILL):
+    self.capacity = capacity
+    self.refill = refill
+    self.tokens = capacity
+    self.lock = threading.Lock()
+
+  def withdraw(self):
+    with self.lock:
+      if self.tokens < 1:
+        return False
+      self.tokens -= 1
+      return True
+
+  def deposit(self):
+    with self.lock:
+      self.tokens = min(self.capacity, self.tokens + self.refill)
+
+
+class CircuitBreaker:
+  """
+  Opens after `threshold` consecutive failed calls, failing fast
+  for `cooldown` seconds. After the cooldown calls are let through
+  again; the first success closes the circuit, another failure
+  re-opens it.
+  """
+
+  def __init__(self, threshold=DEFAULT_CIRCUIT_THRESHOLD, cooldown=DEFAULT_CIRCUIT_COOLDOWN):
+    self.threshold = threshold
+    self.cooldown = cooldown
+    self.failures = 0
+    self.open_until = 0.0
+    self.lock = threading.Lock()
+
+  def check(self, url):
+    with self.lock:
+      wait = self.open_until - time.monotonic()
+    if wait > 0:
+      raise WebServiceError(f"circuit open for another {wait:.1f} secs, not calling '{url}'")
+
+  def record_success(self):
+    with self.lock:
+      self.failures = 0
+      self.open_until = 0.0
+
+  def record_failure(self):
+    with self.lock:
+      self.failures += 1
+      if self.failures >= self.threshold:
+        self.open_until = time.monotonic() + self.cooldown
+
+
+_retry_policy = RetryPolicy()
+_retry_budget = RetryBudget()
+_circuit = CircuitBreaker()
+
+
+def configure_retries(configur=None):
+  """
+  Sets the retry policy, retry budget and circuit breaker from
+  the [client] section of the given config (all keys optional):
+  max_attempts, backoff_base, backoff_max, deadline, retry_budget,
+  retry_refill, circuit_threshold and circuit_cooldown.
+
+  Parameters
+  ----------
+  configur: ConfigParser with the client config, or None for defaults
+
+  Returns
+  -------
+  nothing
+  """
+
+  global _retry_policy, _retry_budget, _circuit
+
+  if configur is None:
+    configur = ConfigParser()
+
+  _retry_policy = RetryPolicy(
+    max_attempts=configur.getint('client', 'max_attempts', fallback=DEFAULT_MAX_ATTEMPTS),
+    backoff_base=configur.getfloat('client', 'backoff_base', fallback=DEFAULT_BACKOFF_BASE),
+    backoff_max=configur.getfloat('client', 'backoff_max', fallback=DEFAULT_BACKOFF_MAX),
+    deadline=configur.getfloat('client', 'deadline', fallback=DEFAULT_DEADLINE))
+
+  _retry_budget = RetryBudget(
+    capacity=configur.getfloat('client', 'retry_budget', fallback=DEFAULT_RETRY_BUDGET),
+    refill=configur.getfloat('client', 'retry_refill', fallback=DEFAULT_RETRY_REFILL))
+
+  _circuit = CircuitBreaker(
+    threshold=configur.getint('client', 'circuit_threshold', fallback=DEFAULT_CIRCUIT_THRESHOLD),
+    cooldown=configur.getfloat('client', 'circuit_cooldown', fallback=DEFAULT_CIRCUIT_COOLDOWN))
+
+
+def _retry_after(response):
+  """
+  Returns the delay in seconds asked for by a Retry-After header
+  (either delta-seconds or an HTTP date), or 0 if there is none.
+  """
+
+  value = response.headers.get('Retry-After')
+  if not value:
+    return 0.0
+
+  try:
+    return max(0.0, float(value))
+  except ValueError:
+    pass
+
+  import email.utils  # rarely needed, and slow to import
+
+  try:
+    when = email.utils.parsedate_to_datetime(value)
+    return max(0.0, when.timestamp() - time.time())
+  except (TypeError, ValueError):
+    return 0.0
+
+
+def web_service_call(method, url, data=None, headers=None, stream=False):
+  """
+  Submits a request to the web service, retrying on connection
+  errors, timeouts and transient status codes (408, 429, 502, 503,
+  504). Any other status code, including 400 and 500 with an error
+  message, is a valid response and returned at once. Retries back
+  off exponentially with jitter (or wait as long as Retry-After
+  says), and stop when the attempts, the call's deadline or the
+  process-wide retry budget run out, in which case the last
+  response is returned.
+
+  A POST is not idempotent, so a POST is only retried when no
+  connection could be made (nothing was sent) or the service
+  answered 429 or 503 (nothing was done); after a 408, 502 or 504
+  the service may have processed it. Large JSON
+  bodies are gzipped if compress_requests is on (see
+  configure_session).
+
+  Parameters
+  ----------
+  method: 'GET', 'PUT' or 'POST'
+  url: url for calling the web service
+  data: optional python object sent as the JSON body, or a
+        file-like object (rewound with seek(0) before every
+        attempt) whose contents are sent as the body
+  headers: optional dict of extra request headers
+  stream: if True the response body is not read up front; use
+          response.iter_content() and close the response
+
+  Returns
+  -------
+  response received from web service; raises WebServiceError if
+  no response could be obtained at all
+  """
+
+  import requests  # already imported by get_session()
+
+  policy = _retry_policy
+  session = get_session()
+  start = time.monotonic()
+  deadline = start + policy.deadline
+  retries = 0
+
+  if hasattr(data, 'read'):
+    headers = {'Content-Type': 'application/json', **(headers or {})}
+
+  compressed = _compress_body(data, headers)
+  if compressed is not None:
+    data, headers = compressed
+
+  if hasattr(data, 'read'):
+    body = {'data': data}
+  else:
+    body = {'json': data}
+
+  try:
+    while True:
+      _circuit.check(url)
+
+      remaining = deadline - time.monotonic()
+      timeout = (min(_timeout[0], remaining), min(_timeout[1], remaining))
+
+      if 'data' in body:
+        data.seek(0)
+
+      response = None
+      try:
+        response = session.request(method, url, headers=headers, stream=stream,
+                                   timeout=timeout, **body)
+      except (requests.ConnectionError, requests.Timeout) as e:
+        error = e
+        retryable = method != 'POST' or _not_sent(e)
+      else:
+        if response.status_code not in RETRYABLE_STATUS_CODES:
+          #
+          # we consider this a successful call and response
+          #
+          _circuit.record_success()
+          _retry_budget.deposit()
+          _record_call(method, url, response, start, retries, data, stream)
+          return response
+        retryable = method != 'POST' or response.status_code in UNPROCESSED_STATUS_CODES
+
+      _circuit.record_failure()
+
+      #
+      # failed, try again?
+      #
+      retries = retries + 1
+      delay = policy.backoff(retries)
+      if response is not None:
+        delay = max(delay, _retry_after(response))
+
+      if (retryable
+          and retries < policy.max_attempts
+          and time.monotonic() + delay < deadline
+          and _retry_budget.withdraw()):
+        time.sleep(delay)
+        #
+        # sleeping may overshoot the deadline, leaving no time for
+        # another attempt:
+        #
+        if time.monotonic() < deadline:
+          if response is not None:
+            response.close()  # give the connection back to the pool
+          continue
+
+      #
+      # if get here, we give up:
+      #
+      _record_call(method, url, response, start, retries - 1, data, stream)
+
+      if response is not None:
+        return response
+
+      raise WebServiceError(f"{method} '{url}' failed after {retries} attempt(s): {error}") from error
+  finally:
+    if compressed is not None:
+      data.close()
+
+
+def _not_sent(error):
+  """
+  True if a requests exception was raised while connecting, before
+  any of the request was sent.
+  """
+
+  import requests
+  import urllib3
+
+  if isinstance(error, requests.ConnectTimeout):
+    return True
+  if not isinstance(error, requests.ConnectionError) or not error.args:
+    return False
+
+  reason = getattr(error.args[0], 'reason', error.args[0])  # MaxRetryError
+  return isinstance(reason, urllib3.exceptions.NewConnectionError)
+
+
+def _compress_body(data, headers):
+  """
+  Gzips a JSON request body, if compress_requests is on and the
+  body (a python object, or a file-like body sent as
+  application/json) has at least compress_min_bytes.
+
+  Returns
+  -------
+  (compressed file, headers with Content-Encoding: gzip), or None
+  if the body is sent as it is
+  """
+
+  if not _compress_requests or data is None:
+    return None
+
+  if hasattr(data, 'read'):
+    if headers.get('Content-Type') != 'application/json' or len(data) < _compress_min_bytes:
+      return None
+    data.seek(0)
+    source = data
+  else:
+    encoded = json.dumps(data, allow_nan=False).encode()
+    if len(encoded) < _compress_min_bytes:
+      return None
+    source = io.BytesIO(encoded)
+
+  headers = {**(headers or {}), 'Content-Type': 'application/json', 'Content-Encoding': 'gzip'}
+  return photoapp_stream.gzip_body(source, REQUEST_GZIP_LEVEL), headers
+
+
+def _record_call(method, url, response, start, retries, data, stream):
+  """
+  Records a finished call in photoapp_metrics: its latency, final
+  status, retries and body sizes as sent over the wire, so
+  compressed (the response's only if known without reading a
+  streamed body).
+  """
+
+  seconds = time.monotonic() - start
+  status = 0
+  sent = 0
+  received = 0
+
+  if response is not None:
+    status = response.status_code
+    sent = int(response.request.headers.get('Content-Length', 0))
+    length = response.headers.get('Content-Length')
+    if not stream:
+      received = response.raw.tell()  # as sent, i.e. compressed
+    elif length is not None:
+      received = int(length)
+  elif hasattr(data, '__len__') and hasattr(data, 'read'):
+    sent = len(data)
+
+  photoapp_metrics.record_call(method, url, status, seconds, retries,
+                               sent * (retries + 1), received)
+
+
+###################################################################
+#
+# web_service_get
+#
+def web_service_get(url, stream=False, headers=None):
+  """
+  Submits a GET request to a web service, retrying transient
+  failures; see web_service_call(). Unless streamed, the request
+  is conditional if the response cache (photoapp_cache) holds an
+  earlier response with an ETag or Last-Modified, and a 304 Not
+  Modified is returned as that response.
+
+  Parameters
+  ----------
+  url: url for calling the web service
+  stream: if True the response body is read by the caller
+  headers: optional dict of extra request headers
+
+  Returns
+  -------
+  response received from web service
+  """
+
+  cache = None if stream else photoapp_cache.get_response_cache()
+  if cache is None:
+    return web_service_call('GET', url, headers=headers, stream=stream)
+
+  key = (url, tuple(sorted(headers.items()))) if headers else url
+  entry = cache.lookup(key)
+  if entry is not None:
+    headers = {**(headers or {}), **cache.validators(entry)}
+
+  response = web_service_call('GET', url, headers=headers)
+  return cache.update(key, entry, response)
+
+
+###################################################################
+#
+# web_service_put
+#
+def web_service_put(url, data, headers=None):
+  """
+  Submits a PUT request with a JSON body to a web service,
+  retrying transient failures; see web_service_call().
+
+  Parameters
+  ----------
+  url: url for calling the web service
+  data: python object to send as JSON, or a rewindable file-like
+        object streaming the body
+  headers: optional dict of extra request headers
+
+  Returns
+  -------
+  response received from web service
+  """
+
+  return web_service_call('PUT', url, data, headers)
+
+
+###################################################################
+#
+# web_service_post
+#
+def web_service_post(url, data, headers=None):
+  """
+  Submits a POST request with a JSON body to a web service,
+  retrying transient failures; see web_service_call().
+
+  Parameters
+  ----------
+  url: url for calling the web service
+  data: python object to send as JSON, or a rewindable file-like
+        object streaming the body
+  headers: optional dict of extra request headers
+
+  Returns
+  -------
+  response received from web service
+  """
+
+  return web_service_call('POST', url, data, headers)
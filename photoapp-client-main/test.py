@@ -8,7 +8,6 @@
 #   CS 310
 #
 
-import requests  
 import jsons
 
 import uuid
@@ -18,72 +17,21 @@ import os
 import base64
 import time
 
+import tempfile
 import unittest
 
 from configparser import ConfigParser
 
+from photoapp_web import configure_session, configure_retries, web_service_get, WebServiceError
+import photoapp_bench
+import photoapp_bulk
+import photoapp_cache
+import photoapp_metrics
+from photoapp_client import PhotoAppClient, configure
+from photoapp_mock import MockPhotoApp
+from photoapp_api import ApiError
 
-###################################################################
-#
-# web_service_get
-#
-# When calling servers on a network, calls can randomly fail. 
-# The better approach is to repeat at least N times (typically 
-# N=3), and then give up after N tries.
-#
-def web_service_get(url):
-  """
-  Submits a GET request to a web service at most 3 times, since 
-  web services can fail to respond e.g. to heavy user or internet 
-  traffic. If the web service responds with status code 200, 400 
-  or 500, we consider this a valid response and return the response.
-  Otherwise we try again, at most 3 times. After 3 attempts the 
-  function returns with the last response.
-  
-  Parameters
-  ----------
-  url: url for calling the web service
-  
-  Returns
-  -------
-  response received from web service
-  """
-
-  try:
-    retries = 0
-    
-    while True:
-      response = requests.get(url)
-        
-      if response.status_code in [200, 400, 500]:
-        #
-        # we consider this a successful call and response
-        #
-        break;
-
-      #
-      # failed, try again?
-      #
-      retries = retries + 1
-      if retries < 3:
-        # try at most 3 times
-        time.sleep(retries)
-        continue
-          
-      #
-      # if get here, we tried 3 times, we give up:
-      #
-      break
-
-    return response
 
-  except Exception as e:
-    print("web_service_get() failed")
-    print("url: '%s'", url)
-    print("msg: %s", str(e))
-    raise
-  
-  
 ############################################################
 #
 # Unit tests
@@ -107,6 +55,9 @@ class WebServiceTests(unittest.TestCase):
       configur.read(config_file)
       baseurl = configur.get('client', 'webservice')
 
+      configure_session(configur)
+      configure_retries(configur)
+
       #
       # call web service, confirm no images are returned...
       #
@@ -166,7 +117,602 @@ class WebServiceTests(unittest.TestCase):
              
       print("test passed!")  
 
-      
+
+
+############################################################
+#
+# Tests against the local mock service (photoapp_mock.py),
+# which need no AWS resources
+#
+class MockServiceTests(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+      cls.tmpdir = tempfile.TemporaryDirectory()
+
+      configur = cls.configur = ConfigParser()
+      configur.read_dict({"client": {
+        "webservice": "http://unused",
+        "cache_dir": os.path.join(cls.tmpdir.name, "cache"),
+        "label_index_file": "",
+        "backoff_base": "0.01"
+      }})
+
+      cls.server = MockPhotoApp(users=5, assets=60, image_bytes=5000, seed=1).start()
+      cls.client = PhotoAppClient(cls.server.baseurl, configur)
+
+    @classmethod
+    def tearDownClass(cls):
+      cls.client.close()
+      cls.server.stop()
+      cls.tmpdir.cleanup()
+
+    def setUp(self):
+      self.server.reset_counts()
+      photoapp_cache.get_response_cache().clear()
+
+    def test_mock_paging(self):
+      print()
+      print("** MOCK TEST: paged listings match full listings **")
+
+      self.assertEqual(list(self.client.iter_users(page_size=2)), self.client.users())
+      self.assertEqual(list(self.client.iter_assets(page_size=7)), self.client.assets())
+      self.assertEqual(len(list(self.client.bucket())), 60)
+
+      print("test passed!")
+
+    def test_mock_download_cache(self):
+      print()
+      print("** MOCK TEST: second download comes from the cache **")
+
+      filename = os.path.join(self.tmpdir.name, "download.jpg")
+
+      first = self.client.download(1002, filename)
+      second = self.client.download(1002, filename)
+
+      self.assertFalse(first["cached"])
+      self.assertTrue(second["cached"])
+      self.assertEqual(first["sha256"], second["sha256"])
+      self.assertEqual(self.server.counts["download"], 1)
+
+      print("test passed!")
+
+    def test_mock_download_cache_per_service(self):
+      print()
+      print("** MOCK TEST: services with the same asset ids do not share cache entries **")
+
+      filename = os.path.join(self.tmpdir.name, "per-service.jpg")
+
+      with MockPhotoApp(users=1, assets=3, seed=1) as one, MockPhotoApp(users=1, assets=3, seed=2) as two:
+        assetid = one.dataset.assetids[0]
+        self.assertIn(assetid, two.dataset.assets)
+        self.assertNotEqual(one.dataset.asset_contents(assetid), two.dataset.asset_contents(assetid))
+
+        for server in (one, two, one, two):
+          result = PhotoAppClient(server.baseurl).download(assetid, filename)
+          with open(filename, "rb") as infile:
+            self.assertEqual(infile.read(), server.dataset.asset_contents(assetid))
+
+        self.assertTrue(result["cached"])
+        self.assertEqual(one.counts["download"], 1)
+        self.assertEqual(two.counts["download"], 1)
+
+      print("test passed!")
+
+    def test_mock_cache_eviction(self):
+      print()
+      print("** MOCK TEST: the download cache evicts the least recently used **")
+
+      configur = ConfigParser()
+      configur.read_dict(self.configur)
+      configur.read_dict({"client": {"cache_dir": os.path.join(self.tmpdir.name, "evict"),
+                                     "cache_max_mb": str(12000 / (1024 * 1024))}})  # 2 assets
+      try:
+        configure(configur)
+        cache = photoapp_cache.get_download_cache()
+        first, second, third = [asset.assetid for asset in self.client.assets()[:3]]
+        filename = os.path.join(self.tmpdir.name, "evict.jpg")
+
+        self.client.download(first, filename)
+        self.client.download(second, filename)
+        self.assertTrue(self.client.download(first, filename)["cached"])  # second is now LRU
+        self.client.download(third, filename)  # over the cap
+
+        stats = cache.stats()
+        self.assertEqual(stats["entries"], 2)
+        self.assertEqual(stats["evictions"], 1)
+        self.assertLessEqual(stats["bytes"], stats["max_bytes"])
+
+        self.assertTrue(self.client.download(third, filename)["cached"])
+        self.assertTrue(self.client.download(first, filename)["cached"])
+        self.assertFalse(self.client.download(second, filename)["cached"])
+        self.assertEqual(self.server.counts["download"], 4)
+      finally:
+        configure(self.configur)  # the other tests' settings
+
+      print("test passed!")
+
+    def test_mock_search_ttl(self):
+      print()
+      print("** MOCK TEST: expired search results are fetched again **")
+
+      configur = ConfigParser()
+      configur.read_dict(self.configur)
+      configur.read_dict({"client": {"search_ttl": "0.5"}})
+      try:
+        configure(configur)
+        asset_name, labels = self.client.labels(1010)
+        label = labels[0]["name"]
+
+        found = self.client.search(label)
+        self.assertEqual(self.client.search(label), found)
+        self.assertEqual(self.server.counts["search"], 1)
+
+        time.sleep(0.6)
+        self.assertEqual(self.client.search(label), found)
+        self.assertEqual(self.server.counts["search"], 2)
+      finally:
+        configure(self.configur)  # the other tests' settings
+
+      print("test passed!")
+
+    def test_mock_retries(self):
+      print()
+      print("** MOCK TEST: failed calls are retried **")
+
+      self.server.fail_next(2, status=503, endpoint="stats")
+
+      stats = self.client.stats()
+      self.assertEqual(stats["db_numAssets"], 60)
+      self.assertEqual(self.server.counts["stats"], 3)
+
+      print("test passed!")
+
+    def test_mock_retry_after(self):
+      print()
+      print("** MOCK TEST: Retry-After is honored **")
+
+      self.server.fail_next(1, status=503, endpoint="stats", retry_after=1)
+
+      start = time.monotonic()
+      self.client.stats()
+      self.assertGreaterEqual(time.monotonic() - start, 1.0)
+      self.assertEqual(self.server.counts["stats"], 2)
+
+      print("test passed!")
+
+    def test_mock_post_not_retried(self):
+      print()
+      print("** MOCK TEST: a POST that may have been processed is not retried **")
+
+      filename = os.path.join(self.tmpdir.name, "gateway.jpg")
+      with open(filename, "wb") as outfile:
+        outfile.write(uuid.uuid4().bytes * 100)
+
+      with MockPhotoApp(users=1, assets=0) as server:
+        client = PhotoAppClient(server.baseurl)
+
+        # stored, but the gateway timed out on the way back:
+        server.fail_next(1, status=504, endpoint="upload", after=True)
+        with self.assertRaises(ApiError):
+          client.upload(server.dataset.userids[0], filename, force=True)
+
+        self.assertEqual(server.counts["upload"], 1)
+        self.assertEqual(len(server.dataset.assets), 1)
+
+      print("test passed!")
+
+    def test_mock_retry_budget(self):
+      print()
+      print("** MOCK TEST: a drained retry budget stops retrying **")
+
+      configur = ConfigParser()
+      configur.read_dict(self.configur)
+      configur.read_dict({"client": {"retry_budget": "2", "retry_refill": "0",
+                                     "circuit_threshold": "100"}})
+      try:
+        configure(configur)
+        self.server.fail_next(10, status=503, endpoint="stats")
+
+        with self.assertRaises(ApiError):
+          self.client.stats()
+        self.assertEqual(self.server.counts["stats"], 3)  # 2 retries
+
+        with self.assertRaises(ApiError):
+          self.client.stats()
+        self.assertEqual(self.server.counts["stats"], 4)  # none left
+      finally:
+        self.server.failures.clear()
+        configure(self.configur)  # the other tests' settings
+
+      print("test passed!")
+
+    def test_mock_circuit_breaker(self):
+      print()
+      print("** MOCK TEST: an open circuit fails fast **")
+
+      configur = ConfigParser()
+      configur.read_dict(self.configur)
+      configur.read_dict({"client": {"circuit_threshold": "2", "circuit_cooldown": "30"}})
+      try:
+        configure(configur)
+        self.server.fail_next(2, status=503, endpoint="stats")
+
+        with self.assertRaises(WebServiceError):
+          self.client.stats()  # opens the circuit on the 2nd failure
+        self.assertEqual(self.server.counts["stats"], 2)
+
+        start = time.monotonic()
+        with self.assertRaises(WebServiceError):
+          self.client.stats()
+        self.assertLess(time.monotonic() - start, 0.1)
+        self.assertEqual(self.server.counts["stats"], 2)  # not called
+      finally:
+        configure(self.configur)  # the other tests' settings
+
+      print("test passed!")
+
+    def test_mock_deadline(self):
+      print()
+      print("** MOCK TEST: the deadline caps the time of a call **")
+
+      configur = ConfigParser()
+      configur.read_dict(self.configur)
+      configur.read_dict({"client": {"deadline": "1", "max_attempts": "10",
+                                     "circuit_threshold": "100"}})
+
+      with MockPhotoApp(users=1, assets=0, latency=0.4) as server:
+        try:
+          configure(configur)
+          client = PhotoAppClient(server.baseurl)
+          server.fail_next(10, status=503, endpoint="stats")
+
+          start = time.monotonic()
+          with self.assertRaises((ApiError, WebServiceError)):
+            client.stats()
+          self.assertLess(time.monotonic() - start, 1.5)
+          self.assertLess(server.counts["stats"], 4)
+        finally:
+          configure(self.configur)  # the other tests' settings
+
+      print("test passed!")
+
+    def test_mock_upload_dedup(self):
+      print()
+      print("** MOCK TEST: same contents are uploaded once **")
+
+      filename = os.path.join(self.tmpdir.name, "upload.jpg")
+      with open(filename, "wb") as outfile:
+        outfile.write(uuid.uuid4().bytes * 100)
+
+      first = self.client.upload(80001, filename)
+      second = self.client.upload(80001, filename)
+
+      self.assertFalse(first["duplicate"])
+      self.assertTrue(second["duplicate"])
+      self.assertEqual(first["asset_id"], second["asset_id"])
+      self.assertEqual(self.server.counts["upload"], 1)
+
+      print("test passed!")
+
+    def test_mock_metrics(self):
+      print()
+      print("** MOCK TEST: calls and retries are counted per endpoint **")
+
+      metrics = photoapp_metrics.get_metrics()
+      metrics.reset()
+
+      self.server.fail_next(1, status=503, endpoint="labels")
+      self.client.labels(1010, use_cache=False)
+      self.client.labels(1011, use_cache=False)
+
+      calls = {(c["method"], c["endpoint"]): c for c in metrics.snapshot()["calls"]}
+      labels = calls[("GET", "/labels/:id")]
+      self.assertEqual(labels["calls"], 2)
+      self.assertEqual(labels["retries"], 1)
+      self.assertEqual(labels["statuses"], {"200": 2})
+      self.assertIn('endpoint="/labels/:id"', metrics.to_prometheus())
+
+      print("test passed!")
+
+    def test_mock_binary_transfer(self):
+      print()
+      print("** MOCK TEST: images move as raw bytes, or as JSON if not supported **")
+
+      filename = os.path.join(self.tmpdir.name, "binary.jpg")
+      contents = uuid.uuid4().bytes * 100
+      with open(filename, "wb") as outfile:
+        outfile.write(contents)
+
+      downloaded = os.path.join(self.tmpdir.name, "binary-download.jpg")
+
+      for binary, expected in [(True, "binary"), (False, "json")]:
+        with MockPhotoApp(users=1, assets=0, binary=binary) as server:
+          client = PhotoAppClient(server.baseurl)
+          userid = server.dataset.userids[0]
+
+          up = client.upload(userid, filename, "binary.jpg", force=True)
+          down = client.download(up["asset_id"], downloaded, use_cache=False)
+
+          self.assertEqual(up["transfer"], expected)
+          self.assertEqual(down["transfer"], expected)
+          self.assertEqual(down["asset_name"], "binary.jpg")
+          self.assertEqual(server.dataset.asset_contents(up["asset_id"]), contents)
+          with open(downloaded, "rb") as infile:
+            self.assertEqual(infile.read(), contents)
+
+      print("test passed!")
+
+    def test_mock_compression(self):
+      print()
+      print("** MOCK TEST: compressed responses and request bodies **")
+
+      metrics = photoapp_metrics.get_metrics()
+      metrics.reset()
+
+      res = web_service_get(self.server.baseurl + "/assets")
+      self.assertEqual(res.headers["Content-Encoding"], "gzip")
+
+      calls = {(c["method"], c["endpoint"]): c for c in metrics.snapshot()["calls"]}
+      self.assertLess(calls[("GET", "/assets")]["bytes_received"], len(res.content) / 2)
+
+      configur = ConfigParser()
+      configur.read_dict(self.configur)
+      configur.read_dict({"client": {"compress_requests": "true", "compress_min_bytes": "1024",
+                                     "transfer": "json", "dedup_uploads": "false"}})
+
+      filename = os.path.join(self.tmpdir.name, "compressed.jpg")
+      with open(filename, "wb") as outfile:
+        outfile.write(uuid.uuid4().bytes * 1000)
+
+      with MockPhotoApp(users=1, assets=0) as server:
+        try:
+          configure(configur)  # settings are shared by all clients
+          client = PhotoAppClient(server.baseurl)
+          with self.assertRaises(ValueError):
+            PhotoAppClient(server.baseurl, self.configur)
+          metrics.reset()
+          up = client.upload(server.dataset.userids[0], filename, force=True)
+          self.assertEqual(up["transfer"], "json")
+          with open(filename, "rb") as infile:
+            self.assertEqual(server.dataset.asset_contents(up["asset_id"]), infile.read())
+
+          calls = {(c["method"], c["endpoint"]): c for c in metrics.snapshot()["calls"]}
+          self.assertLess(calls[("POST", "/image/:id")]["bytes_sent"], 16000)
+        finally:
+          configure(self.configur)  # the other tests' settings
+
+      print("test passed!")
+
+    def test_mock_bench_compression(self):
+      print()
+      print("** MOCK TEST: the compression bench measures full responses **")
+
+      with MockPhotoApp(users=50, assets=200, analyzed=True) as server:
+        try:
+          result = photoapp_bench.bench_compression(server.baseurl, runs=3)
+        finally:
+          configure(self.configur)  # the bench reconfigures the session
+
+      for endpoint in ("/users", "/assets"):
+        off, on = result["endpoints"][endpoint]["off"], result["endpoints"][endpoint]["on"]
+        self.assertGreater(on["wire_bytes"], 0)
+        self.assertGreater(off["wire_bytes"], on["wire_bytes"])
+        self.assertEqual(off["decoded_bytes"], on["decoded_bytes"])
+
+      print("test passed!")
+
+    def test_mock_conditional_get(self):
+      print()
+      print("** MOCK TEST: unchanged listings are revalidated, not refetched **")
+
+      cache = photoapp_cache.get_response_cache()
+      metrics = photoapp_metrics.get_metrics()
+      metrics.reset()
+
+      with MockPhotoApp(users=2, assets=20) as server:
+        client = PhotoAppClient(server.baseurl)
+
+        first = client.stats()
+        assets = client.assets()
+        self.assertEqual(client.stats(), first)
+        self.assertEqual(client.assets(), assets)
+
+        calls = {(c["method"], c["endpoint"]): c for c in metrics.snapshot()["calls"]}
+        self.assertEqual(calls[("GET", "/stats")]["statuses"], {"200": 1, "304": 1})
+        self.assertEqual(calls[("GET", "/assets")]["statuses"], {"200": 1, "304": 1})
+        self.assertEqual(calls[("GET", "/assets")]["errors"], 0)
+        self.assertEqual(cache.stats()["revalidated"], 2)
+
+        # a change shows up at once:
+        server.dataset.add_asset(80001, "new.jpg", "new/new.jpg")
+        self.assertEqual(client.stats()["db_numAssets"], 21)
+        self.assertEqual(len(client.assets()), 21)
+        self.assertEqual(cache.stats()["revalidated"], 2)
+
+      print("test passed!")
+
+    def test_mock_chunked_upload(self):
+      print()
+      print("** MOCK TEST: large uploads go in chunks, and resume after failures **")
+
+      configur = ConfigParser()
+      configur.read_dict(self.configur)
+      configur.read_dict({"client": {"chunked_upload_mb": "0.001", "upload_chunk_mb": "0.001"}})
+
+      filename = os.path.join(self.tmpdir.name, "chunked.jpg")
+      contents = uuid.uuid4().bytes * 320  # 5 chunks of 1048 bytes
+      with open(filename, "wb") as outfile:
+        outfile.write(contents)
+
+      with MockPhotoApp(users=1, assets=0, min_chunk_size=1024) as server:
+        userid = server.dataset.userids[0]
+        try:
+          configure(configur)  # settings are shared by all clients
+          client = PhotoAppClient(server.baseurl)
+
+          # the response to a chunk is lost, so it is sent again:
+          server.fail_next(1, 0, "upload_chunk", after=True)
+          up = client.upload(userid, filename, "chunked.jpg", force=True)
+          self.assertEqual(up["transfer"], "chunked")
+          self.assertEqual(up["resumed_bytes"], 0)
+          self.assertEqual(server.dataset.asset_contents(up["asset_id"]), contents)
+          self.assertEqual(server.counts["upload_complete"], 1)
+
+          # the first chunk is stored, but the upload fails; the next
+          # upload of the file resumes after it:
+          server.reset_counts()
+          server.fail_next(3, 503, "upload_chunk", after=True)
+          with self.assertRaises(ApiError):
+            client.upload(userid, filename, "chunked.jpg", force=True)
+
+          up = client.upload(userid, filename, "chunked.jpg", force=True)
+          self.assertEqual(up["resumed_bytes"], 1048)
+          self.assertEqual(server.counts["upload_chunk"], 3 + 4)
+          self.assertEqual(server.counts["upload_start"], 1)
+          self.assertEqual(server.dataset.asset_contents(up["asset_id"]), contents)
+        finally:
+          configure(self.configur)  # the other tests' settings
+
+      print("test passed!")
+
+    def test_mock_bulk_upload_resume(self):
+      print()
+      print("** MOCK TEST: an interrupted bulk upload resumes without re-sending **")
+
+      folder = os.path.join(self.tmpdir.name, "bulk-upload")
+      os.makedirs(folder)
+      for i in range(6):
+        with open(os.path.join(folder, f"{i}.jpg"), "wb") as outfile:
+          outfile.write(uuid.uuid4().bytes * 50)
+
+      manifest = os.path.join(self.tmpdir.name, "bulk-upload.jsonl")
+
+      with MockPhotoApp(users=1, assets=0) as server:
+        userid = server.dataset.userids[0]
+
+        server.fail_next(2, status=400, endpoint="upload")
+        first = photoapp_bulk.bulk_upload(server.baseurl, userid, [folder], workers=2,
+                                          manifest=manifest, out=None)
+        self.assertEqual(len(first["failures"]), 2)
+        self.assertEqual(server.counts["upload"], 6)
+
+        second = photoapp_bulk.bulk_upload(server.baseurl, userid, [folder], workers=2,
+                                           manifest=manifest, out=None)
+        self.assertEqual(second["failures"], [])
+        self.assertEqual(second["skipped"], 4)
+        self.assertEqual(server.counts["upload"], 8)  # only the 2 that failed
+        self.assertEqual(len(server.dataset.assets), 6)
+
+      print("test passed!")
+
+    def test_mock_bulk_download_resume(self):
+      print()
+      print("** MOCK TEST: an interrupted bulk download resumes without re-downloading **")
+
+      assetids = [asset.assetid for asset in self.client.assets()[10:16]]
+      target = os.path.join(self.tmpdir.name, "bulk-download")
+
+      self.server.fail_next(2, status=400, endpoint="download")
+      first = photoapp_bulk.bulk_download(self.server.baseurl, assetids, target, workers=2, out=None)
+      self.assertEqual(len(first["failures"]), 2)
+      self.assertEqual(self.server.counts["download"], 6)
+
+      second = photoapp_bulk.bulk_download(self.server.baseurl, assetids, target, workers=2, out=None)
+      self.assertEqual(second["failures"], [])
+      self.assertEqual(second["skipped"], 4)
+      self.assertEqual(self.server.counts["download"], 8)  # only the 2 that failed
+      self.assertEqual(len([f for f in os.listdir(target) if not f.startswith(".")]), 6)
+
+      print("test passed!")
+
+    def test_mock_bulk_analyze_resume(self):
+      print()
+      print("** MOCK TEST: an interrupted bulk analyze resumes without re-analyzing **")
+
+      assetids = [asset.assetid for asset in self.client.assets()[-6:]]
+
+      self.server.fail_next(2, status=400, endpoint="labels")
+      first = photoapp_bulk.bulk_analyze(self.server.baseurl, assetids, workers=2, rate=0, out=None)
+      self.assertEqual(len(first["failures"]), 2)
+      self.assertEqual(self.server.counts["labels"], 6)
+
+      second = photoapp_bulk.bulk_analyze(self.server.baseurl, assetids, workers=2, rate=0, out=None)
+      self.assertEqual(second["failures"], [])
+      self.assertEqual(second["skipped"], 4)
+      self.assertEqual(self.server.counts["labels"], 8)  # only the 2 that failed
+
+      print("test passed!")
+
+    def test_mock_labels_per_service(self):
+      print()
+      print("** MOCK TEST: labels and the label index are kept per service **")
+
+      with MockPhotoApp(users=1, assets=5, seed=1) as one, MockPhotoApp(users=1, assets=5, seed=2) as two:
+        assetids = one.dataset.assetids
+        self.assertEqual(assetids, two.dataset.assetids)
+
+        for server in (one, two):
+          client = PhotoAppClient(server.baseurl)
+          labels = {assetid: client.labels(assetid)[1] for assetid in assetids}
+          self.assertEqual(server.counts["labels"], len(assetids))  # none from the other's cache
+
+          label = labels[assetids[0]][0]["name"]
+          expected = [assetid for assetid in assetids
+                      if label in [found["name"] for found in labels[assetid]]]
+          self.assertEqual(client.query(f'"{label}"'), expected)
+
+        # analyzed on one, so still to do on a new service with those ids:
+        with MockPhotoApp(users=1, assets=5, seed=3) as three:
+          result = photoapp_bulk.bulk_analyze(three.baseurl, assetids, rate=0, out=None)
+          self.assertEqual(result["skipped"], 0)
+          self.assertEqual(three.counts["labels"], len(assetids))
+
+      print("test passed!")
+
+    def test_mock_label_query(self):
+      print()
+      print("** MOCK TEST: label index agrees with search **")
+
+      for assetid in range(1001, 1061):
+        self.client.labels(assetid)
+
+      found = [image["asset_id"] for image in self.client.search("dog", use_cache=False)]
+      self.assertEqual(self.client.query("dog"), sorted(found))
+
+      print("test passed!")
+
+    def test_mock_label_query_at_scale(self):
+      print()
+      print("** MOCK TEST: label queries over 200,000 assets **")
+
+      index = photoapp_bench.make_label_index(200000)
+
+      def having(label, min_confidence=0):
+        ids, confidences = index.postings[label]
+        return {id for id, c in zip(ids, confidences) if c >= min_confidence}
+
+      everything = set(index.assets)
+      expected = {
+        "dog": having("dog"),
+        "dog AND NOT cat": having("dog") - having("cat"),
+        "(beach OR ocean) AND person>=90": (having("beach") | having("ocean")) & having("person", 90),
+        "NOT cat": everything - having("cat"),
+        "person": having("person")
+      }
+      for expression, ids in expected.items():
+        self.assertEqual(index.query(expression), sorted(ids))
+        self.assertEqual(index.count(expression), len(ids))
+
+      # evaluating takes well under a millisecond here; the bound
+      # leaves room for slow machines:
+      result = photoapp_bench.bench_index(queries=list(expected), runs=5, index=index)
+      for expression, timing in result["queries"].items():
+        self.assertLess(timing["evaluate_ms"], 10.0, expression)
+
+      print("test passed!")
+
+
 ############################################################
 #
 # main
@@ -1,10 +1,12 @@
 //
-// app.get('/bucket?startafter=bucketkey', async (req, res) => {...});
+// app.get('/bucket?startafter=bucketkey&prefix=folder/', async (req, res) => {...});
 //
 // Retrieves the contents of the S3 bucket and returns the 
 // information about each asset to the client. Note that it
 // returns 12 at a time, use startafter query parameter to pass
 // the last bucketkey and get the next set of 12, and so on.
+// The optional prefix query parameter restricts the listing to
+// keys starting with it, e.g. one user's bucket folder.
 //
 const { ListObjectsV2Command } = require('@aws-sdk/client-s3');
 const { photoapp_s3, s3_bucket_name, s3_region_name } = require('./photoapp_s3.js');
@@ -40,6 +42,12 @@ exports.get_bucket = async (req, res) => {
       input.StartAfter = startAfter; // adds startafter functionality from startafter parameter if it is not null
     }
 
+    const prefix = req.query.prefix;
+
+    if (prefix) {
+      input.Prefix = prefix; // S3 filters the keys, so a folder lists without walking the whole bucket
+    }
+
     //console.log("/stats: calling S3...");
 
     let command = new ListObjectsV2Command(input);
@@ -2,13 +2,18 @@
 // app.get('/image/:assetid', async (req, res) => {...});
 //
 // downloads an asset from S3 bucket and sends it back to the
-// client as a base64-encoded string.
+// client as a base64-encoded string. If the client prefers
+// application/octet-stream (Accept header), the image is sent as
+// is instead, streamed from S3, with the asset's user id, name and
+// bucket key in X-PhotoApp-* headers (name and key URI-encoded).
 //
 const photoapp_db = require('./photoapp_db.js')
 const { GetObjectCommand } = require('@aws-sdk/client-s3');
 const { photoapp_s3, s3_bucket_name, s3_region_name } = require('./photoapp_s3.js');
 const { query_database } = require('./utility.js');
 
+const { pipeline } = require('stream');
+
 exports.get_image = async (req, res) => {
 
   console.log("**Call to get /image/:assetid...");
@@ -66,6 +71,31 @@ exports.get_image = async (req, res) => {
 
     let s3_result = await Promise.all([s3_promise]);
     //console.log(s3_result);
+
+    if (req.accepts(["application/json", "application/octet-stream"]) === "application/octet-stream") {
+      res.set({
+        "Content-Type": "application/octet-stream",
+        "X-PhotoApp-User-Id": String(sql_results[0][0].userid),
+        "X-PhotoApp-Asset-Name": encodeURIComponent(sql_results[0][0].assetname),
+        "X-PhotoApp-Bucket-Key": encodeURIComponent(sql_results[0][0].bucketkey)
+      });
+      if (s3_result[0].ContentLength !== undefined) {
+        res.set("Content-Length", String(s3_result[0].ContentLength));
+      }
+      //
+      // headers are sent by now, so an S3 error mid-body can only
+      // cut the response short:
+      //
+      pipeline(s3_result[0].Body, res, (err) => {
+        if (err) {
+          console.log("**Error streaming /image");
+          console.log(err.message);
+          res.destroy(err);
+        }
+      });
+      return;
+    }
+
     var datastr = await s3_result[0].Body.transformToString("base64");
 
     res.json({
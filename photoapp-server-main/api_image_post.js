@@ -2,7 +2,10 @@
 // app.post('/image/:userid', async (req, res) => {...});
 //
 // Uploads an image to the bucket and updates the database,
-// returning the asset id assigned to this image.
+// returning the asset id assigned to this image. The image is
+// either base64-encoded in a JSON body {assetname, data}, or the
+// body itself (Content-Type: application/octet-stream) with the
+// asset name in the query string: POST /image/:userid?assetname=...
 //
 const photoapp_db = require('./photoapp_db.js')
 const { PutObjectCommand } = require('@aws-sdk/client-s3');
@@ -17,9 +20,19 @@ exports.post_image = async (req, res) => {
 
   try {
 
-    let data = req.body;  // data => JS object
+    let data = req.body;  // data => JS object, or Buffer if binary
     //console.log(data);
 
+    let binary = Buffer.isBuffer(data);
+    let assetname = binary ? req.query.assetname : data.assetname;
+
+    if (binary && (typeof assetname !== "string" || assetname.trim() === "")) {
+      return res.status(400).json({
+        "message": "assetname is required in the query string...",
+        "asset_id": -1
+      });
+    }
+
     let user_id = req.params.userid;
 
     let sql = `
@@ -47,8 +60,7 @@ exports.post_image = async (req, res) => {
     let new_bucketkey = sql_result[0][0].bucketfolder + '/' + name;
     console.log(new_bucketkey);
 
-    let S = req.body.data;
-    let bytes = Buffer.from(S, 'base64');
+    let bytes = binary ? data : Buffer.from(req.body.data, 'base64');
 
     // setting our params for input
     let input = {
@@ -69,7 +81,7 @@ exports.post_image = async (req, res) => {
     INSERT INTO assets (userid, assetname, bucketkey) VALUES (?, ?, ?)
     `;
     console.log(name);
-    let insert_promise = await query_database(photoapp_db, insert_sql, [user_id, data.assetname, new_bucketkey]);
+    let insert_promise = await query_database(photoapp_db, insert_sql, [user_id, assetname, new_bucketkey]);
     //let insert_sql_results = await Promise.all([insert_promise]);
 
     //console.log(insert_sql_results);
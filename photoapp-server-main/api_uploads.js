@@ -0,0 +1,359 @@
+//
+// Resumable, chunked uploads of large images:
+//
+// app.post('/uploads/:userid', async (req, res) => {...});
+//
+//   Starts an upload: JSON body {assetname, size, sha256, chunk_size}
+//   (sha256 = hex digest of the whole file). Returns the upload_id,
+//   the chunk_size to use (at least S3's minimum part size) and the
+//   # of bytes received so far (0).
+//
+// app.get('/uploads/:uploadid', async (req, res) => {...});
+//
+//   Returns how far an upload got: received (# of bytes, always a
+//   multiple of chunk_size until the last chunk), and the asset_id
+//   once completed (-1 before). A client resumes from received.
+//
+// app.put('/uploads/:uploadid?offset=N', async (req, res) => {...});
+//
+//   Stores one chunk (the raw bytes, application/octet-stream) at
+//   offset N, which must equal received; otherwise 409 with the
+//   current received, so a chunk sent twice (its response was lost)
+//   is harmless. The header X-PhotoApp-Chunk-SHA256 holds the hex
+//   digest of the chunk, which is checked before it is stored.
+//
+// app.post('/uploads/:uploadid/complete', async (req, res) => {...});
+//
+//   Once every byte is received and the whole file matches its
+//   sha256, completes the S3 multipart upload (the object appears
+//   atomically) and inserts the asset, returning its asset_id.
+//   Completing again returns the same asset_id.
+//
+// Chunks are the parts of an S3 multipart upload. The state of each
+// upload is kept in memory, so uploads do not survive a restart of
+// the web service (a client then starts over); uploads left idle
+// for UPLOAD_TTL_MS are aborted.
+//
+const photoapp_db = require('./photoapp_db.js')
+const { CreateMultipartUploadCommand, UploadPartCommand,
+        CompleteMultipartUploadCommand, AbortMultipartUploadCommand } = require('@aws-sdk/client-s3');
+const { photoapp_s3, s3_bucket_name, s3_region_name } = require('./photoapp_s3.js');
+const { query_database } = require('./utility.js');
+
+const crypto = require('crypto');
+const uuid = require('uuid');
+
+const MIN_CHUNK_SIZE = 5 * 1024 * 1024;   // S3's minimum part size
+const MAX_PARTS = 10000;                  // S3's maximum # of parts
+const UPLOAD_TTL_MS = 24 * 60 * 60 * 1000;
+
+const uploads = new Map();  // upload_id => state of the upload
+
+//
+// forgets the uploads nobody touched for UPLOAD_TTL_MS, aborting
+// those S3 has not completed:
+//
+function expire_uploads() {
+  let now = Date.now();
+
+  for (let [upload_id, upload] of uploads) {
+    if (now - upload.touched <= UPLOAD_TTL_MS) {
+      continue;
+    }
+    uploads.delete(upload_id);
+    if (!upload.s3_completed) {
+      photoapp_s3.send(new AbortMultipartUploadCommand({
+        Bucket: s3_bucket_name,
+        Key: upload.bucketkey,
+        UploadId: upload.s3_upload_id
+      })).catch(err => console.log("**Error aborting upload", upload_id, err.message));
+    }
+  }
+}
+
+function status_of(upload_id, upload) {
+  return {
+    "message": "success",
+    "upload_id": upload_id,
+    "size": upload.size,
+    "chunk_size": upload.chunk_size,
+    "received": upload.received,
+    "asset_id": upload.asset_id
+  };
+}
+
+exports.start_upload = async (req, res) => {
+
+  console.log("**Call to post /uploads/:userid...");
+
+  try {
+
+    let data = req.body;  // data => JS object
+    let user_id = req.params.userid;
+
+    let size = Number(data.size);
+    if (!Number.isSafeInteger(size) || size < 1 || !/^[0-9a-f]{64}$/.test(String(data.sha256))) {
+      return res.status(400).json({
+        "message": "size and sha256 (hex) of the file are required...",
+        "upload_id": ""
+      });
+    }
+
+    let sql = `
+        SELECT * FROM users WHERE userid = ?;
+        `;
+
+    let sql_result = await query_database(photoapp_db, sql, [user_id]);
+
+    if (sql_result.length === 0) { // invalid user id
+      return res.status(400).json({
+        "message": "No such user...",
+        "upload_id": ""
+      });
+    }
+
+    expire_uploads();
+
+    let chunk_size = Math.max(Number(data.chunk_size) || 0, MIN_CHUNK_SIZE, Math.ceil(size / MAX_PARTS));
+    let bucketkey = sql_result[0].bucketfolder + '/' + uuid.v4() + '.jpg';
+
+    let s3_result = await photoapp_s3.send(new CreateMultipartUploadCommand({
+      Bucket: s3_bucket_name,
+      Key: bucketkey,
+      ContentType: "image/jpg",
+      ACL: "public-read"
+    }));
+
+    let upload_id = uuid.v4();
+
+    uploads.set(upload_id, {
+      user_id: sql_result[0].userid,
+      assetname: data.assetname,
+      size: size,
+      sha256: String(data.sha256),
+      chunk_size: chunk_size,
+      bucketkey: bucketkey,
+      s3_upload_id: s3_result.UploadId,
+      parts: [],
+      hash: crypto.createHash('sha256'),  // of the bytes received, in order
+      received: 0,
+      asset_id: -1,
+      s3_completed: false,
+      busy: false,
+      touched: Date.now()
+    });
+
+    res.json(status_of(upload_id, uploads.get(upload_id)));
+
+  }//try
+  catch (err) {
+    console.log("**Error in /uploads");
+    console.log(err.message);
+
+    res.status(500).json({
+      "message": err.message,
+      "upload_id": ""
+    });
+  }//catch
+
+}//start
+
+exports.get_upload = async (req, res) => {
+
+  console.log("**Call to get /uploads/:uploadid...");
+
+  let upload = uploads.get(req.params.uploadid);
+
+  if (upload === undefined) {
+    return res.status(404).json({
+      "message": "No such upload...",
+      "received": -1
+    });
+  }
+
+  res.json(status_of(req.params.uploadid, upload));
+
+}//get
+
+exports.put_chunk = async (req, res) => {
+
+  console.log("**Call to put /uploads/:uploadid...");
+
+  let upload = uploads.get(req.params.uploadid);
+
+  if (upload === undefined) {
+    return res.status(404).json({
+      "message": "No such upload...",
+      "received": -1
+    });
+  }
+
+  try {
+
+    let chunk = req.body;  // Buffer, see express.raw in app.js
+    let offset = Number(req.query.offset);
+
+    //
+    // one chunk at a time, in order; anything else is answered
+    // with how far the upload got, to resume from there:
+    //
+    if (upload.busy || offset !== upload.received || upload.s3_completed) {
+      return res.status(409).json({
+        "message": "expected offset " + upload.received,
+        "received": upload.received
+      });
+    }
+
+    if (!Buffer.isBuffer(chunk)) {
+      return res.status(400).json({
+        "message": "chunk must be sent as application/octet-stream...",
+        "received": upload.received
+      });
+    }
+
+    let last = offset + chunk.length === upload.size;
+    if (chunk.length === 0 || (chunk.length !== upload.chunk_size && !last) || offset + chunk.length > upload.size) {
+      return res.status(400).json({
+        "message": "chunks must be " + upload.chunk_size + " bytes, except the last...",
+        "received": upload.received
+      });
+    }
+
+    let checksum = crypto.createHash('sha256').update(chunk).digest('hex');
+    if (checksum !== req.get('X-PhotoApp-Chunk-SHA256')) {
+      return res.status(400).json({
+        "message": "chunk checksum mismatch...",
+        "received": upload.received
+      });
+    }
+
+    upload.busy = true;
+    upload.touched = Date.now();
+
+    try {
+      let part_number = offset / upload.chunk_size + 1;
+
+      let s3_result = await photoapp_s3.send(new UploadPartCommand({
+        Bucket: s3_bucket_name,
+        Key: upload.bucketkey,
+        UploadId: upload.s3_upload_id,
+        PartNumber: part_number,
+        Body: chunk
+      }));
+
+      upload.parts.push({ ETag: s3_result.ETag, PartNumber: part_number });
+      upload.hash.update(chunk);
+      upload.received += chunk.length;
+    }
+    finally {
+      upload.busy = false;
+    }
+
+    res.json({
+      "message": "success",
+      "received": upload.received
+    });
+
+  }//try
+  catch (err) {
+    console.log("**Error in /uploads/:uploadid");
+    console.log(err.message);
+
+    res.status(500).json({
+      "message": err.message,
+      "received": upload.received
+    });
+  }//catch
+
+}//put
+
+exports.complete_upload = async (req, res) => {
+
+  console.log("**Call to post /uploads/:uploadid/complete...");
+
+  let upload_id = req.params.uploadid;
+  let upload = uploads.get(upload_id);
+
+  if (upload === undefined) {
+    return res.status(404).json({
+      "message": "No such upload...",
+      "asset_id": -1
+    });
+  }
+
+  try {
+
+    //
+    // completing twice (e.g. the first response was lost) must not
+    // insert a second asset, so concurrent calls share one promise:
+    //
+    if (upload.completing === undefined) {
+
+      if (upload.received !== upload.size) {
+        return res.status(400).json({
+          "message": "upload incomplete, received " + upload.received + " of " + upload.size + " bytes...",
+          "asset_id": -1
+        });
+      }
+
+      if (upload.hash.copy().digest('hex') !== upload.sha256) {
+        uploads.delete(upload_id);
+        await photoapp_s3.send(new AbortMultipartUploadCommand({
+          Bucket: s3_bucket_name,
+          Key: upload.bucketkey,
+          UploadId: upload.s3_upload_id
+        }));
+        return res.status(400).json({
+          "message": "file checksum mismatch, upload aborted...",
+          "asset_id": -1
+        });
+      }
+
+      upload.completing = (async () => {
+        //
+        // once S3 has completed the upload it no longer knows the
+        // upload id, so a retry after a failed INSERT only inserts:
+        //
+        if (!upload.s3_completed) {
+          await photoapp_s3.send(new CompleteMultipartUploadCommand({
+            Bucket: s3_bucket_name,
+            Key: upload.bucketkey,
+            UploadId: upload.s3_upload_id,
+            MultipartUpload: { Parts: upload.parts }
+          }));
+          upload.s3_completed = true;
+        }
+
+        let insert_sql = `
+        INSERT INTO assets (userid, assetname, bucketkey) VALUES (?, ?, ?)
+        `;
+        let insert_result = await query_database(photoapp_db, insert_sql,
+                                                 [upload.user_id, upload.assetname, upload.bucketkey]);
+
+        upload.asset_id = insert_result.insertId;
+        upload.touched = Date.now();
+        return upload.asset_id;
+      })();
+
+      upload.completing.catch(() => { upload.completing = undefined; });
+    }
+
+    let asset_id = await upload.completing;
+
+    res.json({
+      "message": "success",
+      "asset_id": asset_id
+    });
+
+  }//try
+  catch (err) {
+    console.log("**Error in /uploads/:uploadid/complete");
+    console.log(err.message);
+
+    res.status(500).json({
+      "message": err.message,
+      "asset_id": -1
+    });
+  }//catch
+
+}//complete
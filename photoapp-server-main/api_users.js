@@ -1,11 +1,17 @@
 //
-// app.get('/users', async (req, res) => {...});
+// app.get('/users?limit=N&after=userid', async (req, res) => {...});
 //
-// Return all the users from the database:
+// Return all the users from the database. With the optional limit
+// query parameter, returns at most that many (a page), ordered by
+// userid and starting after the optional after=userid; pass the last
+// userid of a page to get the next one. Keyset paging, unlike an
+// offset, costs the same for every page however large the table.
 //
 const photoapp_db = require('./photoapp_db.js')
 const { query_database } = require('./utility.js');
 
+const MAX_PAGE_SIZE = 10000; // rows per page at most, when paging
+
 exports.get_users = async (req, res) => {
 
   console.log("**Call to get /users...");
@@ -21,7 +27,27 @@ exports.get_users = async (req, res) => {
     let sql = `
     SELECT * FROM users ORDER BY userid;
     `
-    let sql_users = query_database(photoapp_db, sql);
+    let params = [];
+
+    if (req.query.limit !== undefined) {
+      let limit = parseInt(req.query.limit);
+      let after = (req.query.after !== undefined) ? parseInt(req.query.after) : -1;
+
+      if (isNaN(limit) || limit < 1 || isNaN(after)) {
+        res.status(400).json({
+          "message": "limit must be a positive integer, after an integer",
+          "data": []
+        });
+        return;
+      }
+
+      sql = `
+      SELECT * FROM users WHERE userid > ? ORDER BY userid LIMIT ?;
+      `
+      params = [after, Math.min(limit, MAX_PAGE_SIZE)];
+    }
+
+    let sql_users = query_database(photoapp_db, sql, params);
     //console.log(sql_users);
 
     let results = await Promise.all([sql_users]);
@@ -24,6 +24,7 @@
 //
 
 const express = require('express');
+const compression = require('compression');
 const app = express();
 const config = require('./config.js');
 
@@ -32,6 +33,19 @@ const { HeadBucketCommand, ListObjectsV2Command } = require('@aws-sdk/client-s3'
 const { photoapp_s3, s3_bucket_name, s3_region_name } = require('./photoapp_s3.js');
 const photoapp_rekognition = require('./photoapp_rekognition.js')
 
+// compress JSON responses of 1KB or more (gzip, deflate or br,
+// whichever the client prefers); listings like /bucket and /assets
+// shrink several-fold. Images sent as application/octet-stream are
+// already compressed and left alone. Gzipped JSON request bodies
+// (Content-Encoding: gzip) are inflated by express.json:
+app.use(compression({ threshold: "1kb" }));
+
+// JSON responses carry a weak ETag (Express' default, spelled out
+// since clients rely on it): a GET with a matching If-None-Match
+// gets 304 Not Modified and no body, so polling /stats, /users or
+// /assets costs little while nothing changes:
+app.set("etag", "weak");
+
 // support larger image uploads/downloads:
 app.use(express.json({ strict: false, limit: "50mb" }));
 
@@ -61,7 +75,8 @@ app.get('/', (req, res) => {
     res.json({
       "status": "running",
       "uptime-in-secs": uptime,
-      "dbConnection": photoapp_db.state
+      "dbConnection": photoapp_db.state,
+      "transfer": ["json", "binary", "chunked"]
     });
   }
   catch(err) {
@@ -84,6 +99,7 @@ let user = require('./api_user.js');
 let upload = require('./api_image_post.js');
 let analyze = require('./api_labels.js');
 let search = require('./api_images.js');
+let uploads = require('./api_uploads.js');
 
 app.get('/stats', stats.get_stats);  
 app.get('/users', users.get_users);  
@@ -96,4 +112,17 @@ app.get('/images/:label', search.search_images);
 
 app.put('/user', user.put_user);
 
-app.post('/image/:userid', upload.post_image);
+//
+// images can also be uploaded as the raw bytes of the file
+// (Content-Type: application/octet-stream), avoiding base64:
+//
+app.post('/image/:userid', express.raw({ type: "application/octet-stream", limit: "50mb" }), upload.post_image);
+
+//
+// resumable uploads of large images, a chunk at a time (see
+// api_uploads.js); a chunk is one part of an S3 multipart upload:
+//
+app.post('/uploads/:userid', uploads.start_upload);
+app.get('/uploads/:uploadid', uploads.get_upload);
+app.put('/uploads/:uploadid', express.raw({ type: "application/octet-stream", limit: "64mb" }), uploads.put_chunk);
+app.post('/uploads/:uploadid/complete', uploads.complete_upload);